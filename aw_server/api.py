@@ -1,14 +1,24 @@
+import base64
+import contextlib
 import functools
 import json
 import logging
-from datetime import datetime
+import os
+import threading
+from datetime import datetime, timezone
 from pathlib import Path
 from socket import gethostname
+from time import perf_counter
 from typing import (
+    IO,
     Any,
     Dict,
+    Iterator,
     List,
     Optional,
+    Set,
+    Tuple,
+    Union,
 )
 from uuid import uuid4
 
@@ -17,67 +27,430 @@ from aw_core.dirs import get_data_dir
 from aw_core.log import get_log_file_path
 from aw_core.models import Event
 from aw_query import query2
-from aw_transform import heartbeat_merge
+from aw_transform import (
+    Rule,
+    categorize,
+    heartbeat_merge,
+    merge_events_by_keys,
+    sort_by_duration,
+)
 
+from . import metrics, notifications, rollups
 from .__about__ import __version__
-from .exceptions import NotFound
+from .exceptions import BadRequest, NotFound, NotSupported, ServiceUnavailable
+from .jsonstream import JSONStreamReader
+from .query_cache import QueryCache, normalize_query
+from .query_pool import QueryPool
+from .query_profile import profile_query
 from .settings import Settings
 
 logger = logging.getLogger(__name__)
 
+# Number of events read from (or written to) the datastore at a time
+# when iterating over (or importing into) a bucket
+EVENTS_PAGE_SIZE = 1000
+
+# Largest page of events returned by a single paginated request
+MAX_EVENTS_PAGE_SIZE = 10000
+
+# Bucket metadata needed before events can be imported
+BUCKET_IMPORT_KEYS = ["id", "type", "client", "hostname", "created"]
+
+# Seconds between keep-alive messages sent to clients waiting for changes
+KEEPALIVE_INTERVAL = 15
+
+# Long-lived requests (change subscriptions and heartbeat streams) open at once,
+# as each holds a thread for as long as it's open
+MAX_STREAMS = 32
+
+# (timestamp, id) of an event
+EventKey = Tuple[datetime, int]
+
 
 def get_device_id() -> str:
     path = Path(get_data_dir("aw-server")) / "device_id"
-    if path.exists():
-        with open(path) as f:
-            return f.read()
-    else:
+    if not path.exists():
         uuid = str(uuid4())
-        with open(path, "w") as f:
-            f.write(uuid)
-        return uuid
+        try:
+            _write_exclusive(path, uuid)
+            return uuid
+        except FileExistsError:
+            # Created by another process or thread first, so all callers get the same ID
+            pass
+    with open(path) as f:
+        return f.read()
+
+
+def _write_exclusive(path: Path, content: str) -> None:
+    """Writes a file, raising FileExistsError if it already exists.
+
+    The content is written to a temporary file which is then linked into place,
+    so the file is never seen half-written. On filesystems without hard links
+    (such as exFAT) the file is instead created exclusively and written in place."""
+    tmp_path = path.with_name(f"{path.name}.{uuid4()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    try:
+        os.link(tmp_path, path)
+        return
+    except FileExistsError:
+        raise
+    except OSError as e:
+        logger.debug("Couldn't link %s into place (%s), writing it in place", path, e)
+    finally:
+        tmp_path.unlink()
+    with open(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY), "w") as f:
+        f.write(content)
+
+
+def _event_end(event: Event) -> datetime:
+    return event.timestamp + event.duration
+
+
+def _event_key(event: Event) -> EventKey:
+    """Key events are paginated by, unique and in the same order as timestamps"""
+    # Events read from the datastore always have an integer ID
+    assert isinstance(event.id, int)
+    return event.timestamp, event.id
+
+
+def encode_cursor(key: EventKey) -> str:
+    timestamp, event_id = key
+    return base64.urlsafe_b64encode(
+        f"{timestamp.isoformat()}|{event_id}".encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> EventKey:
+    try:
+        timestamp, event_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        )
+        return iso8601.parse_date(timestamp), int(event_id)
+    except (ValueError, iso8601.ParseError):
+        raise BadRequest("InvalidCursor", f"Invalid pagination cursor: {cursor}")
+
+
+def _parse_timeperiod(timeperiod: str) -> Tuple[datetime, datetime]:
+    period = timeperiod.split("/")[:2]  # iso8601 timeperiods are separated by a slash
+    return iso8601.parse_date(period[0]), iso8601.parse_date(period[1])
+
+
+def _parse_event(e: Any) -> Event:
+    """Creates an event from its JSON (or the dict it was parsed into).
+
+    The timestamp is parsed with datetime.fromisoformat if possible,
+    which is several times faster than the iso8601 parser used by Event."""
+    if isinstance(e, (str, bytes)):
+        e = json.loads(e)
+    if not isinstance(e, dict):
+        raise TypeError("event must be an object")
+    if not isinstance(e.get("data", {}), dict):
+        raise TypeError("data must be an object")
+    timestamp = e.get("timestamp")
+    if isinstance(timestamp, str):
+        try:
+            e["timestamp"] = datetime.fromisoformat(timestamp)
+        except ValueError:
+            # Left to iso8601 (such as "Z" suffixes before Python 3.11)
+            pass
+    return Event(**e)
+
+
+def _iter_lines(stream: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Yields the lines of a stream, read in chunks
+    (request streams are unbuffered, so reading them line by line is slow)"""
+    rest = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def _trim_event(
+    event: Event, start: Optional[datetime], end: Optional[datetime]
+) -> None:
+    """Trims an event to the given timeperiod, like the peewee storage method does"""
+    if start and event.timestamp < start:
+        event_end = _event_end(event)
+        event.timestamp = start
+        event.duration = event_end - start
+    if end and _event_end(event) > end:
+        event.duration = end - event.timestamp
 
 
 def check_bucket_exists(f):
     @functools.wraps(f)
     def g(self, bucket_id, *args, **kwargs):
-        if bucket_id not in self.db.buckets():
+        if bucket_id not in self.bucket_ids:
             raise NotFound("NoSuchBucket", f"There's no bucket named {bucket_id}")
         return f(self, bucket_id, *args, **kwargs)
 
     return g
 
 
+def flush_heartbeats_first(f):
+    """Writes heartbeats held back in write-behind mode before calling f,
+    so that reads and writes see the bucket as it would be without write-behind."""
+
+    @functools.wraps(f)
+    def g(self, bucket_id, *args, **kwargs):
+        self.flush_heartbeats(bucket_id)
+        return f(self, bucket_id, *args, **kwargs)
+
+    return g
+
+
 class ServerAPI:
-    def __init__(self, db, testing) -> None:
+    def __init__(
+        self,
+        db,
+        testing,
+        heartbeat_flush_interval: float = 0,
+        query_cache_size: int = 0,
+        query_workers: int = 1,
+    ) -> None:
+        # Counters and latencies served at /api/0/metrics
+        self.metrics = metrics.Metrics()
+
         self.db = db
         self.settings = Settings(testing)
         self.testing = testing
         self.last_event = {}  # type: dict
 
+        # Server info doesn't change while running (unless refreshed),
+        # so it's only read once instead of on every request.
+        self.info = {}  # type: Dict[str, Any]
+        self.refresh_info()
+
+        # IDs of all buckets, kept up to date by the methods creating and deleting
+        # buckets, so that checking if a bucket exists doesn't list all buckets.
+        self.bucket_ids: Set[str] = set(db.buckets())
+        self._bucket_ids_lock = threading.Lock()
+
+        # Heartbeats are processed under a lock per bucket, so that heartbeats
+        # to different buckets don't have to wait for each other.
+        # RLock since flush_heartbeats is also called while holding it.
+        self.heartbeat_locks: Dict[str, threading.RLock] = {}
+        self._heartbeat_locks_lock = threading.Lock()
+
+        # Write-behind mode for heartbeats: merged heartbeats are held in
+        # pending_heartbeats (and last_event) and written with replace_last
+        # every heartbeat_flush_interval seconds instead of on every heartbeat.
+        # Disabled if heartbeat_flush_interval is 0.
+        self.heartbeat_flush_interval = heartbeat_flush_interval
+        self.pending_heartbeats: Dict[str, Event] = {}
+        self._flush_stop = threading.Event()
+        if heartbeat_flush_interval > 0:
+            threading.Thread(
+                target=self._flush_loop, name="heartbeat-flush", daemon=True
+            ).start()
+
+        # Index of (timestamp, endtime) of the most recent event in each bucket,
+        # used to serve last_updated in get_buckets without querying every bucket.
+        # None means the bucket is known to be empty, a missing key means unknown.
+        self.last_event_span: Dict[str, Optional[Tuple[datetime, datetime]]] = {}
+
+        # Cache for query2 results, query_cache_size is its maximum size in bytes.
+        self.query_cache = QueryCache(query_cache_size) if query_cache_size else None
+
+        # Worker processes evaluating the timeperiods of a query in parallel,
+        # timeperiods are evaluated one by one if query_workers is 1.
+        self.query_pool = QueryPool(query_workers) if query_workers > 1 else None
+
+        # Durations by data values per bucket and hour, for summaries over long timeperiods
+        self.rollups = rollups.Rollups()
+
+        # Subscribers to changes of buckets (such as the web UI, through server-sent events)
+        self.notifier = notifications.ChangeNotifier()
+
+        # Long-lived requests open at once, further ones are rejected while max_streams are.
+        # Servers with a fixed number of threads (waitress) lower max_streams so that
+        # streams can't take all threads, and disable stream_request_bodies
+        # if they read the whole request body before handling a request.
+        self.max_streams = MAX_STREAMS
+        self.stream_request_bodies = True
+        self.streams = 0
+        self._streams_lock = threading.Lock()
+
+    def _bucket_changed(
+        self,
+        bucket_id: str,
+        since: Optional[datetime],
+        change: str,
+        event: Optional[Event] = None,
+    ) -> None:
+        """Called on every write to a bucket.
+
+        since is the earliest point in time affected by the write,
+        or None if unknown or if bucket metadata changed.
+        change is the type of change (see notifications), with the event it concerns if any.
+        """
+        if self.query_cache is not None:
+            self.query_cache.bucket_changed(bucket_id, since)
+        self._update_rollups(bucket_id, since, change, event)
+        self.notifier.publish(bucket_id, change, event)
+
+    def _update_rollups(
+        self,
+        bucket_id: str,
+        since: Optional[datetime],
+        change: str,
+        event: Optional[Event],
+    ) -> None:
+        if event is not None and change == notifications.EVENT_CREATED:
+            self.rollups.add(bucket_id, event.timestamp, _event_end(event), event.data)
+        elif (
+            event is not None
+            and since is not None
+            and change == notifications.EVENT_MERGED
+        ):
+            # The event was extended from since (its previous end)
+            self.rollups.add(bucket_id, since, _event_end(event), event.data)
+        elif event is not None and change == notifications.EVENT_DELETED:
+            self.rollups.add(
+                bucket_id, event.timestamp, _event_end(event), event.data, sign=-1
+            )
+        elif change == notifications.BUCKET_DELETED:
+            self.rollups.drop(bucket_id)
+        elif change != notifications.BUCKET_UPDATED:
+            self.rollups.invalidate(bucket_id, since)
+
+    def _flush_loop(self) -> None:
+        while not self._flush_stop.wait(self.heartbeat_flush_interval):
+            try:
+                self.flush_heartbeats()
+            except Exception:
+                logger.exception("Failed to flush pending heartbeats")
+
+    def flush_heartbeats(self, bucket_id: Optional[str] = None) -> None:
+        """Writes pending merged heartbeats of a bucket (or all buckets) to the datastore"""
+        if not self.pending_heartbeats:
+            return
+        bucket_ids = (
+            [bucket_id] if bucket_id is not None else list(self.pending_heartbeats)
+        )
+        for bid in bucket_ids:
+            with self._get_heartbeat_lock(bid):
+                merged = self.pending_heartbeats.pop(bid, None)
+                if merged is not None:
+                    self.db[bid].replace_last(merged)
+
+    def _get_heartbeat_lock(self, bucket_id: str) -> threading.RLock:
+        with self._heartbeat_locks_lock:
+            if bucket_id not in self.heartbeat_locks:
+                self.heartbeat_locks[bucket_id] = threading.RLock()
+            return self.heartbeat_locks[bucket_id]
+
+    @contextlib.contextmanager
+    def _locked_bucket(self, bucket_id: str):
+        # Only one heartbeat per bucket is processed at a time,
+        # as merging with the last event is not thread-safe.
+        lock = self._get_heartbeat_lock(bucket_id)
+        t_start = perf_counter()
+        acquired = lock.acquire(timeout=10)
+        self.metrics.observe_heartbeat_lock_wait(perf_counter() - t_start)
+        if not acquired:
+            logger.warning(
+                "Heartbeat lock for bucket '%s' could not be acquired within timeout, rejecting request.",
+                bucket_id,
+            )
+            raise ServiceUnavailable(
+                "HeartbeatLockTimeout", "Server busy, try again later"
+            )
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @contextlib.contextmanager
+    def _stream_slot(self):
+        """Held for as long as a long-lived request is open"""
+        with self._streams_lock:
+            if self.streams >= self.max_streams:
+                logger.warning(
+                    "Rejecting stream, %d streams are already open", self.streams
+                )
+                raise ServiceUnavailable(
+                    "TooManyStreams", "Too many open streams, try again later"
+                )
+            self.streams += 1
+        try:
+            yield
+        finally:
+            with self._streams_lock:
+                self.streams -= 1
+
+    def _transaction(self):
+        """Returns a context manager running the enclosed writes in a single transaction,
+        if the storage method supports it (currently only peewee)."""
+        storage_db = getattr(self.db.storage_strategy, "db", None)
+        if hasattr(storage_db, "atomic"):
+            return storage_db.atomic()
+        return contextlib.nullcontext()
+
+    def close(self) -> None:
+        """Stops the write-behind timer, writes any pending heartbeats,
+        stops query workers and closes change subscriptions"""
+        self._flush_stop.set()
+        self.flush_heartbeats()
+        if self.query_pool is not None:
+            self.query_pool.shutdown()
+        self.notifier.close()
+
     def get_info(self) -> Dict[str, Any]:
         """Get server info"""
-        payload = {
+        return dict(self.info)
+
+    def refresh_info(self) -> None:
+        """Reloads the server info (such as after the hostname has changed)"""
+        self.info = {
             "hostname": gethostname(),
             "version": __version__,
             "testing": self.testing,
             "device_id": get_device_id(),
         }
-        return payload
 
     def get_buckets(self) -> Dict[str, Dict]:
         """Get dict {bucket_name: Bucket} of all buckets"""
         logger.debug("Received get request for buckets")
         buckets = self.db.buckets()
+        self._fill_last_event_span(buckets)
         for b in buckets:
-            # TODO: Move this code to aw-core?
-            last_events = self.db[b].get(limit=1)
-            if len(last_events) > 0:
-                last_event = last_events[0]
-                last_updated = last_event.timestamp + last_event.duration
-                buckets[b]["last_updated"] = last_updated.isoformat()
+            span = self.last_event_span.get(b)
+            if span is not None:
+                buckets[b]["last_updated"] = span[1].isoformat()
         return buckets
 
+    def _fill_last_event_span(self, bucket_ids) -> None:
+        """Populates the last event index for buckets not yet in it.
+
+        Only queries the datastore on cold start (or after an event deletion),
+        after that the index is kept up to date by the methods writing events."""
+        for b in bucket_ids:
+            if b not in self.last_event_span:
+                # TODO: Move this code to aw-core?
+                last_events = self.db[b].get(limit=1)
+                self.last_event_span[b] = None
+                self._update_last_event_span(b, last_events)
+
+    def _update_last_event_span(
+        self, bucket_id: str, events: Union[Event, List[Event]]
+    ) -> None:
+        """Updates the last event index with newly written events."""
+        if bucket_id not in self.last_event_span:
+            # Unknown state, will be filled on next use
+            return
+        if isinstance(events, Event):
+            events = [events]
+        span = self.last_event_span[bucket_id]
+        for e in events:
+            if span is None or e.timestamp >= span[0]:
+                span = (e.timestamp, e.timestamp + e.duration)
+        self.last_event_span[bucket_id] = span
+
     @check_bucket_exists
     def get_bucket_metadata(self, bucket_id: str) -> Dict[str, Any]:
         """Get metadata about bucket."""
@@ -102,22 +475,103 @@ class ServerAPI:
             exported_buckets[bid] = self.export_bucket(bid)
         return exported_buckets
 
-    def import_bucket(self, bucket_data: Any):
-        bucket_id = bucket_data["id"]
-        logger.info(f"Importing bucket {bucket_id}")
+    @check_bucket_exists
+    @flush_heartbeats_first
+    def export_bucket_stream(self, bucket_id: str) -> Iterator[str]:
+        """Same as export_bucket, but as a generator of JSON chunks in the export format
+        which only keeps a page of events in memory at a time."""
+        return self._export_stream([bucket_id])
 
-        # TODO: Check that bucket doesn't already exist
-        self.db.create_bucket(
-            bucket_id,
-            type=bucket_data["type"],
-            client=bucket_data["client"],
-            hostname=bucket_data["hostname"],
-            created=(
-                bucket_data["created"]
-                if isinstance(bucket_data["created"], datetime)
-                else iso8601.parse_date(bucket_data["created"])
-            ),
-        )
+    def export_all_stream(self) -> Iterator[str]:
+        """Same as export_all, but as a generator of JSON chunks in the export format
+        which only keeps a page of events in memory at a time."""
+        self.flush_heartbeats()
+        return self._export_stream(list(self.db.buckets().keys()))
+
+    def _export_stream(self, bucket_ids: List[str]) -> Iterator[str]:
+        yield '{"buckets": {'
+        for i, bucket_id in enumerate(bucket_ids):
+            metadata = json.dumps(self.db[bucket_id].metadata())
+            # Leaves the bucket object open for the events to be added
+            yield '{}{}: {}, "events": ['.format(
+                ", " if i > 0 else "", json.dumps(bucket_id), metadata[:-1]
+            )
+            first = True
+            for page in self._iter_event_pages(bucket_id):
+                events = []
+                for event in page:
+                    event_dict = event.to_json_dict()
+                    # Scrub event IDs
+                    del event_dict["id"]
+                    events.append(json.dumps(event_dict))
+                yield ("" if first else ", ") + ", ".join(events)
+                first = False
+            yield "]}"
+        yield "}}"
+
+    def _iter_event_pages(
+        self,
+        bucket_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        page_size: int = EVENTS_PAGE_SIZE,
+    ) -> Iterator[List[Event]]:
+        """Iterates over the events of a bucket in pages,
+        in descending order by timestamp (same as get_events)."""
+        after = None  # type: Optional[EventKey]
+        while True:
+            page, more = self._read_event_page(bucket_id, page_size, start, end, after)
+            if page:
+                yield page
+            if not more:
+                return
+            after = _event_key(page[-1])
+
+    def _read_event_page(
+        self,
+        bucket_id: str,
+        page_size: int,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        after: Optional[EventKey],
+    ) -> Tuple[List[Event], bool]:
+        """Reads up to page_size events in descending order by (timestamp, id),
+        following the event with the key ``after``.
+        Also returns whether there are more events after the page.
+
+        The storage returns events with the same timestamp in no particular order,
+        so when the limit is reached, the events with the timestamp of the oldest
+        event read (some of which might not have fit within the limit) are left out.
+        """
+        endtime = after[0] if after else end
+        limit = page_size + 1
+        while True:
+            events = self.db[bucket_id].get(limit, start, endtime)
+            complete = len(events) < limit
+            if not complete:
+                oldest = events[-1].timestamp
+                events = [e for e in events if e.timestamp != oldest]
+            if after:
+                events = [e for e in events if _event_key(e) < after]
+            if complete or len(events) > page_size:
+                break
+            # Not enough events with distinct timestamps read, read more at once
+            limit *= 2
+
+        events.sort(key=_event_key, reverse=True)
+        page = events[:page_size]
+        for i, e in enumerate(page):
+            if after and _event_end(e) >= after[0]:
+                # Storage methods may trim events to the endtime,
+                # which is only wanted for the endtime given by the caller
+                untrimmed = self.db[bucket_id].get_by_id(e.id)
+                if untrimmed is not None:
+                    page[i] = e = untrimmed
+            _trim_event(e, start, end)
+        return page, len(events) > page_size
+
+    def import_bucket(self, bucket_data: Any):
+        self._create_imported_bucket(bucket_data)
 
         # scrub IDs from events
         # (otherwise causes weird bugs with no events seemingly imported when importing events exported from aw-server-rust, which contains IDs)
@@ -126,14 +580,98 @@ class ServerAPI:
                 del event["id"]
 
         self.create_events(
-            bucket_id,
+            bucket_data["id"],
             [Event(**e) if isinstance(e, dict) else e for e in bucket_data["events"]],
         )
 
+    def _create_imported_bucket(self, bucket_data: Dict[str, Any]) -> None:
+        bucket_id = bucket_data["id"]
+        logger.info("Importing bucket %s", bucket_id)
+
+        # TODO: Check that bucket doesn't already exist
+        with self._bucket_ids_lock:
+            self.db.create_bucket(
+                bucket_id,
+                type=bucket_data["type"],
+                client=bucket_data["client"],
+                hostname=bucket_data["hostname"],
+                created=(
+                    bucket_data["created"]
+                    if isinstance(bucket_data["created"], datetime)
+                    else iso8601.parse_date(bucket_data["created"])
+                ),
+            )
+            self.bucket_ids.add(bucket_id)
+        self.last_event_span[bucket_id] = None
+        self._bucket_changed(bucket_id, None, notifications.BUCKET_CREATED)
+
     def import_all(self, buckets: Dict[str, Any]):
         for bid, bucket in buckets.items():
             self.import_bucket(bucket)
 
+    def import_stream(
+        self, stream: IO[bytes], batch_size: int = EVENTS_PAGE_SIZE
+    ) -> Dict[str, int]:
+        """Imports buckets from a stream of JSON in the export format.
+
+        The stream is parsed incrementally and events are inserted in batches
+        (each in a transaction), so memory use doesn't depend on the size of the import.
+
+        Returns the number of events imported into each bucket."""
+        imported = {}  # type: Dict[str, int]
+        reader = JSONStreamReader(stream)
+        for key in reader.iter_object():
+            if key != "buckets":
+                reader.read_value()
+                continue
+            for _ in reader.iter_object():
+                bucket_id, count = self._import_bucket_stream(reader, batch_size)
+                imported[bucket_id] = count
+        return imported
+
+    def _import_bucket_stream(
+        self, reader: JSONStreamReader, batch_size: int
+    ) -> Tuple[str, int]:
+        metadata = {}  # type: Dict[str, Any]
+        created = False
+        # Events are only buffered if they come before the bucket metadata
+        buffered = []  # type: List[Event]
+        count = 0
+
+        def insert(events: List[Event]) -> None:
+            nonlocal count
+            with self._transaction():
+                self.create_events(metadata["id"], events)
+            count += len(events)
+            logger.info("Imported %d events into bucket '%s'", count, metadata["id"])
+
+        for key in reader.iter_object():
+            if key != "events":
+                metadata[key] = reader.read_value()
+                continue
+            if not created and all(k in metadata for k in BUCKET_IMPORT_KEYS):
+                self._create_imported_bucket(metadata)
+                created = True
+            batch = []  # type: List[Event]
+            for e in reader.iter_array():
+                # scrub IDs from events (see import_bucket)
+                e.pop("id", None)
+                if not created:
+                    buffered.append(Event(**e))
+                    continue
+                batch.append(Event(**e))
+                if len(batch) >= batch_size:
+                    insert(batch)
+                    batch = []
+            if batch:
+                insert(batch)
+
+        if not created:
+            self._create_imported_bucket(metadata)
+            for i in range(0, len(buffered), batch_size):
+                insert(buffered[i : i + batch_size])
+        return metadata["id"], count
+
     def create_bucket(
         self,
         bucket_id: str,
@@ -153,22 +691,26 @@ class ServerAPI:
         """
         if created is None:
             created = datetime.now()
-        if bucket_id in self.db.buckets():
-            return False
         if hostname == "!local":
             info = self.get_info()
             if data is None:
                 data = {}
             hostname = info["hostname"]
             data["device_id"] = info["device_id"]
-        self.db.create_bucket(
-            bucket_id,
-            type=event_type,
-            client=client,
-            hostname=hostname,
-            created=created,
-            data=data,
-        )
+        with self._bucket_ids_lock:
+            if bucket_id in self.bucket_ids:
+                return False
+            self.db.create_bucket(
+                bucket_id,
+                type=event_type,
+                client=client,
+                hostname=hostname,
+                created=created,
+                data=data,
+            )
+            self.bucket_ids.add(bucket_id)
+        self.last_event_span[bucket_id] = None
+        self._bucket_changed(bucket_id, None, notifications.BUCKET_CREATED)
         return True
 
     @check_bucket_exists
@@ -188,16 +730,27 @@ class ServerAPI:
             hostname=hostname,
             data=data,
         )
+        self._bucket_changed(bucket_id, None, notifications.BUCKET_UPDATED)
         return None
 
     @check_bucket_exists
     def delete_bucket(self, bucket_id: str) -> None:
         """Delete a bucket"""
-        self.db.delete_bucket(bucket_id)
-        logger.debug(f"Deleted bucket '{bucket_id}'")
+        with self._get_heartbeat_lock(bucket_id):
+            self.pending_heartbeats.pop(bucket_id, None)
+            with self._bucket_ids_lock:
+                self.db.delete_bucket(bucket_id)
+                self.bucket_ids.discard(bucket_id)
+            self.last_event.pop(bucket_id, None)
+            self.last_event_span.pop(bucket_id, None)
+        with self._heartbeat_locks_lock:
+            self.heartbeat_locks.pop(bucket_id, None)
+        self._bucket_changed(bucket_id, None, notifications.BUCKET_DELETED)
+        logger.debug("Deleted bucket '%s'", bucket_id)
         return None
 
     @check_bucket_exists
+    @flush_heartbeats_first
     def get_event(
         self,
         bucket_id: str,
@@ -205,36 +758,139 @@ class ServerAPI:
     ) -> Optional[Event]:
         """Get a single event from a bucket"""
         logger.debug(
-            f"Received get request for event {event_id} in bucket '{bucket_id}'"
+            "Received get request for event %s in bucket '%s'", event_id, bucket_id
         )
         event = self.db[bucket_id].get_by_id(event_id)
         return event.to_json_dict() if event else None
 
     @check_bucket_exists
+    @flush_heartbeats_first
     def get_events(
         self,
         bucket_id: str,
         limit: int = -1,
         start: Optional[datetime] = None,
         end: Optional[datetime] = None,
+        raw: bool = False,
     ) -> List[Event]:
         """Get events from a bucket"""
-        logger.debug(f"Received get request for events in bucket '{bucket_id}'")
+        logger.debug("Received get request for events in bucket '%s'", bucket_id)
         if limit is None:  # Let limit = None also mean "no limit"
             limit = -1
-        events = [
-            event.to_json_dict() for event in self.db[bucket_id].get(limit, start, end)
-        ]
-        return events
+        events = self.db[bucket_id].get(limit, start, end)
+        if raw:
+            # Serialized as-is by the JSON provider of the server
+            return events
+        return [event.to_json_dict() for event in events]
 
     @check_bucket_exists
+    @flush_heartbeats_first
+    def get_events_page(
+        self,
+        bucket_id: str,
+        page_size: int = EVENTS_PAGE_SIZE,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+        raw: bool = False,
+    ) -> Dict[str, Any]:
+        """Get a page of events from a bucket, in descending order by timestamp.
+
+        The response contains a ``next`` cursor if there are more events, which is
+        passed (along with the same start and end) to get the following page.
+        Pages are read with the (timestamp, id) of the last event as the key,
+        so reading a page takes the same time no matter how far into the bucket it is.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        page, more = self._read_event_page(bucket_id, page_size, start, end, after)
+        return {
+            "events": page if raw else [event.to_json_dict() for event in page],
+            "next": encode_cursor(_event_key(page[-1])) if more else None,
+        }
+
+    @check_bucket_exists
+    @flush_heartbeats_first
     def create_events(self, bucket_id: str, events: List[Event]) -> Optional[Event]:
         """Create events for a bucket. Can handle both single events and multiple ones.
 
         Returns the inserted event when a single event was inserted, otherwise None."""
-        return self.db[bucket_id].insert(events)
+        inserted = self.db[bucket_id].insert(events)
+        self._update_last_event_span(bucket_id, events)
+        if isinstance(events, Event):
+            self._bucket_changed(
+                bucket_id, events.timestamp, notifications.EVENT_CREATED, events
+            )
+        elif events:
+            self._bucket_changed(
+                bucket_id,
+                min(e.timestamp for e in events),
+                notifications.EVENT_CREATED,
+                events[0] if len(events) == 1 else None,
+            )
+        return inserted
 
     @check_bucket_exists
+    def create_events_bulk(self, bucket_id: str, events: List[Any]) -> int:
+        """Creates events given as dicts parsed from JSON, such as for a large backfill.
+
+        All events are parsed before the first is inserted, so if an event is invalid
+        none are created. The events are then inserted in a single transaction.
+
+        Returns the number of events created."""
+        parsed = []
+        for n, e in enumerate(events, start=1):
+            try:
+                parsed.append(_parse_event(e))
+            except (ValueError, TypeError) as err:
+                raise BadRequest("InvalidEvent", f"Invalid event {n}: {err}")
+        if parsed:
+            with self._transaction():
+                self.create_events(bucket_id, parsed)
+        logger.debug("Created %d events in bucket '%s'", len(parsed), bucket_id)
+        return len(parsed)
+
+    @check_bucket_exists
+    def create_events_stream(
+        self,
+        bucket_id: str,
+        stream: IO[bytes],
+        batch_size: int = EVENTS_PAGE_SIZE,
+    ) -> int:
+        """Creates events sent as newline-delimited JSON over a stream.
+
+        Events are parsed as they are read and inserted in batches (each in a transaction),
+        so events can be streamed without holding all of them in memory.
+        If an event is invalid, the batches before it have already been inserted.
+
+        Returns the number of events created."""
+        count = 0
+        batch: List[Event] = []
+
+        def insert() -> None:
+            nonlocal count
+            with self._transaction():
+                self.create_events(bucket_id, batch)
+            count += len(batch)
+
+        lines = (line for line in _iter_lines(stream) if line.strip())
+        for n, line in enumerate(lines, start=1):
+            try:
+                batch.append(_parse_event(line))
+            except (ValueError, TypeError) as err:
+                raise BadRequest(
+                    "InvalidEvent",
+                    f"Invalid event {n} ({count} events created): {err}",
+                )
+            if len(batch) >= batch_size:
+                insert()
+                batch = []
+        if batch:
+            insert()
+        logger.debug("Created %d events in bucket '%s'", count, bucket_id)
+        return count
+
+    @check_bucket_exists
+    @flush_heartbeats_first
     def get_eventcount(
         self,
         bucket_id: str,
@@ -242,13 +898,24 @@ class ServerAPI:
         end: Optional[datetime] = None,
     ) -> int:
         """Get eventcount from a bucket"""
-        logger.debug(f"Received get request for eventcount in bucket '{bucket_id}'")
+        logger.debug("Received get request for eventcount in bucket '%s'", bucket_id)
         return self.db[bucket_id].get_eventcount(start, end)
 
     @check_bucket_exists
+    @flush_heartbeats_first
     def delete_event(self, bucket_id: str, event_id) -> bool:
         """Delete a single event from a bucket"""
-        return self.db[bucket_id].delete(event_id)
+        event = self.db[bucket_id].get_by_id(event_id)
+        if event is None:
+            return False
+        deleted = self.db[bucket_id].delete(event_id)
+        self._bucket_changed(
+            bucket_id, event.timestamp, notifications.EVENT_DELETED, event
+        )
+        # The deleted event might have been the last one, let it be refetched when needed
+        self.last_event.pop(bucket_id, None)
+        self.last_event_span.pop(bucket_id, None)
+        return deleted
 
     @check_bucket_exists
     def heartbeat(self, bucket_id: str, heartbeat: Event, pulsetime: float) -> Event:
@@ -273,80 +940,331 @@ class ServerAPI:
 
         Inspired by: https://wakatime.com/developers#heartbeats
         """
+        with self._locked_bucket(bucket_id):
+            return self._heartbeat(bucket_id, heartbeat, pulsetime)
+
+    @check_bucket_exists
+    def heartbeats(
+        self, bucket_id: str, heartbeats: List[Event], pulsetime: float
+    ) -> Optional[Event]:
+        """
+        Processes a list of heartbeats in order, as if they had been sent one by one.
+
+        Useful for watchers replaying heartbeats queued while the server was unreachable.
+        The heartbeats are merged in memory and the resulting events written in a single transaction.
+
+        Returns the last (possibly merged) event, or None if no heartbeats were given.
+        """
         logger.debug(
-            "Received heartbeat in bucket '{}'\n\ttimestamp: {}, duration: {}, pulsetime: {}\n\tdata: {}".format(
-                bucket_id,
-                heartbeat.timestamp,
-                heartbeat.duration,
-                pulsetime,
-                heartbeat.data,
+            "Received %d heartbeats in bucket '%s', pulsetime: %s",
+            len(heartbeats),
+            bucket_id,
+            pulsetime,
+        )
+        if not heartbeats:
+            return None
+
+        with self._locked_bucket(bucket_id):
+            self.flush_heartbeats(bucket_id)
+            last_event = self._get_last_event(bucket_id)
+            last_end = _event_end(last_event) if last_event else None
+            # Heartbeats older than the last event are inserted as new events
+            since = min(h.timestamp for h in heartbeats)
+            if last_end:
+                since = min(since, last_end)
+            # The last existing event, if heartbeats were merged into it
+            merged_last = None  # type: Optional[Event]
+            new_events = []  # type: List[Event]
+            for heartbeat in heartbeats:
+                merged = self._merge_heartbeat(
+                    bucket_id, last_event, heartbeat, pulsetime
+                )
+                if merged is None:
+                    new_events.append(heartbeat)
+                    last_event = heartbeat
+                else:
+                    if new_events:
+                        new_events[-1] = merged
+                    else:
+                        merged_last = merged
+                    last_event = merged
+
+            with self._transaction():
+                if merged_last is not None:
+                    self.db[bucket_id].replace_last(merged_last)
+                if new_events:
+                    self.db[bucket_id].insert(new_events)
+            if new_events:
+                self._bucket_changed(bucket_id, since, notifications.EVENT_CREATED)
+            else:
+                # All heartbeats were merged into the last event, extending it from last_end
+                self._bucket_changed(
+                    bucket_id, last_end, notifications.EVENT_MERGED, last_event
+                )
+
+            # Set by the loop, as there was at least one heartbeat
+            assert last_event is not None
+            self.last_event[bucket_id] = last_event
+            self._update_last_event_span(bucket_id, last_event)
+            return last_event
+
+    @check_bucket_exists
+    def heartbeat_stream(
+        self, bucket_id: str, stream: IO[bytes], pulsetime: float
+    ) -> int:
+        """
+        Processes heartbeats sent as newline-delimited JSON over a stream
+        (such as a long-running request with a chunked body), each as soon as it arrives.
+
+        Lets a watcher keep a single request open instead of making one per heartbeat.
+
+        Returns the number of heartbeats processed once the stream ends.
+        """
+        if not self.stream_request_bodies:
+            raise NotSupported(
+                "StreamingUnsupported",
+                "Heartbeat streams aren't supported by this server, send heartbeats one by one",
             )
+        logger.debug("Heartbeat stream opened for bucket '%s'", bucket_id)
+        count = 0
+        with self._stream_slot():
+            for lineno, line in enumerate(iter(stream.readline, b""), start=1):
+                if not line.strip():
+                    continue
+                try:
+                    heartbeat = Event(**json.loads(line))
+                except (ValueError, TypeError) as e:
+                    raise BadRequest(
+                        "InvalidHeartbeat",
+                        f"Invalid heartbeat on line {lineno} ({count} heartbeats processed): {e}",
+                    )
+                self.heartbeat(bucket_id, heartbeat, pulsetime)
+                count += 1
+        logger.debug(
+            "Heartbeat stream closed for bucket '%s' after %d heartbeats",
+            bucket_id,
+            count,
         )
+        return count
 
-        # The endtime here is set such that in the event that the heartbeat is older than an
-        # existing event we should try to merge it with the last event before the heartbeat instead.
-        # FIXME: This (the endtime=heartbeat.timestamp) gets rid of the "heartbeat was older than last event"
-        #        warning and also causes a already existing "newer" event to be overwritten in the
-        #        replace_last call below. This is problematic.
-        # Solution: This could be solved if we were able to replace arbitrary events.
-        #           That way we could double check that the event has been applied
-        #           and if it hasn't we simply replace it with the updated counterpart.
+    def changes(
+        self,
+        bucket_ids: Optional[Set[str]] = None,
+        keepalive_interval: float = KEEPALIVE_INTERVAL,
+    ) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Notifications of changes to buckets (all buckets if no bucket IDs are given), as they happen.
 
-        last_event = None
-        if bucket_id not in self.last_event:
-            last_events = self.db[bucket_id].get(limit=1)
-            if len(last_events) > 0:
-                last_event = last_events[0]
-        else:
-            last_event = self.last_event[bucket_id]
+        Each notification has a type ("created", "merged" or "deleted" for events,
+        "bucket_created", "bucket_updated" or "bucket_deleted" for buckets, or "overflow"
+        if notifications were dropped since the client didn't keep up),
+        the ID of the bucket and the event concerned (if any).
+
+        None is yielded once subscribed to changes,
+        and then whenever no change happened within keepalive_interval seconds.
+        Subscribing raises ServiceUnavailable if max_streams streams are already open.
+        """
+        with self._stream_slot():
+            subscription = self.notifier.subscribe(bucket_ids)
+            try:
+                yield None
+                while not subscription.closed:
+                    yield subscription.get(timeout=keepalive_interval)
+            finally:
+                self.notifier.unsubscribe(subscription)
 
+    def _get_last_event(self, bucket_id: str) -> Optional[Event]:
+        if bucket_id in self.last_event:
+            return self.last_event[bucket_id]
+        last_events = self.db[bucket_id].get(limit=1)
+        return last_events[0] if last_events else None
+
+    def _merge_heartbeat(
+        self,
+        bucket_id: str,
+        last_event: Optional[Event],
+        heartbeat: Event,
+        pulsetime: float,
+    ) -> Optional[Event]:
+        """Returns the heartbeat merged into last_event, or None if it should be inserted as a new event"""
         if last_event:
             if last_event.data == heartbeat.data:
                 merged = heartbeat_merge(last_event, heartbeat, pulsetime)
                 if merged is not None:
+                    self.metrics.count_heartbeat(merged=True)
                     # Heartbeat was merged into last_event
                     logger.debug(
-                        "Received valid heartbeat, merging. (bucket: {})".format(
-                            bucket_id
-                        )
+                        "Received valid heartbeat, merging. (bucket: %s)", bucket_id
                     )
-                    self.last_event[bucket_id] = merged
-                    self.db[bucket_id].replace_last(merged)
                     return merged
                 else:
                     logger.info(
-                        "Received heartbeat after pulse window, inserting as new event. (bucket: {})".format(
-                            bucket_id
-                        )
+                        "Received heartbeat after pulse window, inserting as new event. (bucket: %s)",
+                        bucket_id,
                     )
             else:
                 logger.debug(
-                    "Received heartbeat with differing data, inserting as new event. (bucket: {})".format(
-                        bucket_id
-                    )
+                    "Received heartbeat with differing data, inserting as new event. (bucket: %s)",
+                    bucket_id,
                 )
         else:
             logger.info(
-                "Received heartbeat, but bucket was previously empty, inserting as new event. (bucket: {})".format(
-                    bucket_id
-                )
+                "Received heartbeat, but bucket was previously empty, inserting as new event. (bucket: %s)",
+                bucket_id,
             )
+        self.metrics.count_heartbeat(merged=False)
+        return None
 
+    def _heartbeat(self, bucket_id: str, heartbeat: Event, pulsetime: float) -> Event:
+        logger.debug(
+            "Received heartbeat in bucket '%s'\n\ttimestamp: %s, duration: %s, pulsetime: %s\n\tdata: %s",
+            bucket_id,
+            heartbeat.timestamp,
+            heartbeat.duration,
+            pulsetime,
+            heartbeat.data,
+        )
+
+        # The endtime here is set such that in the event that the heartbeat is older than an
+        # existing event we should try to merge it with the last event before the heartbeat instead.
+        # FIXME: This (the endtime=heartbeat.timestamp) gets rid of the "heartbeat was older than last event"
+        #        warning and also causes a already existing "newer" event to be overwritten in the
+        #        replace_last call below. This is problematic.
+        # Solution: This could be solved if we were able to replace arbitrary events.
+        #           That way we could double check that the event has been applied
+        #           and if it hasn't we simply replace it with the updated counterpart.
+
+        last_event = self._get_last_event(bucket_id)
+        last_end = _event_end(last_event) if last_event else None
+        merged = self._merge_heartbeat(bucket_id, last_event, heartbeat, pulsetime)
+        if merged is not None:
+            self._bucket_changed(
+                bucket_id, last_end, notifications.EVENT_MERGED, merged
+            )
+            self.last_event[bucket_id] = merged
+            if self.heartbeat_flush_interval > 0:
+                self.pending_heartbeats[bucket_id] = merged
+            else:
+                self.db[bucket_id].replace_last(merged)
+            self._update_last_event_span(bucket_id, merged)
+            return merged
+
+        # The last event has to be written before inserting a new one,
+        # since replace_last would otherwise replace the new event.
+        self.flush_heartbeats(bucket_id)
         self.db[bucket_id].insert(heartbeat)
+        self._bucket_changed(
+            bucket_id, heartbeat.timestamp, notifications.EVENT_CREATED, heartbeat
+        )
         self.last_event[bucket_id] = heartbeat
+        self._update_last_event_span(bucket_id, heartbeat)
         return heartbeat
 
     def query2(self, name, query, timeperiods, cache):
+        # Queries can read from any bucket
+        self.flush_heartbeats()
+        query = "".join(query)
+        use_cache = cache and self.query_cache is not None
+        periods = [_parse_timeperiod(timeperiod) for timeperiod in timeperiods]
+
+        result = [None] * len(periods)  # type: List[Any]
+        uncached = list(range(len(periods)))
+        if use_cache:
+            assert self.query_cache is not None
+            normalized_query = normalize_query(query)
+            keys = [
+                (name, normalized_query, f"{start.isoformat()}/{end.isoformat()}")
+                for start, end in periods
+            ]
+            for i, key in enumerate(keys):
+                result[i] = self.query_cache.get(key)
+            uncached = [i for i in uncached if result[i] is None]
+            # Generations are taken before running the query,
+            # so writes made while it runs invalidate the result.
+            generations = self.query_cache.snapshot()
+
+        if self.query_pool is not None and len(uncached) > 1:
+            results = self.query_pool.query(
+                self.db, name, query, [periods[i] for i in uncached]
+            )
+        else:
+            results = [
+                query2.query(name, query, periods[i][0], periods[i][1], self.db)
+                for i in uncached
+            ]
+
+        for i, r in zip(uncached, results):
+            result[i] = r
+            if use_cache:
+                assert self.query_cache is not None
+                self.query_cache.put(keys[i], r, periods[i][1], generations)
+        return result
+
+    def query2_profile(self, name, query, timeperiods) -> Dict[str, Any]:
+        """Evaluates a query like query2 (without using the cache or query workers),
+        returning the result along with the time spent in each statement for each timeperiod.
+        """
+        self.flush_heartbeats()
+        query = "".join(query)
         result = []
+        profile = []
         for timeperiod in timeperiods:
-            period = timeperiod.split("/")[
-                :2
-            ]  # iso8601 timeperiods are separated by a slash
-            starttime = iso8601.parse_date(period[0])
-            endtime = iso8601.parse_date(period[1])
-            query = "".join(query)
-            result.append(query2.query(name, query, starttime, endtime, self.db))
-        return result
+            start, end = _parse_timeperiod(timeperiod)
+            r, p = profile_query(name, query, start, end, self.db)
+            result.append(r)
+            profile.append(p)
+        return {"result": result, "profile": profile}
+
+    @check_bucket_exists
+    @flush_heartbeats_first
+    def summarize(
+        self,
+        bucket_id: str,
+        keys: List[str],
+        timeperiods: List[str],
+        categories: Optional[List[Any]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Summarizes the time spent per value of the given data keys (such as app and title) in each timeperiod.
+
+        Gives the same result as merge_events_by_keys followed by sort_by_duration
+        in a query (except that values without any time spent are left out),
+        but is answered from rollups of each past hour instead of from the events of the bucket. If categories (rules as used by categorize in queries)
+        are given, the time is instead summarized by category, matching the rules against
+        the values of the keys.
+        """
+        classes = None
+        if categories is not None:
+            try:
+                classes = [(category, Rule(rule)) for category, rule in categories]
+            except (ValueError, TypeError) as e:
+                raise BadRequest("InvalidCategories", f"Invalid category rules: {e}")
+
+        now = datetime.now(tz=timezone.utc)
+        results = []
+        for timeperiod in timeperiods:
+            start, end = _parse_timeperiod(timeperiod)
+            totals = self.rollups.summarize(
+                bucket_id,
+                keys,
+                start,
+                end,
+                now,
+                lambda s, e: self.db[bucket_id].get(-1, s, e),
+            )
+            events = rollups.to_events(totals, start)
+            if classes is not None:
+                events = sort_by_duration(
+                    merge_events_by_keys(categorize(events, classes), ["$category"])
+                )
+            results.append([e.to_json_dict() for e in events])
+        return results
+
+    def get_metrics(self) -> str:
+        """Returns the metrics of the server in the Prometheus text format"""
+        if self.query_cache is not None:
+            return self.metrics.render(self.query_cache.hits, self.query_cache.misses)
+        return self.metrics.render()
 
     # TODO: Right now the log format on disk has to be JSON, this is hard to read by humans...
     def get_log(self):
@@ -0,0 +1,456 @@
+"""
+HTTP server handling connections on an asyncio event loop.
+
+Watchers keep their connections open between heartbeats, with a thread per
+connection (like the development server) most threads just wait for the next
+request. Here connections are instead handled by the event loop, and only
+requests are run (through the WSGI app, with the same ServerAPI as any other
+server) on a small pool of threads.
+
+Request bodies are read from the connection as the app reads them, so large
+uploads (and streamed request bodies) aren't buffered in memory.
+
+Long-lived requests (such as server-sent events) are run on threads of their own,
+at most max_streams at once, so that they can't take all threads of the pool.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import unquote_to_bytes
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("flask")
+
+# Largest request line and headers accepted
+MAX_HEADER_SIZE = 64 * 1024
+
+# Seconds an idle connection is kept open waiting for another request
+KEEPALIVE_TIMEOUT = 120
+
+READ_SIZE = 64 * 1024
+
+
+class RequestBody:
+    """File-like object for the body of a request, read by the app from its thread"""
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        loop: asyncio.AbstractEventLoop,
+        content_length: Optional[int],
+    ) -> None:
+        """content_length is None for a chunked body"""
+        self._reader = reader
+        self._loop = loop
+        self._remaining = content_length
+        self._chunked = content_length is None
+        self._chunk_remaining = 0
+        self._done = content_length == 0
+        self._buffer = b""
+
+    async def read_async(self, size: int) -> bytes:
+        """Reads up to size bytes (at least one unless at the end of the body)"""
+        if self._done:
+            return b""
+        if not self._chunked:
+            assert self._remaining is not None
+            data = await self._reader.read(min(size, self._remaining))
+            if not data:
+                raise ConnectionError("Connection closed while reading request body")
+            self._remaining -= len(data)
+            self._done = self._remaining == 0
+            return data
+
+        if self._chunk_remaining == 0:
+            line = await self._reader.readline()
+            chunk_size = int(line.split(b";")[0].strip(), 16)
+            if chunk_size == 0:
+                # Skip trailers
+                while (await self._reader.readline()).strip():
+                    pass
+                self._done = True
+                return b""
+            self._chunk_remaining = chunk_size
+        data = await self._reader.read(min(size, self._chunk_remaining))
+        if not data:
+            raise ConnectionError("Connection closed while reading request body")
+        self._chunk_remaining -= len(data)
+        if self._chunk_remaining == 0:
+            await self._reader.readexactly(2)
+        return data
+
+    async def drain(self) -> None:
+        """Reads the rest of the body, so the next request can be read"""
+        while await self.read_async(READ_SIZE):
+            pass
+
+    def _read_chunk(self, size: int) -> bytes:
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        return asyncio.run_coroutine_threadsafe(
+            self.read_async(size), self._loop
+        ).result()
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is not None and size >= 0:
+            return self._read_chunk(size) if size else b""
+        chunks: List[bytes] = []
+        while True:
+            data = self._read_chunk(READ_SIZE)
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        limit = size if size is not None and size >= 0 else sys.maxsize
+        while b"\n" not in self._buffer and len(self._buffer) < limit:
+            data = asyncio.run_coroutine_threadsafe(
+                self.read_async(READ_SIZE), self._loop
+            ).result()
+            if not data:
+                break
+            self._buffer += data
+        end = min(self._buffer.find(b"\n") + 1 or len(self._buffer), limit)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+class Response:
+    """Writes the response of the app, from its thread, to the connection"""
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        loop: asyncio.AbstractEventLoop,
+        method: str,
+        version: str,
+        keep_alive: bool,
+    ) -> None:
+        self._writer = writer
+        self._loop = loop
+        self._method = method
+        self._version = version
+        self.keep_alive = keep_alive
+        self.status = ""
+        self.headers: List[Tuple[str, str]] = []
+        self.headers_sent = False
+        self._chunked = False
+        self._has_body = True
+
+    def start_response(
+        self, status: str, headers: List[Tuple[str, str]], exc_info=None
+    ) -> Callable[[bytes], None]:
+        if exc_info and self.headers_sent:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = status
+        self.headers = list(headers)
+        return self.write
+
+    def _send(self, data: bytes) -> None:
+        coro = self._send_async(data)
+        try:
+            future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        except RuntimeError:
+            # The server was stopped while a (long-lived) response was being written
+            coro.close()
+            raise ConnectionError("Server stopped")
+        future.result()
+
+    async def _send_async(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def _head(self) -> bytes:
+        code = int(self.status[:3])
+        names = {name.lower() for name, _ in self.headers}
+        self._has_body = self._method != "HEAD" and code not in (204, 304)
+        if self._has_body and "content-length" not in names:
+            if self._version == "HTTP/1.1":
+                self._chunked = True
+                self.headers.append(("Transfer-Encoding", "chunked"))
+            else:
+                # The end of the body can only be told by closing the connection
+                self.keep_alive = False
+        if "server" not in names:
+            self.headers.append(("Server", "aw-server"))
+        self.headers.append(
+            ("Connection", "keep-alive" if self.keep_alive else "close")
+        )
+        lines = [f"HTTP/1.1 {self.status}"]
+        lines += [f"{name}: {value}" for name, value in self.headers]
+        self.headers_sent = True
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def write(self, data: bytes) -> None:
+        out = b"" if self.headers_sent else self._head()
+        if data and self._has_body:
+            out += b"%x\r\n%s\r\n" % (len(data), data) if self._chunked else data
+        if out:
+            self._send(out)
+
+    def finish(self) -> None:
+        if not self.headers_sent:
+            self.write(b"")
+        if self._chunked:
+            self._send(b"0\r\n\r\n")
+
+
+def _parse_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+    """Parses the request line and headers, raises ValueError if invalid"""
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, version = lines[0].split(" ")
+    if not version.startswith("HTTP/1."):
+        raise ValueError(f"Unsupported HTTP version: {version}")
+    headers = {}  # type: Dict[str, str]
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, value = line.split(":", 1)
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return method, target, version, headers
+
+
+class AsyncWSGIServer:
+    def __init__(
+        self,
+        app: Callable,
+        host: str,
+        port: int,
+        threads: int,
+        is_stream: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        max_streams: int = 32,
+    ) -> None:
+        """is_stream tells if a request (given its environ) is long-lived"""
+        self.app = app
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="aw-server-request"
+        )
+        self.is_stream = is_stream
+        self.max_streams = max_streams
+        self.streams = 0
+        self.stream_executor = ThreadPoolExecutor(
+            max_workers=max_streams, thread_name_prefix="aw-server-stream"
+        )
+        self.started = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def run(self) -> None:
+        """Serves until stopped"""
+        asyncio.run(self._serve())
+
+    def stop(self) -> None:
+        """Stops the server, can be called from any thread"""
+        if self._loop is not None and self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=MAX_HEADER_SIZE
+        )
+        # The port is picked by the OS if it was given as 0
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        try:
+            async with server:
+                await self._stopping.wait()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.stream_executor.shutdown(wait=False)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT
+                    )
+                except asyncio.LimitOverrunError:
+                    await self._send_error(
+                        writer, "431 Request Header Fields Too Large"
+                    )
+                    return
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.TimeoutError,
+                    ConnectionError,
+                ):
+                    return
+                try:
+                    request = _parse_head(head)
+                except ValueError:
+                    await self._send_error(writer, "400 Bad Request")
+                    return
+                if not await self._handle_request(request, reader, writer, peer):
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _send_error(self, writer: asyncio.StreamWriter, status: str) -> None:
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+
+    async def _handle_request(
+        self,
+        request: Tuple[str, str, str, Dict[str, str]],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        peer: Tuple[Any, ...],
+    ) -> bool:
+        """Returns whether the connection should be kept open"""
+        assert self._loop is not None
+        method, target, version, headers = request
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        transfer_encoding = headers.get("transfer-encoding", "").lower()
+        length = headers.get("content-length", "0")
+        # Where a body with both headers ends is ambiguous (as used to smuggle requests),
+        # and int() would also accept signs, whitespace and underscores
+        if (transfer_encoding and "content-length" in headers) or not (
+            length.isascii() and length.isdigit()
+        ):
+            await self._send_error(writer, "400 Bad Request")
+            return False
+        content_length: Optional[int] = (
+            None if "chunked" in transfer_encoding else int(length)
+        )
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        body = RequestBody(reader, self._loop, content_length)
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            # The body reader knows where the body ends, even if chunked
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }  # type: Dict[str, Any]
+        for name, value in headers.items():
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name == "content-length":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+        if self.is_stream is not None and self.is_stream(environ):
+            if self.streams >= self.max_streams:
+                logger.warning(
+                    "Rejecting stream, %d streams are already open", self.streams
+                )
+                await self._send_error(writer, "503 Service Unavailable")
+                return False
+            self.streams += 1
+            executor = self.stream_executor
+        else:
+            executor = self.executor
+
+        response = Response(writer, self._loop, method, version, keep_alive)
+        try:
+            keep_alive = await self._loop.run_in_executor(
+                executor, self._call_app, environ, response
+            )
+        finally:
+            if executor is self.stream_executor:
+                self.streams -= 1
+        code = int(response.status[:3]) if response.status else 500
+        request_logger.log(
+            logging.DEBUG if code in [200, 304] else logging.INFO,
+            "%s (%s): %s %s %s",
+            code,
+            peer[0],
+            method,
+            target,
+            version,
+        )
+        if keep_alive:
+            try:
+                await body.drain()
+            except (ValueError, asyncio.IncompleteReadError):
+                return False
+        return keep_alive
+
+    def _call_app(self, environ: Dict[str, Any], response: Response) -> bool:
+        """Runs the app in a thread of the executor, returns whether to keep the connection open"""
+        try:
+            result: Iterable[bytes] = self.app(environ, response.start_response)
+            try:
+                for data in result:
+                    response.write(data)
+                response.finish()
+            finally:
+                if hasattr(result, "close"):
+                    result.close()  # type: ignore
+        except ConnectionError:
+            return False
+        except Exception:
+            logger.exception("Error while handling request")
+            if not response.headers_sent:
+                response.start_response("500 Internal Server Error", [])
+                response.keep_alive = False
+                try:
+                    response.finish()
+                except ConnectionError:
+                    pass
+            return False
+        return response.keep_alive
+
+
+def serve(
+    app: Callable,
+    host: str,
+    port: int,
+    threads: int,
+    is_stream: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    max_streams: int = 32,
+) -> None:
+    server = AsyncWSGIServer(app, host, port, threads, is_stream, max_streams)
+    logger.info(f"Serving on {host}:{port} with asyncio using {threads} threads")
+    server.run()
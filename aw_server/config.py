@@ -6,6 +6,31 @@ host = "localhost"
 port = "5600"
 storage = "peewee"
 cors_origins = ""
+# Seconds to hold back merged heartbeats before writing them (0 writes every heartbeat)
+heartbeat_flush_interval = 0
+# Maximum size of cached query results in megabytes (0 disables the cache)
+query_cache_size = 64
+# Number of worker processes evaluating the timeperiods of a query in parallel (1 disables)
+query_workers = 1
+# HTTP server to run: "werkzeug" (the development server), "waitress" (needs waitress installed)
+# or "asyncio" (handles connections on an event loop, for many concurrent watchers)
+server = "werkzeug"
+# Number of threads handling requests with the waitress and asyncio servers
+server_threads = 8
+# Profile requests, writing pstats files to the profiles directory in the data dir
+# (can also be toggled at runtime through /api/0/profiler)
+profile = false
+# Fraction of requests to profile
+profile_sample_rate = 1.0
+# Path prefixes of the requests to profile (as a comma separated list, all requests if empty)
+profile_routes = ""
+# Log every request as a line of JSON (can also be toggled at runtime through /api/0/trace)
+trace_requests = false
+# Write logs from a background thread in batches, so that slow disks don't slow down requests
+log_queue = false
+# Maximum number of log records queued for the background thread
+# (debug records are dropped when it's half full, other records when it's full)
+log_queue_size = 10000
 
 [server.custom_static]
 
@@ -14,6 +39,17 @@ host = "localhost"
 port = "5666"
 storage = "peewee"
 cors_origins = ""
+heartbeat_flush_interval = 0
+query_cache_size = 64
+query_workers = 1
+server = "werkzeug"
+server_threads = 8
+profile = false
+profile_sample_rate = 1.0
+profile_routes = ""
+trace_requests = false
+log_queue = false
+log_queue_size = 10000
 
 [server-testing.custom_static]
 """.strip()
@@ -17,3 +17,15 @@ class Unauthorized(werkzeug.exceptions.Unauthorized):
     def __init__(self, type: str, message: str) -> None:
         super().__init__(message)
         self.type = type
+
+
+class NotSupported(werkzeug.exceptions.NotImplemented):
+    def __init__(self, type: str, message: str) -> None:
+        super().__init__(message)
+        self.type = type
+
+
+class ServiceUnavailable(werkzeug.exceptions.ServiceUnavailable):
+    def __init__(self, type: str, message: str) -> None:
+        super().__init__(message)
+        self.type = type
@@ -0,0 +1,110 @@
+"""
+Incremental reading of large JSON documents (such as exports) from a stream.
+
+Objects and arrays can be iterated over one member at a time, so only the value
+currently being read has to be kept in memory.
+"""
+
+import codecs
+import json
+from typing import IO, Any, Iterator
+
+CHUNK_SIZE = 64 * 1024
+
+# Largest single value read with read_value, to not read an invalid document
+# (which can't be told apart from an incomplete value) into memory until its end.
+MAX_VALUE_SIZE = 64 * 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+class JSONStreamReader:
+    def __init__(self, stream: IO[bytes], chunk_size: int = CHUNK_SIZE) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self) -> bool:
+        """Reads another chunk into the buffer, returns False if at the end of the stream"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer = self.buffer[self.pos :] + self._decoder.decode(
+                b"", final=True
+            )
+        else:
+            self.buffer = self.buffer[self.pos :] + self._decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Returns the next non-whitespace character, without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read_more():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' in JSON stream, found '{found}'")
+        self.pos += 1
+
+    def read_value(self) -> Any:
+        """Reads a complete JSON value"""
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if len(self.buffer) - self.pos > MAX_VALUE_SIZE:
+                    raise
+                if not self._read_more():
+                    raise
+                continue
+            # A number at the end of the buffer might continue in the next chunk
+            if end == len(self.buffer) and self._read_more():
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self) -> Iterator[str]:
+        """Iterates over the keys of an object,
+        the caller has to read the value of each key before continuing."""
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("Expected string as object key in JSON stream")
+            self._expect(":")
+            yield key
+            if self._peek() == ",":
+                self.pos += 1
+            else:
+                self._expect("}")
+                return
+
+    def iter_array(self) -> Iterator[Any]:
+        """Iterates over the values in an array"""
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self._peek() == ",":
+                self.pos += 1
+            else:
+                self._expect("]")
+                return
@@ -1,7 +1,17 @@
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import List, Optional
 
+from flask import request
 from werkzeug import serving
 
+# Structured logs of every request, if tracing is turned on (see AWFlask.trace_requests)
+trace_logger = logging.getLogger("aw_server.trace")
+
 
 class FlaskLogHandler(serving.WSGIRequestHandler):
     def __init__(self, *args):
@@ -22,4 +32,155 @@ class FlaskLogHandler(serving.WSGIRequestHandler):
             levelno = logging.DEBUG
         else:
             raise Exception("Unknown level " + type)
-        self.logger.log(levelno, f"{code} ({self.address_string()}): {msg}")
+        self.logger.log(levelno, "%s (%s): %s", code, self.address_string(), msg)
+
+
+def trace_request(response, route: str, duration: float) -> None:
+    """Logs a request as a single line of JSON, for tracing what the server spends time on"""
+    if not trace_logger.isEnabledFor(logging.INFO):
+        return
+    record = {
+        "time": datetime.now(tz=timezone.utc).isoformat(),
+        "method": request.method,
+        "path": request.path,
+        "route": route,
+        "args": request.view_args or {},
+        "status": response.status_code,
+        "duration_ms": round(1000 * duration, 3),
+        "request_bytes": request.content_length,
+        "response_bytes": response.content_length,
+        "remote_addr": request.remote_addr,
+    }
+    trace_logger.info(json.dumps(record, default=str))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands log records to a bounded queue, to be written by a QueuedLogWriter.
+
+    If the queue fills up (the writer can't keep up), debug records are dropped
+    once the queue is half full, and other records once it's full.
+
+    Records are put on the queue as-is, so their messages are formatted by the writer
+    thread (the queue is in-process, so nothing has to be pickled)."""
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.log_queue = log_queue
+        self.debug_limit = log_queue.maxsize // 2
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if (
+            record.levelno <= logging.DEBUG
+            and self.log_queue.qsize() >= self.debug_limit
+        ):
+            self.dropped += 1
+            return
+        try:
+            self.log_queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueuedLogWriter:
+    """Writes the log records of a queue to handlers from a background thread.
+
+    Records are written in batches of whatever has been queued since the last batch,
+    with streams (such as log files) flushed once per batch instead of once per record.
+    """
+
+    def __init__(
+        self,
+        log_queue: queue.Queue,
+        handlers: List[logging.Handler],
+        queue_handler: Optional[DroppingQueueHandler] = None,
+        batch_size: int = 1000,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """logger is the logger the handlers were taken from, if any,
+        which they are handed back to when stopped."""
+        self.queue = log_queue
+        self.handlers = handlers
+        self.queue_handler = queue_handler
+        self.logger = logger
+        self.batch_size = batch_size
+        self._reported_dropped = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Writes the records still queued and stops the writer thread"""
+        if self._thread is None:
+            return
+        if self.logger is not None:
+            self.logger.handlers = self.handlers
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write([r for r in batch if r is not None])
+            if stop:
+                return
+
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        dropped = self.queue_handler.dropped if self.queue_handler else 0
+        if dropped > self._reported_dropped:
+            records.append(
+                logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": "Dropped %d log records since the log queue was full",
+                        "args": (dropped - self._reported_dropped,),
+                    }
+                )
+            )
+            self._reported_dropped = dropped
+        for handler in self.handlers:
+            # Handlers flush after every record, which is what makes writing logs slow,
+            # so flushing is skipped while the batch is handled and done once after it
+            handler.flush = _no_flush  # type: ignore[method-assign]
+            try:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                del handler.flush
+            handler.flush()
+
+
+def _no_flush() -> None:
+    pass
+
+
+def start_queued_logging(max_queued: int) -> QueuedLogWriter:
+    """Moves the handlers of the root logger to a background thread,
+    so that writing logs (to slow disks or terminals) doesn't block requests.
+
+    At most max_queued records are held in memory if writing falls behind."""
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    log_queue: queue.Queue = queue.Queue(maxsize=max_queued)
+    queue_handler = DroppingQueueHandler(log_queue)
+    writer = QueuedLogWriter(log_queue, handlers, queue_handler, logger=root_logger)
+    writer.start()
+    root_logger.handlers = [queue_handler]
+    return writer
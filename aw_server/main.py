@@ -1,4 +1,6 @@
 import logging
+import multiprocessing
+import signal
 import sys
 
 from aw_core.log import setup_logging
@@ -6,13 +8,16 @@ from aw_datastore import get_storage_methods
 
 from . import __version__
 from .config import config
-from .server import _start
+from .log import start_queued_logging
+from .server import SERVERS, _start
 
 logger = logging.getLogger(__name__)
 
 
 def main():
     """Called from the executable and __main__.py"""
+    # Needed for query worker processes in PyInstaller builds
+    multiprocessing.freeze_support()
 
     settings, storage_method = parse_settings()
 
@@ -29,6 +34,9 @@ def main():
         log_stderr=True,
         log_file=True,
     )
+    log_writer = (
+        start_queued_logging(settings.log_queue_size) if settings.log_queue else None
+    )
 
     logger.info(f"Using storage method: {settings.storage}")
 
@@ -39,14 +47,40 @@ def main():
         logger.info(f"Using custom_static: {settings.custom_static}")
 
     logger.info("Starting up...")
-    _start(
-        host=settings.host,
-        port=settings.port,
-        testing=settings.testing,
-        storage_method=storage_method,
-        cors_origins=settings.cors_origins,
-        custom_static=settings.custom_static,
-    )
+    _exit_on_sigterm()
+    try:
+        _start(
+            host=settings.host,
+            port=settings.port,
+            testing=settings.testing,
+            storage_method=storage_method,
+            cors_origins=settings.cors_origins,
+            custom_static=settings.custom_static,
+            heartbeat_flush_interval=settings.heartbeat_flush_interval,
+            query_cache_size=settings.query_cache_size,
+            query_workers=settings.query_workers,
+            server=settings.server,
+            server_threads=settings.server_threads,
+            profile=settings.profile,
+            profile_sample_rate=settings.profile_sample_rate,
+            profile_routes=settings.profile_routes,
+            trace_requests=settings.trace_requests,
+        )
+    finally:
+        if log_writer is not None:
+            log_writer.stop()
+
+
+def _exit_on_sigterm():
+    """Turns SIGTERM (as sent by aw-qt and service managers to stop the server)
+    into SystemExit, so that the server is shut down the same way as on Ctrl+C
+    and pending heartbeats are written."""
+
+    def handler(signum, frame):
+        logger.info("Received SIGTERM, shutting down...")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handler)
 
 
 def parse_settings():
@@ -89,6 +123,42 @@ def parse_settings():
         dest="custom_static",
         help="The custom static directories. Format: watcher_name=path,watcher_name2=path2,...",
     )
+    parser.add_argument(
+        "--server",
+        dest="server",
+        choices=SERVERS,
+        help="The HTTP server to run, waitress is faster under load but needs the waitress extra installed, asyncio handles many concurrent connections with few threads",
+    )
+    parser.add_argument(
+        "--server-threads",
+        dest="server_threads",
+        type=int,
+        help="Number of threads handling requests (only used by the waitress and asyncio servers)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="Profile requests, writing pstats files to the profiles directory in the data dir",
+    )
+    parser.add_argument(
+        "--profile-sample-rate",
+        dest="profile_sample_rate",
+        type=float,
+        help="Fraction of requests to profile (between 0 and 1)",
+    )
+    parser.add_argument(
+        "--profile-routes",
+        dest="profile_routes",
+        help="Path prefixes of the requests to profile (as a comma separated list)",
+    )
+    parser.add_argument(
+        "--trace-requests",
+        dest="trace_requests",
+        action="store_true",
+        default=None,
+        help="Log every request as a line of JSON",
+    )
     args = parser.parse_args()
     if args.version:
         print(__version__)
@@ -102,6 +172,21 @@ def parse_settings():
     settings.storage = config[configsection]["storage"]
     settings.cors_origins = config[configsection]["cors_origins"]
     settings.custom_static = dict(config[configsection]["custom_static"])
+    settings.heartbeat_flush_interval = float(
+        config[configsection]["heartbeat_flush_interval"]
+    )
+    settings.query_cache_size = int(
+        float(config[configsection]["query_cache_size"]) * 1024 * 1024
+    )
+    settings.query_workers = int(config[configsection]["query_workers"])
+    settings.server = config[configsection]["server"]
+    settings.server_threads = int(config[configsection]["server_threads"])
+    settings.profile = bool(config[configsection]["profile"])
+    settings.profile_sample_rate = float(config[configsection]["profile_sample_rate"])
+    settings.profile_routes = config[configsection]["profile_routes"]
+    settings.trace_requests = bool(config[configsection]["trace_requests"])
+    settings.log_queue = bool(config[configsection]["log_queue"])
+    settings.log_queue_size = int(config[configsection]["log_queue_size"])
 
     """ If a argument is not none, override the config value """
     for key, value in vars(args).items():
@@ -112,6 +197,10 @@ def parse_settings():
                 vars(settings)[key] = value
 
     settings.cors_origins = [o for o in settings.cors_origins.split(",") if o]
+    settings.profile_routes = [r for r in settings.profile_routes.split(",") if r]
+
+    if settings.server not in SERVERS:
+        raise ValueError(f"Unknown server: {settings.server}")
 
     storage_methods = get_storage_methods()
     storage_method = storage_methods[settings.storage]
@@ -0,0 +1,191 @@
+"""
+In-process metrics of the server, served in the Prometheus text format at /api/0/metrics.
+
+Kept as plain counters and fixed-bucket histograms updated under a lock,
+so recording a measurement is a few additions (no labels are created per request
+other than per route, method and status code).
+"""
+
+import bisect
+import inspect
+import threading
+from time import perf_counter
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # Counts per bucket (not cumulative), the last for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _lines(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for le, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        braced = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{braced} {self.sum}")
+        lines.append(f"{name}_count{braced} {self.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # Requests by (method, route, status code)
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        # Request latency by (method, route)
+        self.request_latency: Dict[Tuple[str, str], Histogram] = {}
+        # Heartbeats merged into the last event or inserted as new events
+        self.heartbeats = {"merged": 0, "inserted": 0}
+        self.heartbeat_lock_wait = Histogram()
+        # Duration of calls to the storage method, by method name
+        self.datastore_calls: Dict[str, Histogram] = {}
+
+    def observe_request(
+        self, method: str, route: str, status: int, seconds: float
+    ) -> None:
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.request_latency.get((method, route))
+            if histogram is None:
+                histogram = self.request_latency[(method, route)] = Histogram()
+            histogram.observe(seconds)
+
+    def count_heartbeat(self, merged: bool) -> None:
+        with self.lock:
+            self.heartbeats["merged" if merged else "inserted"] += 1
+
+    def observe_heartbeat_lock_wait(self, seconds: float) -> None:
+        with self.lock:
+            self.heartbeat_lock_wait.observe(seconds)
+
+    def observe_datastore_call(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.datastore_calls.get(name)
+            if histogram is None:
+                histogram = self.datastore_calls[name] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self, cache_hits: Optional[int] = None, cache_misses: int = 0) -> str:
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            lines.append("# HELP aw_requests_total Requests handled, by route")
+            lines.append("# TYPE aw_requests_total counter")
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'aw_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {count}'
+                )
+
+            lines.append("# HELP aw_request_duration_seconds Request latency, by route")
+            lines.append("# TYPE aw_request_duration_seconds histogram")
+            for (method, route), histogram in sorted(self.request_latency.items()):
+                lines += histogram._lines(
+                    "aw_request_duration_seconds",
+                    f'method="{method}",route="{_escape(route)}"',
+                )
+
+            lines.append(
+                "# HELP aw_heartbeats_total Heartbeats merged into the last event or inserted as a new event"
+            )
+            lines.append("# TYPE aw_heartbeats_total counter")
+            for result, count in self.heartbeats.items():
+                lines.append(f'aw_heartbeats_total{{result="{result}"}} {count}')
+
+            lines.append(
+                "# HELP aw_heartbeat_lock_wait_seconds Time spent waiting for the heartbeat lock of a bucket"
+            )
+            lines.append("# TYPE aw_heartbeat_lock_wait_seconds histogram")
+            lines += self.heartbeat_lock_wait._lines(
+                "aw_heartbeat_lock_wait_seconds", ""
+            )
+
+            lines.append(
+                "# HELP aw_datastore_call_duration_seconds Duration of calls to the storage method"
+            )
+            lines.append("# TYPE aw_datastore_call_duration_seconds histogram")
+            for name, histogram in sorted(self.datastore_calls.items()):
+                lines += histogram._lines(
+                    "aw_datastore_call_duration_seconds", f'call="{name}"'
+                )
+
+        if cache_hits is not None:
+            lines.append(
+                "# HELP aw_query_cache_requests_total Lookups in the query cache"
+            )
+            lines.append("# TYPE aw_query_cache_requests_total counter")
+            lines.append(f'aw_query_cache_requests_total{{result="hit"}} {cache_hits}')
+            lines.append(
+                f'aw_query_cache_requests_total{{result="miss"}} {cache_misses}'
+            )
+        return "\n".join(lines) + "\n"
+
+
+class TimedStorage:
+    """Wraps a storage method (such as PeeweeStorage), timing every method called on it.
+
+    Other attributes (such as the peewee database of PeeweeStorage, which is callable)
+    are passed through unchanged."""
+
+    def __init__(self, storage, metrics: Metrics) -> None:
+        self.storage = storage
+        self.metrics = metrics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.storage, name)
+        if not inspect.ismethod(attr) or name.startswith("_"):
+            return attr
+        observe = self.metrics.observe_datastore_call
+
+        def timed(*args, **kwargs):
+            t_start = perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                observe(name, perf_counter() - t_start)
+
+        # Cached, so the wrapper is only created on the first call
+        setattr(self, name, timed)
+        return timed
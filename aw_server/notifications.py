@@ -0,0 +1,115 @@
+"""
+Notifications of changes to buckets, for clients (like the web UI) to refresh
+when something changed instead of polling.
+
+Every subscriber has a bounded queue of notifications. If a subscriber doesn't
+keep up and its queue fills up, the queued notifications are replaced by a single
+"overflow" notification, after which the subscriber should refresh everything.
+"""
+
+import logging
+import queue
+import threading
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+from aw_core.models import Event
+
+logger = logging.getLogger(__name__)
+
+# Notifications queued per subscriber before it's considered to have fallen behind
+MAX_QUEUED = 1000
+
+# Types of change notifications
+BUCKET_CREATED = "bucket_created"
+BUCKET_UPDATED = "bucket_updated"
+BUCKET_DELETED = "bucket_deleted"
+EVENT_CREATED = "created"
+EVENT_MERGED = "merged"
+EVENT_DELETED = "deleted"
+OVERFLOW = "overflow"
+
+
+class Subscription:
+    def __init__(self, bucket_ids: Optional[Set[str]], max_queued: int) -> None:
+        """bucket_ids are the buckets to be notified of changes to, None for all buckets"""
+        self.bucket_ids = bucket_ids
+        self._queue = queue.Queue(maxsize=max_queued)  # type: queue.Queue
+        self._overflowed = False
+        self.closed = False
+
+    def _put(self, notification: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(notification)
+        except queue.Full:
+            self._overflowed = True
+
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Returns the next notification, or None if there was none within the timeout
+        (or the subscription has been closed)."""
+        if self._overflowed:
+            self._overflowed = False
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return {"type": OVERFLOW}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeNotifier:
+    def __init__(self, max_queued: int = MAX_QUEUED) -> None:
+        self.max_queued = max_queued
+        self.subscriptions: List[Subscription] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, bucket_ids: Optional[Set[str]] = None) -> Subscription:
+        subscription = Subscription(bucket_ids, self.max_queued)
+        with self._lock:
+            self.subscriptions.append(subscription)
+        logger.debug("New change subscription for buckets: %s", bucket_ids or "all")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(
+        self, bucket_id: str, change: str, event: Optional[Event] = None
+    ) -> None:
+        if not self.subscriptions:
+            return
+        with self._lock:
+            subscriptions = [
+                s
+                for s in self.subscriptions
+                if s.bucket_ids is None or bucket_id in s.bucket_ids
+            ]
+        if not subscriptions:
+            return
+        notification = {
+            "type": change,
+            "bucket": bucket_id,
+            "event": event.to_json_dict() if event is not None else None,
+        }
+        for s in subscriptions:
+            s._put(notification)
+
+    def close(self) -> None:
+        """Closes all subscriptions, such as when shutting down"""
+        with self._lock:
+            subscriptions, self.subscriptions = self.subscriptions, []
+        for s in subscriptions:
+            s.closed = True
+            # Wakes up the subscriber if it's waiting for a notification
+            try:
+                s._queue.put_nowait(None)
+            except queue.Full:
+                pass
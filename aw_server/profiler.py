@@ -0,0 +1,133 @@
+"""
+Profiling of requests to a running server, which can be turned on with --profile
+(or the profile setting in the config) and toggled at runtime through /api/0/profiler.
+
+Profiled requests are written as pstats files to the profiles directory in the
+data dir, named after the method, path, time taken and time of the request.
+They can be inspected with `python -m pstats <file>` or tools like snakeviz.
+"""
+
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.dirs import get_data_dir
+
+logger = logging.getLogger(__name__)
+
+
+def get_profile_dir() -> str:
+    return os.path.join(get_data_dir("aw-server"), "profiles")
+
+
+class SamplingProfilerMiddleware:
+    """Profiles a sample of the requests to a WSGI app, optionally only those to some routes.
+
+    Requests are profiled one at a time (as cProfile only profiles the thread it runs in
+    and can't always be run concurrently), requests arriving while another is profiled
+    are served without profiling.
+
+    Like werkzeug's ProfilerMiddleware the body of a profiled response is collected
+    while profiling, but only if the response has a Content-Length (and thus is already
+    in memory). Streamed responses (such as exports, which would have to be collected
+    in memory, and server-sent events, which are only finished when the client
+    disconnects) are passed on as they are, without writing a profile."""
+
+    def __init__(self, app, profile_dir: Optional[str] = None) -> None:
+        self.app = app
+        self.profile_dir = profile_dir or get_profile_dir()
+        self.enabled = False
+        self.sample_rate = 1.0
+        # Path prefixes of the requests to profile, all requests if empty
+        self.routes = []  # type: List[str]
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        enabled: bool,
+        sample_rate: float = 1.0,
+        routes: Optional[List[str]] = None,
+    ) -> None:
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate has to be between 0 and 1")
+        if enabled:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        self.sample_rate = sample_rate
+        self.routes = list(routes or [])
+        self.enabled = enabled
+        logger.info(
+            "Profiling %s (sample rate: %s, routes: %s, writing to: %s)",
+            "enabled" if enabled else "disabled",
+            sample_rate,
+            self.routes or "all",
+            self.profile_dir,
+        )
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "routes": self.routes,
+            "profile_dir": self.profile_dir,
+        }
+
+    def _should_profile(self, environ) -> bool:
+        if self.routes and not any(
+            environ.get("PATH_INFO", "").startswith(r) for r in self.routes
+        ):
+            return False
+        if "text/event-stream" in environ.get("HTTP_ACCEPT", ""):
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.enabled or not self._should_profile(environ):
+            return self.app(environ, start_response)
+        if not self._lock.acquire(blocking=False):
+            return self.app(environ, start_response)
+        try:
+            return self._profile(environ, start_response)
+        finally:
+            self._lock.release()
+
+    def _profile(self, environ, start_response):
+        headers: List[Tuple[str, str]] = []
+
+        def catching_start_response(status, response_headers, exc_info=None):
+            headers[:] = response_headers
+            return start_response(status, response_headers, exc_info)
+
+        profile = cProfile.Profile()
+        t_start = time.time()
+        app_iter = profile.runcall(self.app, environ, catching_start_response)
+        if not any(name.lower() == "content-length" for name, _ in headers):
+            return app_iter
+
+        def collect() -> bytes:
+            try:
+                return b"".join(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        body = profile.runcall(collect)
+        elapsed = time.time() - t_start
+        # Named the same way as by werkzeug's ProfilerMiddleware
+        filename = "{method}.{path}.{elapsed:.0f}ms.{time:.0f}.prof".format(
+            method=environ["REQUEST_METHOD"],
+            path=environ["PATH_INFO"].strip("/").replace("/", ".") or "root",
+            elapsed=elapsed * 1000.0,
+            time=time.time(),
+        )
+        profile.dump_stats(os.path.join(self.profile_dir, filename))
+        return [body]
@@ -0,0 +1,177 @@
+"""
+Cache for query2 results.
+
+Results are cached per (query name, normalized query, timeperiod). Every write to
+a bucket removes the cached results with a timeperiod ending at or after the earliest
+point in time the write affected (found in an index of results sorted by endtime),
+which means results for timeperiods in the past survive the steady stream of
+heartbeats at the current time, however long ago they were cached.
+
+Since a write can happen while a query runs, every write also bumps the generation
+of the bucket, and results are only cached if no write since the generations were
+taken (before the query started) affected their timeperiod.
+"""
+
+import bisect
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+logger = logging.getLogger(__name__)
+
+# Number of writes remembered per bucket, if more writes than this happened while
+# a query ran its result isn't cached.
+MAX_CHANGES_PER_BUCKET = 1000
+
+# Bucket.get rounds the endtime up to the next millisecond, so a write starting
+# slightly after the end of a timeperiod can still affect its result.
+ENDTIME_MARGIN = timedelta(seconds=1)
+
+CacheKey = Tuple[str, str, str]
+
+
+def normalize_query(query: str) -> str:
+    """Strips whitespace around statements (ignoring semicolons in string literals),
+    the same way query2 does when splitting a query into statements."""
+    statements = []
+    current = ""
+    quote = None
+    prev_char = None
+    for char in query:
+        if char in "'\"" and prev_char != "\\" and quote in (None, char):
+            quote = None if quote else char
+            current += char
+        elif char == ";" and quote is None:
+            statements.append(current)
+            current = ""
+        else:
+            current += char
+        prev_char = char
+    statements.append(current)
+    return ";".join(s.strip() for s in statements if s.strip())
+
+
+class CacheEntry:
+    def __init__(self, result: Any, size: int, endtime: datetime) -> None:
+        self.result = result
+        self.size = size
+        self.endtime = endtime
+
+
+class QueryCache:
+    def __init__(self, max_size: int) -> None:
+        """max_size is the approximate maximum size of cached results in bytes"""
+        self.max_size = max_size
+        self.size = 0
+        self.entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        # (endtime, key) of every entry, sorted
+        self.endtimes: List[Tuple[datetime, CacheKey]] = []
+        self.generations: Dict[str, int] = {}
+        # (generation, earliest time affected by the write) for recent writes to each bucket,
+        # the time is None if unknown (such as when a bucket is created or deleted).
+        self.changes: Dict[str, Deque[Tuple[int, Optional[datetime]]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def bucket_changed(self, bucket_id: str, since: Optional[datetime]) -> None:
+        """Invalidates results depending on data in the bucket from ``since`` and onwards"""
+        with self.lock:
+            generation = self.generations.get(bucket_id, 0) + 1
+            self.generations[bucket_id] = generation
+            if bucket_id not in self.changes:
+                self.changes[bucket_id] = deque(maxlen=MAX_CHANGES_PER_BUCKET)
+            self.changes[bucket_id].append((generation, since))
+
+            if since is None:
+                self.entries.clear()
+                self.endtimes.clear()
+                self.size = 0
+                return
+            # Entries ending at or after since - ENDTIME_MARGIN are at the end of the index
+            i = bisect.bisect_left(self.endtimes, (since - ENDTIME_MARGIN,))
+            for _, key in self.endtimes[i:]:
+                self.size -= self.entries.pop(key).size
+            del self.endtimes[i:]
+
+    def snapshot(self) -> Dict[str, int]:
+        """Returns the current bucket generations, to be taken before running a query"""
+        with self.lock:
+            return dict(self.generations)
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.result
+
+    def put(
+        self,
+        key: CacheKey,
+        result: Any,
+        endtime: datetime,
+        generations: Dict[str, int],
+    ) -> None:
+        size = len(json.dumps(result, default=str))
+        if size > self.max_size:
+            return
+        with self.lock:
+            if not self._unchanged_since(generations, endtime):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = CacheEntry(result, size, endtime)
+            bisect.insort(self.endtimes, (endtime, key))
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.endtimes.clear()
+            self.size = 0
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        i = bisect.bisect_left(self.endtimes, (entry.endtime, key))
+        del self.endtimes[i]
+
+    def _unchanged_since(self, generations: Dict[str, int], endtime: datetime) -> bool:
+        """Checks that no write since the given generations affected data up to endtime"""
+        for bucket_id, generation in self.generations.items():
+            cached_generation = generations.get(bucket_id, 0)
+            if generation == cached_generation:
+                continue
+            changes = self._changes_since(bucket_id, cached_generation)
+            if changes is None:
+                return False
+            for since in changes:
+                if since is None or since <= endtime + ENDTIME_MARGIN:
+                    return False
+        return True
+
+    def _changes_since(
+        self, bucket_id: str, generation: int
+    ) -> Optional[List[Optional[datetime]]]:
+        """Returns the times affected by writes after the given generation,
+        or None if they are no longer known."""
+        changes = self.changes[bucket_id]
+        if changes[0][0] > generation + 1:
+            return None
+        return [since for g, since in changes if g > generation]
@@ -0,0 +1,268 @@
+"""
+Evaluates a query2 query over several timeperiods in parallel on a pool of worker processes.
+
+Query transforms are pure Python and CPU-bound, so they wouldn't run in parallel on threads.
+Worker processes can't use the datastore of the server though, so the events of the
+buckets a query reads are instead fetched once for the union of all timeperiods,
+and each worker is sent the part overlapping its timeperiod.
+
+Which buckets a query reads is found out by evaluating the first timeperiod in the
+server process. Should a worker read any other bucket (which would require the query
+to pick buckets differently depending on the timeperiod) that timeperiod is evaluated
+in the server process instead.
+"""
+
+import copy
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
+
+from aw_core.models import Event
+from aw_datastore import Datastore
+from aw_datastore.storages import AbstractStorage
+from aw_query import query2
+
+logger = logging.getLogger(__name__)
+
+Period = Tuple[datetime, datetime]
+
+# Bucket.get rounds timeperiods outwards to whole milliseconds,
+# so events sent to workers are selected with some margin.
+MARGIN = timedelta(seconds=1)
+
+
+class MissingBucketData(Exception):
+    """Raised in a worker when a query reads a bucket whose events weren't sent to it"""
+
+
+class SnapshotStorage(AbstractStorage):
+    """Read-only storage serving events fetched by the server process.
+
+    Events are filtered and trimmed to the requested range the same way as by PeeweeStorage
+    (except that it doesn't assume events to be shorter than 24h)."""
+
+    sid = "snapshot"
+
+    def __init__(
+        self,
+        testing: bool,
+        buckets: Dict[str, dict],
+        events: Dict[str, List[Event]],
+    ) -> None:
+        self.testing = testing
+        self._buckets = buckets
+        # Events of each bucket, sorted in descending order by timestamp
+        self._events = events
+
+    def buckets(self) -> Dict[str, dict]:
+        return self._buckets
+
+    def get_metadata(self, bucket_id: str) -> dict:
+        return self._buckets[bucket_id]
+
+    def _get_in_range(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+    ) -> List[Event]:
+        if bucket_id not in self._events:
+            raise MissingBucketData(bucket_id)
+        return [
+            e
+            for e in self._events[bucket_id]
+            if (not starttime or starttime <= e.timestamp + e.duration)
+            and (not endtime or e.timestamp <= endtime)
+        ]
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        if limit == 0:
+            return []
+        events = self._get_in_range(bucket_id, starttime, endtime)
+        if limit > 0:
+            events = events[:limit]
+        # Copied since transforms are allowed to modify the events they're given
+        events = copy.deepcopy(events)
+        for e in events:
+            if starttime and e.timestamp < starttime:
+                e_end = e.timestamp + e.duration
+                e.timestamp = starttime
+                e.duration = e_end - e.timestamp
+            if endtime and e.timestamp + e.duration > endtime:
+                e.duration = endtime - e.timestamp
+        return events
+
+    def get_eventcount(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> int:
+        return len(self._get_in_range(bucket_id, starttime, endtime))
+
+    def create_bucket(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def update_bucket(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def delete_bucket(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def get_event(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage does not keep event IDs")
+
+    def insert_one(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def replace(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+    def replace_last(self, *args, **kwargs):
+        raise NotImplementedError("SnapshotStorage is read-only")
+
+
+class RecordingDatastore:
+    """Wraps a datastore, recording which buckets are read from it"""
+
+    def __init__(self, datastore: Datastore) -> None:
+        self.datastore = datastore
+        self.bucket_ids: Set[str] = set()
+
+    def __getitem__(self, bucket_id: str):
+        self.bucket_ids.add(bucket_id)
+        return self.datastore[bucket_id]
+
+    def buckets(self):
+        return self.datastore.buckets()
+
+
+def _query_period(
+    name: str,
+    query: str,
+    starttime: datetime,
+    endtime: datetime,
+    buckets: Dict[str, dict],
+    events: Dict[str, List[Event]],
+) -> Any:
+    """Runs in the worker processes"""
+    datastore = Datastore(SnapshotStorage, buckets=buckets, events=events)
+    return query2.query(name, query, starttime, endtime, datastore)
+
+
+class QueryPool:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process with a (multi-threaded) server running in it is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """Discards a broken executor (such as after a worker crashed),
+        so that a new one is started for the next query"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def query(
+        self, datastore: Datastore, name: str, query: str, periods: List[Period]
+    ) -> List[Any]:
+        """Evaluates the query for each period, returns the results in the same order"""
+        recording = RecordingDatastore(datastore)
+        first = query2.query(
+            name, query, periods[0][0], periods[0][1], cast(Datastore, recording)
+        )
+        if len(periods) == 1:
+            return [first]
+
+        rest = periods[1:]
+        union_start = min(start for start, _ in rest)
+        union_end = max(end for _, end in rest)
+        bucket_events = {
+            bucket_id: datastore[bucket_id].get(
+                starttime=union_start, endtime=union_end
+            )
+            for bucket_id in recording.bucket_ids
+        }
+        buckets = datastore.buckets()
+
+        executor = self._get_executor()
+        futures: List[Optional[Future]] = []
+        for start, end in rest:
+            events = {
+                bucket_id: [
+                    e
+                    for e in bucket_events[bucket_id]
+                    if start - MARGIN <= e.timestamp + e.duration
+                    and e.timestamp <= end + MARGIN
+                ]
+                for bucket_id in bucket_events
+            }
+            try:
+                futures.append(
+                    executor.submit(
+                        _query_period, name, query, start, end, buckets, events
+                    )
+                )
+            except BrokenProcessPool:
+                futures.append(None)
+
+        results = [first]
+        broken = False
+        for (start, end), future in zip(rest, futures):
+            try:
+                if future is None:
+                    raise BrokenProcessPool("Query pool was broken when submitting")
+                results.append(future.result())
+            except MissingBucketData as e:
+                logger.debug(
+                    "Query read bucket '%s' not read for the first timeperiod, running in server process",
+                    e,
+                )
+                results.append(query2.query(name, query, start, end, datastore))
+            except BrokenProcessPool:
+                broken = True
+                results.append(query2.query(name, query, start, end, datastore))
+        if broken:
+            logger.warning(
+                "A query worker process died, ran the query in the server process instead and restarting the workers"
+            )
+            self._discard_executor(executor)
+        return results
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -0,0 +1,116 @@
+"""
+Evaluation of query2 queries with timing of each statement, for finding out
+what makes a query slow (reading from the datastore or one of the transforms).
+
+Statements are evaluated the same way as by query2.query, but one at a time with
+the time spent in each measured, along with how long reading from the datastore took
+and the number of events going in and out of each statement.
+"""
+
+import re
+from datetime import datetime
+from time import perf_counter
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
+
+from aw_datastore import Datastore
+from aw_query import query2
+
+
+class ProfilingBucket:
+    def __init__(self, bucket, datastore: "ProfilingDatastore") -> None:
+        self.bucket = bucket
+        self.datastore = datastore
+
+    def get(self, *args, **kwargs):
+        t_start = perf_counter()
+        events = self.bucket.get(*args, **kwargs)
+        self.datastore.read_time += perf_counter() - t_start
+        self.datastore.read_events += len(events)
+        return events
+
+    def get_eventcount(self, *args, **kwargs):
+        t_start = perf_counter()
+        count = self.bucket.get_eventcount(*args, **kwargs)
+        self.datastore.read_time += perf_counter() - t_start
+        return count
+
+    def __getattr__(self, name: str):
+        return getattr(self.bucket, name)
+
+
+class ProfilingDatastore:
+    """Wraps a datastore, measuring the time spent reading events from it"""
+
+    def __init__(self, datastore: Datastore) -> None:
+        self.datastore = datastore
+        self.read_time = 0.0
+        self.read_events = 0
+
+    def __getitem__(self, bucket_id: str) -> ProfilingBucket:
+        return ProfilingBucket(self.datastore[bucket_id], self)
+
+    def buckets(self):
+        t_start = perf_counter()
+        buckets = self.datastore.buckets()
+        self.read_time += perf_counter() - t_start
+        return buckets
+
+
+def _count_events(value: Any) -> int:
+    return len(value) if isinstance(value, list) else 0
+
+
+def profile_query(
+    name: str, query: str, starttime: datetime, endtime: datetime, datastore: Datastore
+) -> Tuple[Any, Dict[str, Any]]:
+    """Evaluates a query like query2.query does, returns the result and the profile"""
+    profiling = ProfilingDatastore(datastore)
+    namespace = query2.create_namespace()
+    namespace["NAME"] = name
+    namespace["STARTTIME"] = starttime.isoformat()
+    namespace["ENDTIME"] = endtime.isoformat()
+
+    statements: List[Dict[str, Any]] = []
+    t_query = perf_counter()
+    for statement in query2._split_query_statements(query):
+        statement = statement.strip()
+        if not statement:
+            continue
+        # Events in are those of the variables the statement reads
+        expression = statement.split("=", 1)[-1]
+        events_in = sum(
+            _count_events(namespace[v])
+            for v in set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", expression))
+            if v in namespace
+        )
+        read_time, read_events = profiling.read_time, profiling.read_events
+
+        t_start = perf_counter()
+        var, val = query2.parse(statement, namespace)
+        query2.interpret(var, val, namespace, profiling)
+        t_total = perf_counter() - t_start
+
+        statements.append(
+            {
+                "statement": statement,
+                "time": t_total,
+                "datastore_time": profiling.read_time - read_time,
+                "datastore_events": profiling.read_events - read_events,
+                "events_in": events_in,
+                "events_out": _count_events(namespace[var.name]),
+            }
+        )
+
+    result = query2.get_return(namespace)
+    profile = {
+        "timeperiod": f"{starttime.isoformat()}/{endtime.isoformat()}",
+        "time": perf_counter() - t_query,
+        "datastore_time": profiling.read_time,
+        "statements": statements,
+    }
+    return result, profile
@@ -1,7 +1,7 @@
-import json
+import itertools
 import traceback
 from functools import wraps
-from threading import Lock
+from time import perf_counter
 from typing import Dict
 
 import iso8601
@@ -10,15 +10,16 @@ from aw_core.models import Event
 from aw_query.exceptions import QueryException
 from flask import (
     Blueprint,
+    Response,
     current_app,
     jsonify,
-    make_response,
     request,
+    stream_with_context,
 )
 from flask_restx import Api, Resource, fields
 
-from . import logger
-from .api import ServerAPI
+from . import logger, metrics
+from .api import EVENTS_PAGE_SIZE, MAX_EVENTS_PAGE_SIZE, ServerAPI, _parse_event
 from .exceptions import BadRequest, Unauthorized
 
 
@@ -51,6 +52,16 @@ blueprint = Blueprint("api", __name__, url_prefix="/api")
 api = Api(blueprint, doc="/", decorators=[host_header_check])
 
 
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """Serializes responses with the JSON provider of the app (instead of the one
+    built into flask-restx), so that events and datetimes can be returned as-is."""
+    resp = current_app.json.response(data)
+    resp.status_code = code
+    resp.headers.extend(headers or {})
+    return resp
+
+
 # Loads event and bucket schema from JSONSchema in aw_core
 event = api.schema_model("Event", schema.get_json_schema("event"))
 bucket = api.schema_model("Bucket", schema.get_json_schema("bucket"))
@@ -195,6 +206,11 @@ class EventsResource(Resource):
     @api.param("limit", "the maximum number of requests to get")
     @api.param("start", "Start date of events")
     @api.param("end", "End date of events")
+    @api.param(
+        "page_size",
+        "Number of events per page, if given (or if cursor is) events are returned in pages",
+    )
+    @api.param("cursor", "The next cursor of the previous page")
     @copy_doc(ServerAPI.get_events)
     def get(self, bucket_id):
         args = request.args
@@ -202,31 +218,54 @@ class EventsResource(Resource):
         start = iso8601.parse_date(args["start"]) if "start" in args else None
         end = iso8601.parse_date(args["end"]) if "end" in args else None
 
+        if "page_size" in args or "cursor" in args:
+            try:
+                page_size = int(args.get("page_size", EVENTS_PAGE_SIZE))
+            except ValueError:
+                raise BadRequest("InvalidPageSize", "page_size must be an integer")
+            if not 0 < page_size <= MAX_EVENTS_PAGE_SIZE:
+                raise BadRequest(
+                    "InvalidPageSize",
+                    f"page_size must be between 1 and {MAX_EVENTS_PAGE_SIZE}",
+                )
+            page = current_app.api.get_events_page(
+                bucket_id,
+                page_size=page_size,
+                start=start,
+                end=end,
+                cursor=args.get("cursor"),
+                raw=True,
+            )
+            return page, 200
+
         events = current_app.api.get_events(
-            bucket_id, limit=limit, start=start, end=end
+            bucket_id, limit=limit, start=start, end=end, raw=True
         )
         return events, 200
 
     # TODO: How to tell expect that it could be a list of events? Until then we can't use validate.
     @api.expect(event)
-    @copy_doc(ServerAPI.create_events)
     def post(self, bucket_id):
-        data = request.get_json()
-        logger.debug(
-            "Received post request for event in bucket '{}' and data: {}".format(
-                bucket_id, data
-            )
-        )
+        """
+        Create one or more events in a bucket, given as an event, a list of events
+        or (with Content-Type: application/x-ndjson) newline-delimited JSON events.
+
+        Lists of events are validated before any is inserted, so either all or none are created.
+        Newline-delimited events are read and inserted in batches as they arrive, so large
+        backfills don't have to be held in memory, and the number of events created is returned.
+        """
+        if request.mimetype == "application/x-ndjson":
+            count = current_app.api.create_events_stream(bucket_id, request.stream)
+            return {"events": count}, 200
 
+        data = request.get_json()
         if isinstance(data, dict):
-            events = [Event(**data)]
-        elif isinstance(data, list):
-            events = [Event(**e) for e in data]
-        else:
+            data = [data]
+        elif not isinstance(data, list):
             raise BadRequest("Invalid POST data", "")
-
-        event = current_app.api.create_events(bucket_id, events)
-        return event.to_json_dict() if event else None, 200
+        logger.debug("Received %d events for bucket '%s'", len(data), bucket_id)
+        current_app.api.create_events_bulk(bucket_id, data)
+        return None, 200
 
 
 @api.route("/0/buckets/<string:bucket_id>/events/count")
@@ -250,7 +289,9 @@ class EventResource(Resource):
     @copy_doc(ServerAPI.get_event)
     def get(self, bucket_id: str, event_id: int):
         logger.debug(
-            f"Received get request for event with id '{event_id}' in bucket '{bucket_id}'"
+            "Received get request for event with id '%s' in bucket '%s'",
+            event_id,
+            bucket_id,
         )
         event = current_app.api.get_event(bucket_id, event_id)
         if event:
@@ -261,9 +302,9 @@ class EventResource(Resource):
     @copy_doc(ServerAPI.delete_event)
     def delete(self, bucket_id: str, event_id: int):
         logger.debug(
-            "Received delete request for event with id '{}' in bucket '{}'".format(
-                event_id, bucket_id
-            )
+            "Received delete request for event with id '%s' in bucket '%s'",
+            event_id,
+            bucket_id,
         )
         success = current_app.api.delete_event(bucket_id, event_id)
         return {"success": success}, 200
@@ -271,14 +312,6 @@ class EventResource(Resource):
 
 @api.route("/0/buckets/<string:bucket_id>/heartbeat")
 class HeartbeatResource(Resource):
-    # Class-level lock shared across all instances.
-    # Flask-RESTX creates a new Resource instance per request, so an
-    # instance-level lock would provide no mutual exclusion.
-    lock = Lock()
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
     @api.expect(event, validate=True)
     @api.param(
         "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
@@ -292,22 +325,118 @@ class HeartbeatResource(Resource):
         else:
             raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
 
-        # This lock is meant to ensure that only one heartbeat is processed at a time,
-        # as the heartbeat function is not thread-safe.
-        # This should maybe be moved into the api.py file instead (but would be very messy).
-        acquired = self.lock.acquire(timeout=10)
-        if not acquired:
-            logger.warning(
-                "Heartbeat lock could not be acquired within timeout, rejecting request."
-            )
-            return {"message": "Server busy, try again later"}, 503
-        try:
-            event = current_app.api.heartbeat(bucket_id, heartbeat, pulsetime)
-        finally:
-            self.lock.release()
+        event = current_app.api.heartbeat(bucket_id, heartbeat, pulsetime)
         return event.to_json_dict(), 200
 
 
+@api.route("/0/buckets/<string:bucket_id>/heartbeats")
+class HeartbeatsResource(Resource):
+    @api.expect([event])
+    @api.param(
+        "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
+    )
+    @copy_doc(ServerAPI.heartbeats)
+    def post(self, bucket_id):
+        data = request.get_json()
+        if not isinstance(data, list):
+            raise BadRequest("InvalidData", "Expected a list of heartbeats")
+        try:
+            heartbeats = [_parse_event(e) for e in data]
+        except (ValueError, TypeError) as e:
+            raise BadRequest("InvalidHeartbeat", f"Invalid heartbeat: {e}")
+
+        if "pulsetime" in request.args:
+            pulsetime = float(request.args["pulsetime"])
+        else:
+            raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
+
+        event = current_app.api.heartbeats(bucket_id, heartbeats, pulsetime)
+        return event.to_json_dict() if event else None, 200
+
+
+@api.route("/0/buckets/<string:bucket_id>/heartbeat/stream")
+class HeartbeatStreamResource(Resource):
+    @api.param(
+        "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
+    )
+    @copy_doc(ServerAPI.heartbeat_stream)
+    def post(self, bucket_id):
+        if "pulsetime" in request.args:
+            pulsetime = float(request.args["pulsetime"])
+        else:
+            raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
+
+        count = current_app.api.heartbeat_stream(bucket_id, request.stream, pulsetime)
+        return {"heartbeats": count}, 200
+
+
+# CHANGES
+
+
+@api.route("/0/changes")
+class ChangesResource(Resource):
+    @api.param(
+        "bucket",
+        "Bucket to be notified of changes to, can be given several times (all buckets if not given)",
+    )
+    @copy_doc(ServerAPI.changes)
+    def get(self):
+        bucket_ids = set(request.args.getlist("bucket")) or None
+        changes = current_app.api.changes(bucket_ids)
+        # Subscribes before responding, so that the request is rejected
+        # if too many streams are open
+        subscribed = next(changes)
+
+        def generate():
+            try:
+                for notification in itertools.chain([subscribed], changes):
+                    if notification is None:
+                        # Sent once subscribed and then periodically, to keep the connection
+                        # alive and to let the server notice when it has been closed
+                        yield ": keep-alive\n\n"
+                    else:
+                        data = current_app.json.dumps(notification)
+                        yield f"event: {notification['type']}\ndata: {data}\n\n"
+            finally:
+                changes.close()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+
+# SUMMARY
+
+summary = api.model(
+    "Summary",
+    {
+        "timeperiods": fields.List(
+            fields.String, required=True, description="List of periods to summarize"
+        ),
+        "keys": fields.List(
+            fields.String, required=True, description="Data keys to summarize by"
+        ),
+        "categories": fields.Raw(
+            required=False, description="Category rules to summarize by instead"
+        ),
+    },
+)
+
+
+@api.route("/0/buckets/<string:bucket_id>/summary")
+class SummaryResource(Resource):
+    @api.expect(summary, validate=True)
+    @copy_doc(ServerAPI.summarize)
+    def post(self, bucket_id):
+        data = request.get_json()
+        result = current_app.api.summarize(
+            bucket_id, data["keys"], data["timeperiods"], data.get("categories")
+        )
+        return result, 200
+
+
 # QUERY
 
 
@@ -315,15 +444,27 @@ class HeartbeatResource(Resource):
 class QueryResource(Resource):
     # TODO Docs
     @api.expect(query, validate=True)
-    @api.param("name", "Name of the query (required if using cache)")
+    @api.param("name", "Name of the query")
+    @api.param(
+        "profile",
+        "If =1, the result is returned along with the time spent in each statement",
+    )
     def post(self):
         name = ""
         if "name" in request.args:
             name = request.args["name"]
         query = request.get_json()
         try:
+            if request.args.get("profile") == "1":
+                profiled = current_app.api.query2_profile(
+                    name, query["query"], query["timeperiods"]
+                )
+                t_start = perf_counter()
+                current_app.json.dumps(profiled["result"])
+                profiled["encode_time"] = perf_counter() - t_start
+                return jsonify(profiled)
             result = current_app.api.query2(
-                name, query["query"], query["timeperiods"], False
+                name, query["query"], query["timeperiods"], True
             )
             return jsonify(result)
         except QueryException as qe:
@@ -334,14 +475,85 @@ class QueryResource(Resource):
 # EXPORT AND IMPORT
 
 
+@api.route("/0/metrics")
+class MetricsResource(Resource):
+    def get(self):
+        """
+        Metrics of the server in the Prometheus text format: requests and their latency by route,
+        heartbeats merged and inserted, heartbeat lock wait time, datastore call durations
+        and query cache hits and misses.
+        """
+        return Response(current_app.api.get_metrics(), mimetype=metrics.CONTENT_TYPE)
+
+
+profiler = api.model(
+    "Profiler",
+    {
+        "enabled": fields.Boolean(required=True),
+        "sample_rate": fields.Float(
+            required=False, description="Fraction of requests to profile (default 1)"
+        ),
+        "routes": fields.List(
+            fields.String,
+            required=False,
+            description="Path prefixes of the requests to profile (default all)",
+        ),
+    },
+)
+
+
+@api.route("/0/profiler")
+class ProfilerResource(Resource):
+    def get(self):
+        """Settings of the request profiler"""
+        return current_app.profiler.status(), 200
+
+    @api.expect(profiler, validate=True)
+    def post(self):
+        """
+        Turns profiling of requests on or off. Profiles are written as pstats files
+        to the profiles directory in the data dir.
+        """
+        data = request.get_json()
+        try:
+            current_app.profiler.configure(
+                data["enabled"], data.get("sample_rate", 1.0), data.get("routes")
+            )
+        except ValueError as e:
+            raise BadRequest("InvalidProfilerSettings", str(e))
+        return current_app.profiler.status(), 200
+
+
+trace = api.model("Trace", {"enabled": fields.Boolean(required=True)})
+
+
+@api.route("/0/trace")
+class TraceResource(Resource):
+    def get(self):
+        """If every request is logged as a line of JSON (to the aw_server.trace logger)"""
+        return {"enabled": current_app.trace_requests}, 200
+
+    @api.expect(trace, validate=True)
+    def post(self):
+        """Turns logging of every request as a line of JSON on or off"""
+        current_app.trace_requests = request.get_json()["enabled"]
+        logger.info(
+            "Request tracing %s",
+            "enabled" if current_app.trace_requests else "disabled",
+        )
+        return {"enabled": current_app.trace_requests}, 200
+
+
 @api.route("/0/export")
 class ExportAllResource(Resource):
     @api.doc(model=buckets_export)
     @copy_doc(ServerAPI.export_all)
     def get(self):
-        buckets_export = current_app.api.export_all()
-        payload = {"buckets": buckets_export}
-        response = make_response(json.dumps(payload))
+        # Streamed, since the export of a large database doesn't fit in memory
+        response = Response(
+            stream_with_context(current_app.api.export_all_stream()),
+            mimetype="application/json",
+        )
         filename = "aw-buckets-export.json"
         response.headers["Content-Disposition"] = "attachment; filename={}".format(
             filename
@@ -355,10 +567,11 @@ class BucketExportResource(Resource):
     @api.doc(model=buckets_export)
     @copy_doc(ServerAPI.export_bucket)
     def get(self, bucket_id):
-        bucket_export = current_app.api.export_bucket(bucket_id)
-        payload = {"buckets": {bucket_export["id"]: bucket_export}}
-        response = make_response(json.dumps(payload))
-        filename = "aw-bucket-export_{}.json".format(bucket_export["id"])
+        response = Response(
+            stream_with_context(current_app.api.export_bucket_stream(bucket_id)),
+            mimetype="application/json",
+        )
+        filename = f"aw-bucket-export_{bucket_id}.json"
         response.headers["Content-Disposition"] = "attachment; filename={}".format(
             filename
         )
@@ -370,19 +583,25 @@ class ImportAllResource(Resource):
     @api.expect(buckets_export)
     @copy_doc(ServerAPI.import_all)
     def post(self):
+        # Imports are parsed as they're read, since large ones don't fit in memory
         # If import comes from a form in th web-ui
         if len(request.files) > 0:
             # web-ui form only allows one file, but technically it's possible to
             # upload multiple files at the same time
             for filename, f in request.files.items():
-                buckets = json.loads(f.stream.read())["buckets"]
-                current_app.api.import_all(buckets)
+                self._import(f.stream)
         # Normal import from body
         else:
-            buckets = request.get_json()["buckets"]
-            current_app.api.import_all(buckets)
+            self._import(request.stream)
         return None, 200
 
+    def _import(self, stream):
+        try:
+            current_app.api.import_stream(stream)
+        except (ValueError, KeyError, TypeError) as e:
+            # Such as for truncated uploads, or buckets missing their metadata
+            raise BadRequest("InvalidJSON", f"Invalid import: {e}")
+
 
 # LOGGING
 
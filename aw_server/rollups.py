@@ -0,0 +1,277 @@
+"""
+Rollups of the duration of events, per bucket and hour, grouped by the values of data keys.
+
+Summaries over long timeperiods (such as the time spent per app each day for
+months back) are then the sum of the rollups of the hours within the period,
+instead of a scan over every event in it. Hours are used rather than days so that
+the rollups can be combined into days starting at any hour, in any timezone.
+
+Rollups for a set of keys are computed from the events of a bucket the first time
+a summary needs them. From then on they are kept up to date by every write to the bucket:
+created events are added, deleted events subtracted and merged heartbeats add the time
+the event was extended by. Writes which can't be applied incrementally (such as imports)
+drop the rollups for the hours they affect, which are recomputed when needed next.
+
+Only hours which have ended are rolled up, the rest of a period is summarized from its events.
+At most max_hours hours are kept rolled up, the rollups used least recently are dropped first.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.models import Event
+
+INTERVAL = timedelta(hours=1)
+
+# (key, value) for the data keys present in an event
+GroupKey = Tuple[Tuple[str, Any], ...]
+
+# Total duration in seconds for each group
+Totals = Dict[GroupKey, float]
+
+# Default maximum number of rolled up hours kept (over all buckets and sets of keys),
+# a bit more than a year of hours for each of ten summaries
+MAX_HOURS = 100_000
+
+# Totals smaller than this (left after subtracting deleted events) are dropped
+EPSILON = 1e-6
+
+
+def _floor(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil(dt: datetime) -> datetime:
+    floor = _floor(dt)
+    return floor if floor == dt else floor + INTERVAL
+
+
+def _hours(start: datetime, end: datetime) -> Iterator[datetime]:
+    hour = _floor(start)
+    while hour < end:
+        yield hour
+        hour += INTERVAL
+
+
+def group_key(data: Dict[str, Any], keys: Tuple[str, ...]) -> GroupKey:
+    """Groups events the same way as merge_events_by_keys (ignoring missing keys)"""
+    return tuple(
+        (key, tuple(data[key]) if isinstance(data[key], list) else data[key])
+        for key in keys
+        if key in data
+    )
+
+
+def _add(totals: Totals, key: GroupKey, seconds: float) -> None:
+    total = totals.get(key, 0) + seconds
+    if abs(total) < EPSILON:
+        totals.pop(key, None)
+    else:
+        totals[key] = total
+
+
+def _add_interval(
+    hours: Dict[datetime, Totals],
+    start: datetime,
+    end: datetime,
+    key: GroupKey,
+    sign: int = 1,
+) -> None:
+    """Adds the time between start and end to the rolled up hours it overlaps"""
+    for hour in _hours(start, end):
+        if hour not in hours:
+            continue
+        overlap = min(end, hour + INTERVAL) - max(start, hour)
+        if overlap > timedelta(0):
+            _add(hours[hour], key, sign * overlap.total_seconds())
+
+
+def _add_events(
+    totals: Totals,
+    events: List[Event],
+    keys: Tuple[str, ...],
+    start: datetime,
+    end: datetime,
+) -> None:
+    """Adds the part of each event between start and end to totals"""
+    for e in events:
+        overlap = min(end, e.timestamp + e.duration) - max(start, e.timestamp)
+        if overlap > timedelta(0):
+            _add(totals, group_key(e.data, keys), overlap.total_seconds())
+
+
+class Rollups:
+    def __init__(self, max_hours: int = MAX_HOURS) -> None:
+        # Rolled up hours of each bucket, for each set of keys
+        self.rollups: Dict[str, Dict[Tuple[str, ...], Dict[datetime, Totals]]] = {}
+        # Number of rolled up hours for each bucket and set of keys,
+        # ordered from least to most recently used
+        self.sizes: "OrderedDict[Tuple[str, Tuple[str, ...]], int]" = OrderedDict()
+        self.size = 0
+        self.max_hours = max_hours
+        # Bumped on every write to a bucket, so rollups computed while
+        # a bucket was written to are not stored.
+        self.generations: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def _changed(self, bucket_id: str) -> Dict[Tuple[str, ...], Dict[datetime, Totals]]:
+        self.generations[bucket_id] = self.generations.get(bucket_id, 0) + 1
+        return self.rollups.get(bucket_id, {})
+
+    def _evict(self) -> None:
+        """Drops the least recently used rollups until at most max_hours are kept"""
+        while self.size > self.max_hours:
+            (bucket_id, keys), hours = self.sizes.popitem(last=False)
+            by_keys = self.rollups[bucket_id]
+            del by_keys[keys]
+            if not by_keys:
+                del self.rollups[bucket_id]
+            self.size -= hours
+
+    def add(
+        self,
+        bucket_id: str,
+        start: datetime,
+        end: datetime,
+        data: Dict[str, Any],
+        sign: int = 1,
+    ) -> None:
+        """Adds (or with sign=-1 subtracts) the time between start and end
+        with the given event data to the rollups of a bucket"""
+        with self.lock:
+            for keys, hours in self._changed(bucket_id).items():
+                _add_interval(hours, start, end, group_key(data, keys), sign)
+
+    def invalidate(self, bucket_id: str, since: Optional[datetime]) -> None:
+        """Drops the rollups of a bucket from since and onwards (all if since is None)"""
+        with self.lock:
+            for keys, hours in self._changed(bucket_id).items():
+                dropped = [
+                    hour for hour in hours if since is None or hour + INTERVAL > since
+                ]
+                for hour in dropped:
+                    del hours[hour]
+                self.sizes[(bucket_id, keys)] -= len(dropped)
+                self.size -= len(dropped)
+
+    def drop(self, bucket_id: str) -> None:
+        """Drops all rollups of a bucket (such as when it's deleted)"""
+        with self.lock:
+            self._changed(bucket_id)
+            for keys in self.rollups.pop(bucket_id, {}):
+                self.size -= self.sizes.pop((bucket_id, keys))
+
+    def summarize(
+        self,
+        bucket_id: str,
+        keys: List[str],
+        start: datetime,
+        end: datetime,
+        now: datetime,
+        read_events: Callable[[datetime, datetime], List[Event]],
+    ) -> Totals:
+        """Returns the total duration of the events between start and end, grouped by keys.
+
+        read_events is called to read the events of the bucket between two points in time,
+        for hours not rolled up yet and for the parts of the period which aren't whole hours.
+        """
+        key_tuple = tuple(keys)
+        # Hours are aligned in UTC, also for timezones not offset by whole hours
+        start = start.astimezone(timezone.utc)
+        end = end.astimezone(timezone.utc)
+        totals = {}  # type: Totals
+        rolled_start = _ceil(start)
+        rolled_end = _floor(min(end, now))
+        if rolled_start >= rolled_end:
+            _add_events(totals, read_events(start, end), key_tuple, start, end)
+            return totals
+
+        for edge_start, edge_end in [(start, rolled_start), (rolled_end, end)]:
+            if edge_start < edge_end:
+                events = read_events(edge_start, edge_end)
+                _add_events(totals, events, key_tuple, edge_start, edge_end)
+
+        with self.lock:
+            generation = self.generations.get(bucket_id, 0)
+            rolled_up = self.rollups.get(bucket_id, {}).get(key_tuple, {})
+            if (bucket_id, key_tuple) in self.sizes:
+                self.sizes.move_to_end((bucket_id, key_tuple))
+            missing = []  # type: List[datetime]
+            for hour in _hours(rolled_start, rolled_end):
+                if hour in rolled_up:
+                    for key, seconds in rolled_up[hour].items():
+                        _add(totals, key, seconds)
+                else:
+                    missing.append(hour)
+
+        # Hours not yet rolled up are computed in runs of consecutive hours
+        computed = {}  # type: Dict[datetime, Totals]
+        for run_start, run_end in _runs(missing):
+            hours = {
+                hour: {} for hour in _hours(run_start, run_end)
+            }  # type: Dict[datetime, Totals]
+            for e in read_events(run_start, run_end):
+                _add_interval(
+                    hours,
+                    e.timestamp,
+                    e.timestamp + e.duration,
+                    group_key(e.data, key_tuple),
+                )
+            for hour_totals in hours.values():
+                for key, seconds in hour_totals.items():
+                    _add(totals, key, seconds)
+            computed.update(hours)
+
+        if computed:
+            with self.lock:
+                if self.generations.get(bucket_id, 0) == generation:
+                    by_keys = self.rollups.setdefault(bucket_id, {})
+                    hours = by_keys.setdefault(key_tuple, {})
+                    added = len(computed.keys() - hours.keys())
+                    hours.update(computed)
+                    entry = (bucket_id, key_tuple)
+                    self.sizes[entry] = self.sizes.pop(entry, 0) + added
+                    self.size += added
+                    self._evict()
+        return totals
+
+
+def _runs(hours: List[datetime]) -> Iterator[Tuple[datetime, datetime]]:
+    """Yields the (start, end) of each run of consecutive hours"""
+    run_start = None  # type: Optional[datetime]
+    prev = None  # type: Optional[datetime]
+    for hour in hours:
+        if run_start is None:
+            run_start = hour
+        elif prev is not None and hour != prev + INTERVAL:
+            yield run_start, prev + INTERVAL
+            run_start = hour
+        prev = hour
+    if run_start is not None and prev is not None:
+        yield run_start, prev + INTERVAL
+
+
+def to_events(totals: Totals, timestamp: datetime) -> List[Event]:
+    """Returns the totals as events (like those from merge_events_by_keys),
+    sorted by duration in descending order"""
+    return [
+        Event(
+            timestamp=timestamp,
+            duration=seconds,
+            data={
+                key: list(value) if isinstance(value, tuple) else value
+                for key, value in group
+            },
+        )
+        for group, seconds in sorted(totals.items(), key=lambda t: -t[1])
+    ]
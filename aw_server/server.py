@@ -1,6 +1,7 @@
 import logging
 import os
 from datetime import datetime, timedelta
+from time import perf_counter
 from typing import Dict, List
 
 import aw_datastore
@@ -10,14 +11,22 @@ from flask import (
     Blueprint,
     Flask,
     current_app,
+    g,
+    request,
     send_from_directory,
 )
 from flask_cors import CORS
 
-from . import rest
+from . import asyncserver, metrics, rest
 from .api import ServerAPI
 from .custom_static import get_custom_static_blueprint
-from .log import FlaskLogHandler
+from .log import FlaskLogHandler, trace_request
+from .profiler import SamplingProfilerMiddleware
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
 
 logger = logging.getLogger(__name__)
 
@@ -37,9 +46,18 @@ class AWFlask(Flask):
         custom_static=dict(),
         static_folder=static_folder,
         static_url_path="",
+        heartbeat_flush_interval: float = 0,
+        query_cache_size: int = 0,
+        query_workers: int = 1,
+        profile: bool = False,
+        profile_sample_rate: float = 1.0,
+        profile_routes: List[str] = [],
+        trace_requests: bool = False,
     ):
         name = "aw-server"
-        self.json_provider_class = CustomJSONProvider
+        self.json_provider_class = (
+            OrjsonJSONProvider if orjson is not None else CustomJSONProvider
+        )
         # only prettyprint JSON if testing (due to perf)
         self.json_provider_class.compact = not testing
 
@@ -58,13 +76,51 @@ class AWFlask(Flask):
         if storage_method is None:
             storage_method = aw_datastore.get_storage_methods()["memory"]
         db = Datastore(storage_method, testing=testing)
-        self.api = ServerAPI(db=db, testing=testing)
+        self.api = ServerAPI(
+            db=db,
+            testing=testing,
+            heartbeat_flush_interval=heartbeat_flush_interval,
+            query_cache_size=query_cache_size,
+            query_workers=query_workers,
+        )
+        # Times every call to the storage method, for /api/0/metrics
+        db.storage_strategy = metrics.TimedStorage(  # type: ignore[assignment]
+            db.storage_strategy, self.api.metrics
+        )
+
+        # Logs every request as a line of JSON if set,
+        # can be toggled at runtime through /api/0/trace
+        self.trace_requests = trace_requests
+        self.before_request(_start_request_timer)
+        self.after_request(_observe_request)
+
+        # Profiling of requests, which can be toggled at runtime through /api/0/profiler
+        self.profiler = SamplingProfilerMiddleware(self.wsgi_app)
+        if profile:
+            self.profiler.configure(True, profile_sample_rate, profile_routes)
+        self.wsgi_app = self.profiler  # type: ignore
 
         self.register_blueprint(root)
         self.register_blueprint(rest.blueprint)
         self.register_blueprint(get_custom_static_blueprint(custom_static))
 
 
+def _start_request_timer():
+    g.request_start = perf_counter()
+
+
+def _observe_request(response):
+    # Requests are grouped by route (not path), so that the number of routes stays bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    duration = perf_counter() - g.request_start
+    current_app.api.metrics.observe_request(
+        request.method, route, response.status_code, duration
+    )
+    if current_app.trace_requests:
+        trace_request(response, route, duration)
+    return response
+
+
 class CustomJSONProvider(flask.json.provider.DefaultJSONProvider):
     # encoding/decoding of datetime as iso8601 strings
     # encoding of timedelta as second floats
@@ -79,6 +135,39 @@ class CustomJSONProvider(flask.json.provider.DefaultJSONProvider):
         return super().default(obj)
 
 
+class OrjsonJSONProvider(CustomJSONProvider):
+    """Serializes responses with orjson, which encodes datetimes natively
+    (and events directly, without converting them to JSON dicts first).
+
+    Falls back to CustomJSONProvider for anything orjson can't serialize,
+    such as integers larger than 64 bits."""
+
+    def _dumps_bytes(self, obj, indent: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return self._dumps_bytes(obj).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            data = self._dumps_bytes(obj, indent=indent) + b"\n"
+        except orjson.JSONEncodeError:
+            return super().response(obj)
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+
 @root.route("/")
 def static_root():
     return current_app.send_static_file("index.html")
@@ -113,6 +202,10 @@ def _config_cors(cors_origins: List[str], testing: bool):
     CORS(current_app, resources={r"/api/*": {"origins": cors_origins}})
 
 
+# HTTP servers which aw-server can be run with
+SERVERS = ["werkzeug", "waitress", "asyncio"]
+
+
 # Only to be called from aw_server.main function!
 def _start(
     storage_method,
@@ -121,6 +214,15 @@ def _start(
     testing: bool = False,
     cors_origins: List[str] = [],
     custom_static: Dict[str, str] = dict(),
+    heartbeat_flush_interval: float = 0,
+    query_cache_size: int = 0,
+    query_workers: int = 1,
+    server: str = "werkzeug",
+    server_threads: int = 8,
+    profile: bool = False,
+    profile_sample_rate: float = 1.0,
+    profile_routes: List[str] = [],
+    trace_requests: bool = False,
 ):
     app = AWFlask(
         host,
@@ -128,16 +230,66 @@ def _start(
         storage_method=storage_method,
         cors_origins=cors_origins,
         custom_static=custom_static,
+        heartbeat_flush_interval=heartbeat_flush_interval,
+        query_cache_size=query_cache_size,
+        query_workers=query_workers,
+        profile=profile,
+        profile_sample_rate=profile_sample_rate,
+        profile_routes=profile_routes,
+        trace_requests=trace_requests,
     )
     try:
-        app.run(
-            debug=testing,
-            host=host,
-            port=port,
-            request_handler=FlaskLogHandler,
-            use_reloader=False,
-            threaded=True,
-        )
+        if server == "waitress":
+            _serve_waitress(app, host, port, server_threads)
+        elif server == "asyncio":
+            asyncserver.serve(
+                app,
+                host,
+                port,
+                server_threads,
+                is_stream=_is_stream_request,
+                max_streams=app.api.max_streams,
+            )
+        else:
+            app.run(
+                debug=testing,
+                host=host,
+                port=port,
+                request_handler=FlaskLogHandler,
+                use_reloader=False,
+                threaded=True,
+            )
     except OSError as e:
         logger.exception(e)
         raise e
+    finally:
+        app.api.close()
+
+
+def _is_stream_request(environ) -> bool:
+    """Whether a request is long-lived (a change subscription or heartbeat stream)"""
+    path = environ.get("PATH_INFO", "")
+    return path == "/api/0/changes" or path.endswith("/heartbeat/stream")
+
+
+def _serve_waitress(app: AWFlask, host: str, port: int, threads: int):
+    """Runs the app with waitress, a production WSGI server.
+
+    Unlike the development server (which starts a thread per connection) it handles
+    requests with a fixed number of threads and keeps connections alive."""
+    try:
+        import waitress
+    except ImportError:
+        logger.error(
+            "The waitress server was selected but waitress isn't installed (install aw-server[waitress])"
+        )
+        raise
+
+    # Every open stream holds one of the threads, so only a few are allowed at once.
+    # Waitress reads the whole request body before handling a request,
+    # so heartbeat streams would only be processed once they end and are rejected.
+    app.api.max_streams = max(1, threads // 4)
+    app.api.stream_request_bodies = False
+
+    logger.info(f"Serving with waitress using {threads} threads")
+    waitress.serve(app, host=host, port=port, threads=threads, ident="aw-server")
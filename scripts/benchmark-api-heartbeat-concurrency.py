@@ -0,0 +1,97 @@
+"""
+Measures heartbeat throughput with many watchers sending heartbeats at the same time,
+each to its own bucket (like aw-watcher-window, aw-watcher-afk and browser watchers do).
+
+Usage: benchmark-api-heartbeat-concurrency.py [n_watchers] [--global-lock] [--slow-disk]
+
+With --global-lock all heartbeats are serialized behind a single lock,
+like they were before heartbeat locking was done per bucket.
+
+With --slow-disk every write to the storage takes an extra 5ms, to emulate
+slow disks (SD cards, network home directories) where the lock matters the most.
+"""
+
+import sys
+import threading
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter, sleep
+
+from aw_core.models import Event
+
+import aw_datastore
+import aw_server
+
+HEARTBEATS_PER_WATCHER = 500
+
+
+def slow_down_writes(ds, delay: float) -> None:
+    storage = ds.storage_strategy
+    for method in ["insert_one", "replace_last"]:
+
+        def slow(*args, _f=getattr(storage, method), **kwargs):
+            sleep(delay)
+            return _f(*args, **kwargs)
+
+        setattr(storage, method, slow)
+
+
+def benchmark(n_watchers: int, global_lock: bool, slow_disk: bool):
+    ds = aw_datastore.Datastore(aw_datastore.storages.PeeweeStorage, testing=True)
+    if slow_disk:
+        slow_down_writes(ds, 0.005)
+    api = aw_server.api.ServerAPI(ds, testing=True)
+    lock = threading.Lock()
+
+    bucket_ids = [f"test-benchmark-concurrency-{i}" for i in range(n_watchers)]
+    for bucket_id in bucket_ids:
+        if bucket_id in api.get_buckets():
+            api.delete_bucket(bucket_id)
+        api.create_bucket(bucket_id, "test", "test", "test")
+
+    def watcher(bucket_id: str):
+        start = datetime.now(tz=tz.utc) - timedelta(days=1)
+        for i in range(HEARTBEATS_PER_WATCHER):
+            # Data changes every 10th heartbeat
+            e = Event(
+                timestamp=start + timedelta(seconds=i),
+                data={"test": str(int(i / 10))},
+            )
+            if global_lock:
+                with lock:
+                    api.heartbeat(bucket_id, e, pulsetime=2)
+            else:
+                api.heartbeat(bucket_id, e, pulsetime=2)
+
+    threads = [threading.Thread(target=watcher, args=(b,)) for b in bucket_ids]
+    t_start = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    t_total = perf_counter() - t_start
+
+    for bucket_id in bucket_ids:
+        api.delete_bucket(bucket_id)
+
+    n_heartbeats = n_watchers * HEARTBEATS_PER_WATCHER
+    print(
+        "{} watchers, {}{}: {} heartbeats in {:.2f}s ({:.0f} heartbeats/s)".format(
+            n_watchers,
+            "global lock" if global_lock else "per-bucket locks",
+            ", slow disk" if slow_disk else "",
+            n_heartbeats,
+            t_total,
+            n_heartbeats / t_total,
+        )
+    )
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    n_watchers = int(args[0]) if args else 8
+    benchmark(
+        n_watchers,
+        global_lock="--global-lock" in sys.argv,
+        slow_disk="--slow-disk" in sys.argv,
+    )
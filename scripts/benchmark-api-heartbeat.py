@@ -1,6 +1,7 @@
 from time import sleep
 import cProfile
 import pstats
+import sys
 from datetime import timezone as tz
 from datetime import datetime
 
@@ -10,9 +11,26 @@ import aw_datastore
 import aw_server
 
 
-def benchmark():
+def count_writes(ds) -> dict:
+    """Wraps the write methods of the storage to count how often they're called"""
+    counts = {"insert_one": 0, "replace_last": 0}
+    storage = ds.storage_strategy
+    for method in counts:
+
+        def counted(*args, _method=method, _f=getattr(storage, method), **kwargs):
+            counts[_method] += 1
+            return _f(*args, **kwargs)
+
+        setattr(storage, method, counted)
+    return counts
+
+
+def benchmark(heartbeat_flush_interval: float = 0):
     ds = aw_datastore.Datastore(aw_datastore.storages.PeeweeStorage, testing=True)
-    api = aw_server.api.ServerAPI(ds, testing=True)
+    api = aw_server.api.ServerAPI(
+        ds, testing=True, heartbeat_flush_interval=heartbeat_flush_interval
+    )
+    counts = count_writes(ds)
 
     print(api.get_info())
 
@@ -23,19 +41,29 @@ def benchmark():
     except Exception as e:
         print(e)
 
-    print("Benchmarking... this will take 30 seconds")
+    print(
+        "Benchmarking with heartbeat_flush_interval={}... this will take 12 seconds".format(
+            heartbeat_flush_interval
+        )
+    )
     for i in range(120):
         sleep(0.1)
+        # Data changes every 10th heartbeat, as with a window watcher switching windows
         api.heartbeat(
             bucket_id,
-            Event(timestamp=datetime.now(tz=tz.utc), data={"test": str(int(i))}),
+            Event(timestamp=datetime.now(tz=tz.utc), data={"test": str(int(i / 10))}),
             pulsetime=0.3,
         )
+    api.close()
+
+    print(f"Writes: {counts}")
 
 
 if __name__ == "__main__":
+    # Usage: benchmark-api-heartbeat.py [heartbeat_flush_interval]
+    flush_interval = float(sys.argv[1]) if len(sys.argv) > 1 else 0
     f_bench = "benchmark.dat"
-    cProfile.run("benchmark()", f_bench)
+    cProfile.run(f"benchmark({flush_interval})", f_bench)
     p = pstats.Stats(f_bench)
     p.strip_dirs()
     # p.sort_stats('tottime')
@@ -0,0 +1,136 @@
+"""
+Compares sending heartbeats as one request each with sending them over a
+single streamed request (newline-delimited JSON in a chunked body),
+measuring heartbeats per second and server CPU time per heartbeat.
+
+The server is started in a separate process, so its CPU time can be measured (on Linux).
+
+Usage: benchmark-heartbeat-stream.py [n_heartbeats] [--server=werkzeug|waitress|asyncio]
+
+Note that waitress reads the whole request body before handing it to aw-server,
+so with it streamed heartbeats are only processed when the stream ends.
+"""
+
+import http.client
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter, sleep
+
+PORT = 5668
+BUCKET_ID = "test-benchmark-stream"
+
+
+def start_server(server: str) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "aw_server",
+            "--testing",
+            "--storage=memory",
+            f"--port={PORT}",
+            f"--server={server}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection("localhost", PORT)
+            conn.request("GET", "/api/0/info")
+            if conn.getresponse().status == 200:
+                return proc
+        except ConnectionError:
+            sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{server} server didn't start")
+
+
+def cpu_time(pid: int) -> float:
+    """Returns the user + system CPU time of a process in seconds"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return float("nan")
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def heartbeats(n: int, offset: int):
+    start = datetime.now(tz=tz.utc) - timedelta(days=1)
+    for i in range(offset, offset + n):
+        yield {
+            "timestamp": (start + timedelta(seconds=i)).isoformat(),
+            "duration": 0,
+            "data": {"title": str(i // 10)},
+        }
+
+
+def send_requests(conn: http.client.HTTPConnection, n: int) -> None:
+    for hb in heartbeats(n, 0):
+        conn.request(
+            "POST",
+            f"/api/0/buckets/{BUCKET_ID}/heartbeat?pulsetime=2",
+            json.dumps(hb),
+            {"Content-Type": "application/json"},
+        )
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 200:
+            raise Exception(f"Heartbeat failed with status {resp.status}")
+
+
+def send_stream(conn: http.client.HTTPConnection, n: int) -> None:
+    conn.request(
+        "POST",
+        f"/api/0/buckets/{BUCKET_ID}/heartbeat/stream?pulsetime=2",
+        ((json.dumps(hb) + "\n").encode() for hb in heartbeats(n, n)),
+        {"Content-Type": "application/x-ndjson"},
+        encode_chunked=True,
+    )
+    resp = conn.getresponse()
+    assert json.loads(resp.read()) == {"heartbeats": n}
+
+
+def benchmark(n: int, server: str):
+    proc = start_server(server)
+    try:
+        conn = http.client.HTTPConnection("localhost", PORT)
+        conn.request(
+            "POST",
+            f"/api/0/buckets/{BUCKET_ID}",
+            json.dumps({"client": "test", "type": "test", "hostname": "test"}),
+            {"Content-Type": "application/json"},
+        )
+        conn.getresponse().read()
+
+        print(f"{n} heartbeats, {server} server:")
+        for name, send in [("requests", send_requests), ("stream", send_stream)]:
+            conn = http.client.HTTPConnection("localhost", PORT)
+            cpu_start = cpu_time(proc.pid)
+            t_start = perf_counter()
+            send(conn, n)
+            t_total = perf_counter() - t_start
+            cpu = cpu_time(proc.pid) - cpu_start
+            conn.close()
+            print(
+                "  {:<8}  {:.0f} heartbeats/s, {:.3f}ms server CPU per heartbeat".format(
+                    name, n / t_total, 1000 * cpu / n
+                )
+            )
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    server = "asyncio"
+    for a in sys.argv[1:]:
+        if a.startswith("--server="):
+            server = a.split("=")[1]
+    benchmark(int(args[0]) if args else 5000, server)
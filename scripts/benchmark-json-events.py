@@ -0,0 +1,54 @@
+"""
+Compares the time to serialize a response with 100k events
+with the standard library JSON provider (converting every event with to_json_dict first)
+and with the orjson provider (serializing the events as-is).
+
+Usage: benchmark-json-events.py [n_events]
+"""
+
+import sys
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter
+
+from aw_core.models import Event
+
+from aw_server.server import AWFlask, CustomJSONProvider, OrjsonJSONProvider
+
+
+def create_events(n: int):
+    start = datetime(2020, 1, 1, tzinfo=tz.utc)
+    return [
+        Event(
+            id=i,
+            timestamp=start + timedelta(seconds=30 * i, microseconds=i),
+            duration=29.5,
+            data={"app": f"app{i % 10}", "title": f"Some window title {i % 100}"},
+        )
+        for i in range(n)
+    ]
+
+
+def benchmark(n_events: int):
+    app = AWFlask("127.0.0.1", testing=False)
+    events = create_events(n_events)
+
+    with app.app_context():
+        stdlib = CustomJSONProvider(app)
+        t_start = perf_counter()
+        body_stdlib = stdlib.response([e.to_json_dict() for e in events]).get_data()
+        t_stdlib = perf_counter() - t_start
+
+        fast = OrjsonJSONProvider(app)
+        t_start = perf_counter()
+        body_fast = fast.response(events).get_data()
+        t_fast = perf_counter() - t_start
+
+    assert len(body_stdlib) == len(body_fast)
+    print(f"{n_events} events ({len(body_fast) / 1e6:.1f}MB)")
+    print(f"  json + to_json_dict: {t_stdlib:.3f}s")
+    print(f"  orjson, raw events:  {t_fast:.3f}s ({t_stdlib / t_fast:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,85 @@
+"""
+Compares evaluating the timeperiods of a 31-day query one by one and in parallel,
+like the month view of the web UI does.
+
+Also compares it with summarizing the same timeperiods from rollups,
+both the first time (when the rollups are computed) and after that.
+
+Usage: benchmark-query-timeperiods.py [query_workers]
+"""
+
+import sys
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter
+
+from aw_core.models import Event
+
+import aw_datastore
+import aw_server
+
+BUCKET_ID = "test-benchmark-query-window"
+DAYS = 31
+
+QUERY = [
+    f'events = flood(query_bucket("{BUCKET_ID}"));',
+    'events = merge_events_by_keys(events, ["app", "title"]);',
+    "events = sort_by_duration(events);",
+    "RETURN = limit_events(events, 100);",
+]
+
+
+def create_events(api, start: datetime) -> None:
+    """Creates 8 hours of window events per day, switching window every 30 seconds"""
+    if BUCKET_ID in api.get_buckets():
+        return
+    api.create_bucket(BUCKET_ID, "currentwindow", "test", "test")
+    events = []
+    for day in range(DAYS):
+        day_start = start + timedelta(days=day, hours=9)
+        for i in range(8 * 60 * 2):
+            events.append(
+                Event(
+                    timestamp=day_start + timedelta(seconds=30 * i),
+                    duration=29,
+                    data={"app": f"app{i % 10}", "title": f"title{i % 100}"},
+                )
+            )
+    api.create_events(BUCKET_ID, events)
+
+
+def benchmark(query_workers: int):
+    ds = aw_datastore.Datastore(aw_datastore.storages.PeeweeStorage, testing=True)
+    api = aw_server.api.ServerAPI(ds, testing=True, query_workers=query_workers)
+
+    start = datetime(2020, 1, 1, tzinfo=tz.utc)
+    create_events(api, start)
+    timeperiods = [
+        "{}/{}".format(
+            (start + timedelta(days=i)).isoformat(),
+            (start + timedelta(days=i + 1)).isoformat(),
+        )
+        for i in range(DAYS)
+    ]
+
+    if api.query_pool is not None:
+        # Don't count worker process startup
+        api.query2("benchmark", QUERY, timeperiods[: query_workers + 1], False)
+
+    t_start = perf_counter()
+    results = api.query2("benchmark", QUERY, timeperiods, False)
+    t_total = perf_counter() - t_start
+    assert len(results) == DAYS
+    print(f"query_workers={query_workers}: {DAYS} timeperiods in {t_total:.2f}s")
+
+    for run in ["first", "second"]:
+        t_start = perf_counter()
+        summaries = api.summarize(BUCKET_ID, ["app", "title"], timeperiods)
+        t_total = perf_counter() - t_start
+        assert len(summaries) == DAYS
+        print(f"summarize ({run} time): {DAYS} timeperiods in {t_total:.2f}s")
+    api.close()
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
@@ -0,0 +1,165 @@
+"""
+Measures request throughput and latency of a running aw-server,
+started with each of the HTTP servers in turn.
+
+A number of clients (like watchers) send heartbeats to their own bucket while
+a few others (like the web UI) list buckets, each over a persistent connection.
+
+The number of threads of the server process is also reported (on Linux).
+
+Usage: benchmark-server-load.py [n_clients] [seconds] [--server-threads=N]
+"""
+
+import http.client
+import json
+import subprocess
+import sys
+import threading
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter, sleep
+
+PORT = 5667
+
+
+class Client:
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.conn = http.client.HTTPConnection("localhost", port)
+
+    def _request(self, method: str, path: str, body=None) -> int:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        data = json.dumps(body) if body is not None else None
+        self.conn.request(method, path, data, headers)
+        resp = self.conn.getresponse()
+        resp.read()
+        return resp.status
+
+    def request(self, method: str, path: str, body=None) -> int:
+        try:
+            return self._request(method, path, body)
+        except (http.client.HTTPException, ConnectionError):
+            # The server closed the connection (no keep-alive), reconnect
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("localhost", self.port)
+            return self._request(method, path, body)
+
+
+def start_server(server: str, server_threads: int) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "aw_server",
+            "--testing",
+            "--storage=memory",
+            f"--port={PORT}",
+            f"--server={server}",
+            f"--server-threads={server_threads}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            if Client(PORT).request("GET", "/api/0/info") == 200:
+                return proc
+        except ConnectionError:
+            sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{server} server didn't start")
+
+
+def count_threads(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return line.split()[1]
+    except OSError:
+        pass
+    return "?"
+
+
+def run_load(n_clients: int, seconds: float, pid: int):
+    latencies = []  # type: list
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def watcher(i: int):
+        client = Client(PORT)
+        bucket_id = f"test-load-{i}"
+        client.request(
+            "POST",
+            f"/api/0/buckets/{bucket_id}",
+            {"client": "test", "type": "test", "hostname": "test"},
+        )
+        start = datetime.now(tz=tz.utc) - timedelta(days=1)
+        n = 0
+        while not stop.is_set():
+            heartbeat = {
+                "timestamp": (start + timedelta(seconds=n)).isoformat(),
+                "duration": 0,
+                "data": {"title": str(n // 10)},
+            }
+            t = perf_counter()
+            client.request(
+                "POST", f"/api/0/buckets/{bucket_id}/heartbeat?pulsetime=2", heartbeat
+            )
+            with lock:
+                latencies.append(perf_counter() - t)
+            n += 1
+
+    def dashboard():
+        client = Client(PORT)
+        while not stop.is_set():
+            t = perf_counter()
+            client.request("GET", "/api/0/buckets/")
+            with lock:
+                latencies.append(perf_counter() - t)
+
+    threads = [threading.Thread(target=watcher, args=(i,)) for i in range(n_clients)]
+    threads += [threading.Thread(target=dashboard) for _ in range(2)]
+    for t in threads:
+        t.start()
+    sleep(seconds)
+    threads_used = count_threads(pid)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sorted(latencies), threads_used
+
+
+def benchmark(server: str, n_clients: int, seconds: float, server_threads: int):
+    proc = start_server(server, server_threads)
+    try:
+        latencies, threads_used = run_load(n_clients, seconds, proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    def percentile(p: float) -> float:
+        return 1000 * latencies[int(p * (len(latencies) - 1))]
+
+    print(
+        "{:<9} {} clients: {:.0f} req/s, latency p50 {:.1f}ms, p99 {:.1f}ms, {} server threads".format(
+            server,
+            n_clients + 2,
+            len(latencies) / seconds,
+            percentile(0.5),
+            percentile(0.99),
+            threads_used,
+        )
+    )
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    n_clients = int(args[0]) if len(args) > 0 else 32
+    seconds = float(args[1]) if len(args) > 1 else 10
+    server_threads = 8
+    for a in sys.argv[1:]:
+        if a.startswith("--server-threads="):
+            server_threads = int(a.split("=")[1])
+    for server in ["werkzeug", "waitress", "asyncio"]:
+        benchmark(server, n_clients, seconds, server_threads)
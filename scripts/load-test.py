@@ -0,0 +1,363 @@
+"""
+Load test simulating a number of machines, each running a window, afk and web watcher
+sending heartbeats at their usual rates (with data changing like it does in real use),
+along with dashboard clients making the queries of the activity view of the web UI.
+
+Reports throughput, p50/p99 latency and the rate of errors and 503s (server busy)
+for each kind of request.
+
+Targets a running aw-server with --port (and --host), or with --in-process an AWFlask
+app created by the script and driven through its test client (such as in CI).
+
+--speedup makes the watchers send heartbeats that many times as often
+(as if time passed that much faster), to simulate more load with fewer threads.
+
+Usage: load-test.py [--in-process | --port=5666] [--watchers=10] [--dashboards=1]
+                    [--seconds=30] [--speedup=1]
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from datetime import timezone as tz
+from time import perf_counter, sleep
+from typing import Dict, List
+
+APPS = {
+    "Firefox": ["GitHub", "Hacker News", "Wikipedia", "YouTube", "Gmail"],
+    "Code": ["api.py", "rest.py", "server.py", "test_server.py"],
+    "Terminal": ["bash", "htop", "git log", "vim"],
+    "Slack": ["general", "random", "dev"],
+    "Spotify": ["Spotify Premium"],
+}
+URLS = [
+    "https://github.com/ActivityWatch/aw-server",
+    "https://news.ycombinator.com/",
+    "https://en.wikipedia.org/wiki/Special:Random",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://mail.google.com/mail/u/0/#inbox",
+]
+
+
+class HTTPTransport:
+    """Sends requests to a running server over a persistent connection"""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+
+    def _request(self, method: str, path: str, body=None) -> int:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        data = json.dumps(body) if body is not None else None
+        self.conn.request(method, path, data, headers)
+        resp = self.conn.getresponse()
+        resp.read()
+        return resp.status
+
+    def request(self, method: str, path: str, body=None) -> int:
+        try:
+            return self._request(method, path, body)
+        except (http.client.HTTPException, ConnectionError):
+            # The server closed the connection (no keep-alive), reconnect
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            return self._request(method, path, body)
+
+
+class InProcessTransport:
+    """Sends requests to an AWFlask app through its test client"""
+
+    def __init__(self, app) -> None:
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, body=None) -> int:
+        return self.client.open(path, method=method, json=body).status_code
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, kind: str, latency: float, status: int) -> None:
+        with self.lock:
+            self.latencies[kind].append(latency)
+            self.statuses[kind][status] += 1
+
+    def report(self, seconds: float) -> None:
+        print(
+            "{:<10} {:>8} {:>9} {:>9} {:>9} {:>7} {:>7}".format(
+                "request", "count", "req/s", "p50 ms", "p99 ms", "errors", "503s"
+            )
+        )
+        for kind in sorted(self.latencies):
+            latencies = sorted(self.latencies[kind])
+            statuses = self.statuses[kind]
+            n = len(latencies)
+            errors = sum(c for s, c in statuses.items() if s >= 400 or s == 0)
+
+            def percentile(p: float) -> float:
+                return 1000 * latencies[int(p * (n - 1))]
+
+            print(
+                "{:<10} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.1%} {:>6.1%}".format(
+                    kind,
+                    n,
+                    n / seconds,
+                    percentile(0.5),
+                    percentile(0.99),
+                    errors / n,
+                    statuses.get(503, 0) / n,
+                )
+            )
+
+
+def timed_request(stats: Stats, kind: str, transport, method: str, path: str, body):
+    t_start = perf_counter()
+    try:
+        status = transport.request(method, path, body)
+    except Exception:
+        status = 0
+    stats.record(kind, perf_counter() - t_start, status)
+
+
+class Watcher:
+    """Sends heartbeats every interval, the data changing after a random time
+    (exponentially distributed with a mean of dwell seconds)"""
+
+    kind = ""
+    interval = 1.0
+    pulsetime = 2.0
+    dwell = 30.0
+
+    def __init__(self, host_id: int, rng: random.Random) -> None:
+        self.bucket_id = f"test-load-{self.kind}_host{host_id}"
+        self.rng = rng
+        self.data = self.next_data()
+
+    def next_data(self) -> dict:
+        raise NotImplementedError
+
+    def heartbeat(self, timestamp: datetime) -> dict:
+        if self.rng.random() < self.interval / self.dwell:
+            self.data = self.next_data()
+        return {"timestamp": timestamp.isoformat(), "duration": 0, "data": self.data}
+
+
+class WindowWatcher(Watcher):
+    kind = "window"
+
+    def next_data(self) -> dict:
+        app = self.rng.choice(list(APPS))
+        return {"app": app, "title": f"{self.rng.choice(APPS[app])} - {app}"}
+
+
+class AFKWatcher(Watcher):
+    kind = "afk"
+    interval = 5.0
+    pulsetime = 6.0
+    dwell = 600.0
+
+    def next_data(self) -> dict:
+        afk = getattr(self, "data", {}).get("status") == "not-afk"
+        return {"status": "afk" if afk else "not-afk"}
+
+
+class WebWatcher(Watcher):
+    kind = "web"
+    interval = 10.0
+    pulsetime = 11.0
+    dwell = 60.0
+
+    def next_data(self) -> dict:
+        url = self.rng.choice(URLS)
+        return {"url": url, "title": url.split("/")[2], "audible": False}
+
+
+def run_watcher(
+    watcher: Watcher, transport, stats, stop, speedup: float, t_sim: datetime
+) -> None:
+    """Sends heartbeats with timestamps from t_sim onwards, speedup times as often as usual"""
+    transport.request(
+        "POST",
+        f"/api/0/buckets/{watcher.bucket_id}",
+        {"client": "load-test", "type": watcher.kind, "hostname": "load-test"},
+    )
+    path = f"/api/0/buckets/{watcher.bucket_id}/heartbeat?pulsetime={watcher.pulsetime}"
+    start = perf_counter()
+    # Watchers on different machines don't send heartbeats in lockstep
+    n = watcher.rng.random()
+    while not stop.is_set():
+        wait = start + n * watcher.interval / speedup - perf_counter()
+        if wait > 0 and stop.wait(wait):
+            break
+        timestamp = t_sim + timedelta(seconds=n * watcher.interval)
+        timed_request(
+            stats, watcher.kind, transport, "POST", path, watcher.heartbeat(timestamp)
+        )
+        n += 1
+
+
+def dashboard_query(window: str, afk: str, web: str) -> List[str]:
+    return f"""
+        events = flood(query_bucket("{window}"));
+        not_afk = flood(query_bucket("{afk}"));
+        not_afk = filter_keyvals(not_afk, "status", ["not-afk"]);
+        events = filter_period_intersect(events, not_afk);
+        title_events = sort_by_duration(merge_events_by_keys(events, ["app", "title"]));
+        app_events = sort_by_duration(merge_events_by_keys(title_events, ["app"]));
+        browser_events = flood(query_bucket("{web}"));
+        browser_events = filter_period_intersect(browser_events, not_afk);
+        url_events = sort_by_duration(merge_events_by_keys(browser_events, ["url"]));
+        duration = sum_durations(events);
+        RETURN = {{
+            "app_events": app_events,
+            "title_events": limit_events(title_events, 100),
+            "url_events": limit_events(url_events, 100),
+            "duration": duration
+        }};
+    """.split(
+        "\n"
+    )
+
+
+def run_dashboard(
+    host_id: int, transport, stats, stop, interval: float, days: int
+) -> None:
+    """Lists buckets and queries the activity of a host every interval seconds, like the web UI"""
+    query = dashboard_query(
+        f"test-load-window_host{host_id}",
+        f"test-load-afk_host{host_id}",
+        f"test-load-web_host{host_id}",
+    )
+    while not stop.is_set():
+        timed_request(stats, "buckets", transport, "GET", "/api/0/buckets/", None)
+        today = datetime.now(tz=tz.utc).replace(hour=0, minute=0, second=0)
+        timeperiods = [
+            "{}/{}".format(
+                (today - timedelta(days=d)).isoformat(),
+                (today - timedelta(days=d - 1)).isoformat(),
+            )
+            for d in range(days - 1, -1, -1)
+        ]
+        timed_request(
+            stats,
+            "query",
+            transport,
+            "POST",
+            "/api/0/query/",
+            {"query": query, "timeperiods": timeperiods},
+        )
+        if stop.wait(interval):
+            break
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Create an AWFlask app in this process instead of connecting to a server",
+    )
+    parser.add_argument(
+        "--storage",
+        default="memory",
+        help="Storage method of the in-process app",
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5666)
+    parser.add_argument(
+        "--watchers",
+        type=int,
+        default=10,
+        help="Number of simulated machines, each running a window, afk and web watcher",
+    )
+    parser.add_argument("--dashboards", type=int, default=1)
+    parser.add_argument(
+        "--dashboard-interval",
+        type=float,
+        default=5,
+        help="Seconds between the refreshes of each dashboard",
+    )
+    parser.add_argument(
+        "--dashboard-days", type=int, default=1, help="Days queried by dashboards"
+    )
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--speedup", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.in_process:
+        from aw_datastore import get_storage_methods
+
+        from aw_server.server import AWFlask
+
+        app = AWFlask(
+            "127.0.0.1",
+            testing=True,
+            storage_method=get_storage_methods()[args.storage],
+        )
+
+        def transport():
+            return InProcessTransport(app)
+
+    else:
+
+        def transport():
+            return HTTPTransport(args.host, args.port)
+
+    # Simulated time starts in the past, so that sped up heartbeats aren't in the future
+    t_sim = datetime.now(tz=tz.utc) - timedelta(seconds=args.seconds * args.speedup)
+    rng = random.Random(args.seed)
+    stats = Stats()
+    stop = threading.Event()
+    threads = []
+    for i in range(args.watchers):
+        for watcher_class in [WindowWatcher, AFKWatcher, WebWatcher]:
+            watcher = watcher_class(i, random.Random(rng.random()))
+            threads.append(
+                threading.Thread(
+                    target=run_watcher,
+                    args=(watcher, transport(), stats, stop, args.speedup, t_sim),
+                )
+            )
+    for i in range(args.dashboards):
+        threads.append(
+            threading.Thread(
+                target=run_dashboard,
+                args=(
+                    i % max(args.watchers, 1),
+                    transport(),
+                    stats,
+                    stop,
+                    args.dashboard_interval,
+                    args.dashboard_days,
+                ),
+            )
+        )
+
+    print(
+        f"Simulating {args.watchers} machines (x3 watchers, speedup {args.speedup}) "
+        f"and {args.dashboards} dashboards for {args.seconds}s..."
+    )
+    t_start = perf_counter()
+    for t in threads:
+        t.start()
+    sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    stats.report(perf_counter() - t_start)
+
+    if args.in_process:
+        app.api.close()
+
+
+if __name__ == "__main__":
+    main()
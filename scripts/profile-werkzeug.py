@@ -1,6 +1,17 @@
-from werkzeug.contrib.profiler import ProfilerMiddleware
-from aw_server import app
+"""
+Runs a testing server with every request profiled,
+writing pstats files to the profiles directory in the data dir.
 
-app.config["PROFILE"] = True
-app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[30])
-app.run(debug=True)
+Usage: profile-werkzeug.py [path prefixes of requests to profile...]
+
+Profiling can also be turned on for a running server with --profile
+or by POSTing {"enabled": true} to /api/0/profiler.
+"""
+
+import sys
+
+from aw_server.server import AWFlask
+
+app = AWFlask("127.0.0.1", testing=True, profile=True, profile_routes=sys.argv[1:])
+print(f"Writing profiles to {app.profiler.profile_dir}")
+app.run(host="127.0.0.1", port=5666, threaded=True)
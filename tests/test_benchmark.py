@@ -0,0 +1,288 @@
+"""
+Benchmarks of the hot paths of the REST API, driving the Flask test client
+of a server using the peewee storage method (in a temporary directory).
+
+Datasets are generated from a fixed seed and start time, so that results are
+comparable across commits. To save the results of a run and compare against it later:
+
+    python -m pytest tests/test_benchmark.py --benchmark-autosave
+    python -m pytest tests/test_benchmark.py --benchmark-compare
+
+Reading 100k and 1M events and listing 1000 buckets is only benchmarked
+if AW_BENCHMARK_LARGE=1 is set, since creating those datasets takes a while.
+"""
+
+import functools
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import pytest
+from aw_core.models import Event
+from aw_datastore import get_storage_methods
+from aw_server.server import AWFlask
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+SEED = 0
+
+large = pytest.mark.skipif(
+    os.environ.get("AW_BENCHMARK_LARGE") != "1",
+    reason="large benchmarks are only run with AW_BENCHMARK_LARGE=1",
+)
+
+APPS = ["Firefox", "Code", "Terminal", "Slack", "Spotify", "Thunderbird", "Zoom"]
+
+CATEGORIES = [
+    [["Work", "Programming"], {"type": "regex", "regex": "Code|Terminal"}],
+    [["Work", "Communication"], {"type": "regex", "regex": "Slack|Thunderbird|Zoom"}],
+    [["Media"], {"type": "regex", "regex": "Spotify"}],
+]
+
+
+def window_events(n: int, seed: int = SEED) -> List[Event]:
+    """Events like those of aw-watcher-window, back to back with short gaps"""
+    rng = random.Random(seed)
+    timestamp = START
+    events = []
+    for _ in range(n):
+        app = rng.choice(APPS)
+        duration = round(rng.expovariate(1 / 30), 3)
+        events.append(
+            Event(
+                timestamp=timestamp,
+                duration=duration,
+                data={"app": app, "title": f"{app} - document {rng.randrange(50)}"},
+            )
+        )
+        timestamp += timedelta(seconds=duration + round(rng.expovariate(1 / 5), 3))
+    return events
+
+
+def afk_events(end: datetime, seed: int = SEED) -> List[Event]:
+    """Events like those of aw-watcher-afk, alternating between afk and not-afk until end"""
+    rng = random.Random(seed)
+    timestamp = START
+    events = []
+    afk = False
+    while timestamp < end:
+        duration = round(rng.expovariate(1 / (600 if afk else 1800)), 3)
+        events.append(
+            Event(
+                timestamp=timestamp,
+                duration=duration,
+                data={"status": "afk" if afk else "not-afk"},
+            )
+        )
+        timestamp += timedelta(seconds=duration)
+        afk = not afk
+    return events
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    filepath = tmp_path_factory.mktemp("benchmark") / "peewee.db"
+    storage_method = functools.partial(
+        get_storage_methods()["peewee"], filepath=str(filepath)
+    )
+    app = AWFlask("127.0.0.1", testing=True, storage_method=storage_method)
+    yield app
+    app.api.close()
+
+
+@pytest.fixture(scope="module")
+def client(app):
+    return app.test_client()
+
+
+def create_bucket(app, bucket_id: str, events: List[Event]) -> str:
+    app.api.create_bucket(bucket_id, "test", "test", "test")
+    if events:
+        app.api.create_events(bucket_id, events)
+    return bucket_id
+
+
+@pytest.fixture()
+def empty_bucket(app, request):
+    bucket_id = create_bucket(app, f"test-benchmark-{request.node.name}", [])
+    yield bucket_id
+    app.api.delete_bucket(bucket_id)
+
+
+@pytest.fixture(
+    scope="module",
+    params=[
+        10_000,
+        pytest.param(100_000, marks=large),
+        pytest.param(1_000_000, marks=large),
+    ],
+)
+def events_bucket(app, request):
+    bucket_id = create_bucket(
+        app, f"test-benchmark-events-{request.param}", window_events(request.param)
+    )
+    yield bucket_id
+    app.api.delete_bucket(bucket_id)
+
+
+@pytest.mark.benchmark(group="heartbeat")
+def test_heartbeat_merge(benchmark, client, empty_bucket):
+    """Heartbeats with unchanged data, merged into the last event"""
+    timestamps = (START + timedelta(seconds=i) for i in range(10**9))
+
+    @benchmark
+    def send():
+        heartbeat = Event(timestamp=next(timestamps), data={"app": "Code"})
+        r = client.post(
+            f"/api/0/buckets/{empty_bucket}/heartbeat?pulsetime=2",
+            json=heartbeat.to_json_dict(),
+        )
+        assert r.status_code == 200
+
+
+@pytest.mark.benchmark(group="heartbeat")
+def test_heartbeat_insert(benchmark, client, empty_bucket):
+    """Heartbeats with changed data, inserted as new events"""
+    timestamps = (START + timedelta(seconds=i) for i in range(10**9))
+
+    @benchmark
+    def send():
+        timestamp = next(timestamps)
+        heartbeat = Event(timestamp=timestamp, data={"title": str(timestamp)})
+        r = client.post(
+            f"/api/0/buckets/{empty_bucket}/heartbeat?pulsetime=2",
+            json=heartbeat.to_json_dict(),
+        )
+        assert r.status_code == 200
+
+
+@pytest.mark.benchmark(group="insert")
+def test_insert_events(benchmark, client, empty_bucket):
+    """Inserting 1000 events in one request"""
+    body = json.dumps([e.to_json_dict() for e in window_events(1000)])
+
+    @benchmark
+    def insert():
+        r = client.post(
+            f"/api/0/buckets/{empty_bucket}/events",
+            data=body,
+            content_type="application/json",
+        )
+        assert r.status_code == 200
+
+
+@pytest.mark.benchmark(group="get_events")
+def test_get_events(benchmark, client, events_bucket):
+    @benchmark
+    def get():
+        r = client.get(f"/api/0/buckets/{events_bucket}/events?limit=-1")
+        assert r.status_code == 200
+
+    assert len(client.get(f"/api/0/buckets/{events_bucket}/events?limit=1").json) == 1
+
+
+@pytest.mark.benchmark(group="get_buckets")
+@pytest.mark.parametrize("n_buckets", [10, 100, pytest.param(1000, marks=large)])
+def test_get_buckets(benchmark, app, client, n_buckets):
+    bucket_ids = [
+        create_bucket(app, f"test-benchmark-buckets-{i}", window_events(1, seed=i))
+        for i in range(n_buckets)
+    ]
+    try:
+
+        @benchmark
+        def get():
+            r = client.get("/api/0/buckets/")
+            assert r.status_code == 200
+
+    finally:
+        for bucket_id in bucket_ids:
+            app.api.delete_bucket(bucket_id)
+
+
+@pytest.mark.benchmark(group="export")
+def test_export_bucket(benchmark, app, client):
+    bucket_id = create_bucket(app, "test-benchmark-export", window_events(10_000))
+    try:
+
+        @benchmark
+        def export():
+            r = client.get(f"/api/0/buckets/{bucket_id}/export")
+            assert r.status_code == 200
+
+    finally:
+        app.api.delete_bucket(bucket_id)
+
+
+@pytest.mark.benchmark(group="export")
+def test_import_bucket(benchmark, app, client):
+    bucket_id = "test-benchmark-import"
+    create_bucket(app, bucket_id, window_events(10_000))
+    export = client.get(f"/api/0/buckets/{bucket_id}/export").get_data()
+    app.api.delete_bucket(bucket_id)
+
+    def import_bucket():
+        r = client.post("/api/0/import", data=export, content_type="application/json")
+        assert r.status_code == 200
+
+    def delete_imported():
+        if bucket_id in app.api.bucket_ids:
+            app.api.delete_bucket(bucket_id)
+
+    # The imported bucket is deleted before each round, as buckets can't be imported twice
+    benchmark.pedantic(import_bucket, setup=delete_imported, rounds=5)
+    app.api.delete_bucket(bucket_id)
+
+
+@pytest.fixture(scope="module")
+def dashboard_buckets(app):
+    """A week of window and afk events"""
+    window = window_events(7 * 24 * 60 * 2)
+    end = window[-1].timestamp + window[-1].duration
+    yield (
+        create_bucket(app, "test-benchmark-window", window),
+        create_bucket(app, "test-benchmark-afk", afk_events(end)),
+    )
+    app.api.delete_bucket("test-benchmark-window")
+    app.api.delete_bucket("test-benchmark-afk")
+
+
+@pytest.mark.benchmark(group="query")
+@pytest.mark.parametrize("days", [1, 7])
+def test_query_dashboard(benchmark, client, dashboard_buckets, days):
+    """A query like those of the activity view of the web UI, for each day of a period"""
+    window, afk = dashboard_buckets
+    query = f"""
+        events = flood(query_bucket("{window}"));
+        not_afk = flood(query_bucket("{afk}"));
+        not_afk = filter_keyvals(not_afk, "status", ["not-afk"]);
+        events = filter_period_intersect(events, not_afk);
+        events = categorize(events, {json.dumps(CATEGORIES)});
+        title_events = sort_by_duration(merge_events_by_keys(events, ["app", "title"]));
+        app_events = sort_by_duration(merge_events_by_keys(title_events, ["app"]));
+        cat_events = sort_by_duration(merge_events_by_keys(events, ["$category"]));
+        duration = sum_durations(events);
+        RETURN = {{
+            "events": limit_events(events, 1000),
+            "window": {{
+                "app_events": app_events,
+                "title_events": limit_events(title_events, 100),
+                "cat_events": cat_events,
+                "duration": duration
+            }}
+        }};
+    """
+    timeperiods = [
+        "{}/{}".format(
+            (START + timedelta(days=d)).isoformat(),
+            (START + timedelta(days=d + 1)).isoformat(),
+        )
+        for d in range(days)
+    ]
+    body = {"query": query.split("\n"), "timeperiods": timeperiods}
+
+    @benchmark
+    def run():
+        r = client.post("/api/0/query/", json=body)
+        assert r.status_code == 200
@@ -1,7 +1,49 @@
+import base64
+import functools
+import http.client
+import io
+import json
+import logging
+import os
+import pstats
+import queue
 import random
-from datetime import datetime, timedelta
+import signal
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
+import peewee
 import pytest
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+from aw_server import metrics
+from aw_server.asyncserver import AsyncWSGIServer
+from aw_server.api import ServerAPI, get_device_id
+from aw_server.exceptions import NotFound, NotSupported, ServiceUnavailable
+from aw_server.log import DroppingQueueHandler, QueuedLogWriter
+from aw_server.main import _exit_on_sigterm
+from aw_server.query_cache import MAX_CHANGES_PER_BUCKET
+from aw_server.server import (
+    AWFlask,
+    CustomJSONProvider,
+    OrjsonJSONProvider,
+    _is_stream_request,
+    _start,
+)
+
+
+@pytest.fixture()
+def peewee_app(tmp_path):
+    "An app using the peewee storage method, for tests relying on transactions"
+    storage_method = functools.partial(
+        get_storage_methods()["peewee"], filepath=str(tmp_path / "peewee.db")
+    )
+    app = AWFlask("127.0.0.1", testing=True, storage_method=storage_method)
+    yield app
+    app.api.close()
 
 
 @pytest.fixture()
@@ -26,6 +68,52 @@ def test_info(flask_client):
     assert r.json["testing"]
 
 
+def test_info_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr("aw_server.api.get_data_dir", lambda _: str(tmp_path))
+    monkeypatch.setattr("aw_server.api.gethostname", lambda: "host-a")
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    info = api.get_info()
+    assert info["hostname"] == "host-a"
+    assert info["device_id"] == (tmp_path / "device_id").read_text()
+
+    # Served from memory until refreshed
+    monkeypatch.setattr("aw_server.api.gethostname", lambda: "host-b")
+    assert api.get_info() == info
+    api.refresh_info()
+    assert api.get_info() == {**info, "hostname": "host-b"}
+
+
+def test_device_id_concurrent(monkeypatch, tmp_path):
+    monkeypatch.setattr("aw_server.api.get_data_dir", lambda _: str(tmp_path))
+    barrier = threading.Barrier(8)
+    device_ids = []
+
+    def first_run():
+        barrier.wait()
+        device_ids.append(get_device_id())
+
+    threads = [threading.Thread(target=first_run) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(device_ids)) == 1
+    assert [p.name for p in tmp_path.iterdir()] == ["device_id"]
+
+
+def test_device_id_without_hard_links(monkeypatch, tmp_path):
+    monkeypatch.setattr("aw_server.api.get_data_dir", lambda _: str(tmp_path))
+
+    def link(src, dst):
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr("os.link", link)
+    device_id = get_device_id()
+    assert get_device_id() == device_id
+    assert [p.name for p in tmp_path.iterdir()] == ["device_id"]
+
+
 def test_buckets(flask_client, bucket, benchmark):
     @benchmark
     def list_buckets():
@@ -35,6 +123,37 @@ def test_buckets(flask_client, bucket, benchmark):
         assert len(r.json) == 1
 
 
+def test_buckets_last_updated(flask_client, bucket):
+    r = flask_client.get("/api/0/buckets/")
+    assert "last_updated" not in r.json[bucket]
+
+    start = datetime(2020, 1, 1, 12, 0, tzinfo=timezone.utc)
+    for i in range(3):
+        r = flask_client.post(
+            f"/api/0/buckets/{bucket}/heartbeat?pulsetime=10",
+            json={"timestamp": start + timedelta(seconds=i), "data": {"a": 1}},
+        )
+        assert r.status_code == 200
+    r = flask_client.get("/api/0/buckets/")
+    last_updated = start + timedelta(seconds=2)
+    assert r.json[bucket]["last_updated"] == last_updated.isoformat()
+
+    # Inserting an older event doesn't change last_updated
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        json=[{"timestamp": start - timedelta(hours=1), "duration": 1, "data": {}}],
+    )
+    r = flask_client.get("/api/0/buckets/")
+    assert r.json[bucket]["last_updated"] == last_updated.isoformat()
+
+    # Deleting the last event falls back to the one before it
+    last_event = flask_client.get(f"/api/0/buckets/{bucket}/events?limit=1").json[0]
+    flask_client.delete(f"/api/0/buckets/{bucket}/events/{last_event['id']}")
+    r = flask_client.get("/api/0/buckets/")
+    older_end = start - timedelta(hours=1) + timedelta(seconds=1)
+    assert r.json[bucket]["last_updated"] == older_end.isoformat()
+
+
 def test_heartbeats(flask_client, bucket, benchmark):
     # FIXME: Currently tests using the memory storage method
     # TODO: Test with a longer data section and see if there's a significant difference
@@ -49,6 +168,1069 @@ def test_heartbeats(flask_client, bucket, benchmark):
         assert r.status_code == 200
 
 
+def test_heartbeats_batch(flask_client, bucket):
+    start = datetime(2020, 1, 1, 12, 0, tzinfo=timezone.utc)
+    labels = ["a", "a", "a", "b", "b", "a"]
+    heartbeats = [
+        {"timestamp": start + timedelta(seconds=i), "data": {"label": label}}
+        for i, label in enumerate(labels)
+    ]
+
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeats?pulsetime=2", json=heartbeats[:2]
+    )
+    assert r.status_code == 200
+    assert r.json["duration"] == 1
+
+    # Continues merging into the last event of the previous batch
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeats?pulsetime=2", json=heartbeats[2:]
+    )
+    assert r.status_code == 200
+    assert r.json["data"] == {"label": "a"}
+
+    events = flask_client.get(f"/api/0/buckets/{bucket}/events").json
+    assert [(e["data"]["label"], e["duration"]) for e in events] == [
+        ("a", 0),
+        ("b", 1),
+        ("a", 2),
+    ]
+
+    # Malformed heartbeats are rejected without creating any events
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeats?pulsetime=2", json=[{"bogus": 1}]
+    )
+    assert r.status_code == 400
+    assert len(flask_client.get(f"/api/0/buckets/{bucket}/events").json) == 3
+
+
+def test_heartbeats_batch_transaction(peewee_app, monkeypatch):
+    """A batch of heartbeats is written in a single transaction"""
+    api = peewee_app.api
+    api.create_bucket("test-batch", "test", "test", "test")
+    start = datetime(2020, 1, 1, 12, 0, tzinfo=timezone.utc)
+    heartbeats = [
+        Event(timestamp=start + timedelta(seconds=i), data={"label": label})
+        for i, label in enumerate(["a", "a", "b"])
+    ]
+    api.heartbeats("test-batch", heartbeats[:1], pulsetime=2)
+
+    # The second heartbeat is merged into the last event and the third inserted,
+    # should inserting fail the merge is rolled back too
+    storage = api.db.storage_strategy
+
+    def insert_many(*args):
+        storage.storage.insert_many(*args)
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(storage, "insert_many", insert_many)
+    with pytest.raises(RuntimeError):
+        api.heartbeats("test-batch", heartbeats[1:], pulsetime=2)
+    events = api.db["test-batch"].get()
+    assert [(e.data["label"], e.duration) for e in events] == [("a", timedelta(0))]
+
+    monkeypatch.undo()
+    api.heartbeats("test-batch", heartbeats[1:], pulsetime=2)
+    events = api.db["test-batch"].get()
+    assert [(e.data["label"], e.duration) for e in events] == [
+        ("b", timedelta(0)),
+        ("a", timedelta(seconds=1)),
+    ]
+
+
+def test_export_stream(flask_client, bucket):
+    start = datetime(2020, 1, 1, 12, 0, tzinfo=timezone.utc)
+    events = [
+        {"timestamp": start + timedelta(minutes=i), "duration": 30, "data": {"i": i}}
+        for i in range(5)
+    ]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export")
+    assert r.status_code == 200
+    exported = r.json["buckets"][bucket]
+    assert exported["id"] == bucket
+    assert [e["data"]["i"] for e in exported["events"]] == [4, 3, 2, 1, 0]
+    assert all("id" not in e for e in exported["events"])
+
+    r = flask_client.get("/api/0/export")
+    assert r.json["buckets"][bucket] == exported
+
+    r = flask_client.get("/api/0/buckets/test-nonexistent/export")
+    assert r.status_code == 404
+
+
+def test_import_stream(flask_client):
+    bucket_id = "test-import"
+    events = [
+        {
+            "id": i,
+            "timestamp": f"2020-01-01T00:0{i}:00+00:00",
+            "duration": 1,
+            "data": {},
+        }
+        for i in range(5)
+    ]
+    # Events before the metadata are buffered until the bucket can be created
+    bucket = {
+        "events": events,
+        "id": bucket_id,
+        "created": "2020-01-01T00:00:00+00:00",
+        "type": "test",
+        "client": "test",
+        "hostname": "test",
+    }
+    r = flask_client.post("/api/0/import", json={"buckets": {bucket_id: bucket}})
+    assert r.status_code == 200
+    r = flask_client.get(f"/api/0/buckets/{bucket_id}/events")
+    assert len(r.json) == 5
+    flask_client.delete(f"/api/0/buckets/{bucket_id}")
+
+    # Import of a file (as done by the web UI) exported from the server
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    api.import_all({bucket_id: bucket})
+    export = "".join(api.export_all_stream()).encode()
+    r = flask_client.post(
+        "/api/0/import", data={"file": (io.BytesIO(export), "export.json")}
+    )
+    assert r.status_code == 200
+    r = flask_client.get(f"/api/0/buckets/{bucket_id}/events")
+    assert len(r.json) == 5
+    flask_client.delete(f"/api/0/buckets/{bucket_id}")
+
+    # Truncated and malformed imports are rejected
+    for body in [
+        export[: len(export) // 2],
+        b"{",
+        b'{"buckets": {"a": {"events": 1}}}',
+    ]:
+        r = flask_client.post(
+            "/api/0/import", data=body, content_type="application/json"
+        )
+        assert r.status_code == 400
+    flask_client.delete(f"/api/0/buckets/{bucket_id}")
+
+
+def test_bucket_ids():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    assert api.create_bucket("test-a", "test", "test", "test")
+    assert not api.create_bucket("test-a", "test", "test", "test")
+    api.create_bucket("test-b", "test", "test", "test")
+    assert api.bucket_ids == set(db.buckets()) == {"test-a", "test-b"}
+
+    api.delete_bucket("test-a")
+    assert api.bucket_ids == set(db.buckets()) == {"test-b"}
+    with pytest.raises(NotFound):
+        api.get_events("test-a")
+    assert api.create_bucket("test-a", "test", "test", "test")
+
+    bucket = {
+        "id": "test-imported",
+        "created": "2020-01-01T00:00:00+00:00",
+        "type": "test",
+        "client": "test",
+        "hostname": "test",
+        "events": [],
+    }
+    api.import_all({"test-imported": bucket})
+    export = json.dumps(
+        {"buckets": {"test-streamed": {**bucket, "id": "test-streamed"}}}
+    )
+    api.import_stream(io.BytesIO(export.encode()))
+    assert api.bucket_ids == set(db.buckets())
+    assert api.bucket_ids == {"test-a", "test-b", "test-imported", "test-streamed"}
+    assert api.get_events("test-streamed") == []
+
+    # Buckets existing in the datastore are known on startup
+    assert ServerAPI(db, testing=True).bucket_ids == api.bucket_ids
+
+
+def test_iter_event_pages():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    bucket_id = "test-pages"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # Several events with the same timestamp, some overlapping the following ones
+    api.create_events(
+        bucket_id,
+        [
+            Event(timestamp=start + timedelta(minutes=i // 3), duration=90, data={})
+            for i in range(20)
+        ],
+    )
+
+    pages = list(api._iter_event_pages(bucket_id, page_size=2))
+    events = [e for page in pages for e in page]
+    assert len(events) == 20
+    assert len({e.id for e in events}) == 20
+    assert all(e.duration == timedelta(seconds=90) for e in events)
+    assert events == sorted(events, key=lambda e: e.timestamp, reverse=True)
+
+
+def test_events_pagination(flask_client, bucket):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # Groups of events with the same timestamp, overlapping the following group
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        json=[
+            {
+                "timestamp": (start + timedelta(minutes=i // 4)).isoformat(),
+                "duration": 90,
+                "data": {"i": i},
+            }
+            for i in range(25)
+        ],
+    )
+    assert r.status_code == 200
+
+    events = []
+    cursor = None
+    while True:
+        url = f"/api/0/buckets/{bucket}/events?page_size=3"
+        if cursor:
+            url += f"&cursor={cursor}"
+        r = flask_client.get(url)
+        assert r.status_code == 200
+        assert len(r.json["events"]) <= 3
+        events += r.json["events"]
+        cursor = r.json["next"]
+        if cursor is None:
+            break
+
+    assert sorted(e["data"]["i"] for e in events) == list(range(25))
+    assert all(e["duration"] == 90 for e in events)
+    assert events == flask_client.get(f"/api/0/buckets/{bucket}/events").json
+
+    for cursor in [
+        "invalid",
+        base64.urlsafe_b64encode(b"2020-01-01T00:00:00+00:00").decode(),
+        base64.urlsafe_b64encode(b"yesterday|1").decode(),
+        base64.urlsafe_b64encode(b"2020-01-01T00:00:00+00:00|x").decode(),
+        base64.urlsafe_b64encode(b"\xff|1").decode(),
+    ]:
+        r = flask_client.get(f"/api/0/buckets/{bucket}/events?cursor={cursor}")
+        assert r.status_code == 400
+        assert "Invalid pagination cursor" in r.json["message"]
+    for page_size in ["abc", "0", "1.5"]:
+        r = flask_client.get(f"/api/0/buckets/{bucket}/events?page_size={page_size}")
+        assert r.status_code == 400
+        assert "page_size must be" in r.json["message"]
+
+
+def test_json_provider_orjson(app):
+    pytest.importorskip("orjson")
+    events = [
+        Event(
+            id=i,
+            timestamp=datetime(2020, 1, 1, 0, 0, i, i * 1000, tzinfo=timezone.utc),
+            duration=i / 3,
+            data={"app": "ä", "n": i},
+        )
+        for i in range(3)
+    ]
+    expected = CustomJSONProvider(app).dumps([e.to_json_dict() for e in events])
+    fast = OrjsonJSONProvider(app)
+    assert json.loads(fast.dumps(events)) == json.loads(expected)
+    assert fast.response(events).json == json.loads(expected)
+
+    # Falls back to the standard library for what orjson can't serialize
+    assert fast.response({"big": 2**64}).json == {"big": 2**64}
+
+
+def test_asyncio_server(app):
+    server = AsyncWSGIServer(
+        app, "127.0.0.1", 0, threads=1, is_stream=_is_stream_request
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    assert server.started.wait(5)
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.port)
+        bucket_id = "test-asyncio"
+
+        def request(method, path, body=None, headers={}, **kwargs):
+            conn.request(method, path, body, {"Host": "127.0.0.1", **headers}, **kwargs)
+            r = conn.getresponse()
+            return r.status, r.read()
+
+        # Several requests over the same (kept alive) connection
+        status, _ = request(
+            "POST",
+            f"/api/0/buckets/{bucket_id}",
+            json.dumps({"client": "test", "type": "test", "hostname": "test"}),
+            {"Content-Type": "application/json"},
+        )
+        assert status == 200
+        start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        for i in range(3):
+            status, _ = request(
+                "POST",
+                f"/api/0/buckets/{bucket_id}/heartbeat?pulsetime=2",
+                json.dumps({"timestamp": (start + timedelta(seconds=i)).isoformat()}),
+                {"Content-Type": "application/json"},
+            )
+            assert status == 200
+
+        # Chunked request body
+        events = [
+            {"timestamp": (start + timedelta(minutes=i)).isoformat(), "data": {}}
+            for i in range(1, 4)
+        ]
+        body = json.dumps(events).encode()
+        status, _ = request(
+            "POST",
+            f"/api/0/buckets/{bucket_id}/events",
+            iter([body[:10], body[10:]]),
+            {"Content-Type": "application/json"},
+            encode_chunked=True,
+        )
+        assert status == 200
+
+        status, data = request("GET", f"/api/0/buckets/{bucket_id}/events")
+        assert status == 200
+        events = json.loads(data)
+        assert len(events) == 4
+        assert events[-1]["duration"] == 2
+
+        status, _ = request("GET", "/api/0/buckets/test-nonexisting/events")
+        assert status == 404
+
+        # Bodies of an invalid length, or with both a length and chunked encoding
+        for headers in [
+            "Content-Length: -1\r\n",
+            "Content-Length: abc\r\n",
+            "Content-Length: 2\r\nTransfer-Encoding: chunked\r\n",
+        ]:
+            with socket.create_connection(("127.0.0.1", server.port)) as s:
+                s.sendall(
+                    f"POST /api/0/buckets/{bucket_id}/events HTTP/1.1\r\n"
+                    f"Host: 127.0.0.1\r\n{headers}\r\n[]".encode()
+                )
+                assert s.recv(1024).startswith(b"HTTP/1.1 400 ")
+        # Open change subscriptions don't take the only request thread
+        changes = http.client.HTTPConnection("127.0.0.1", server.port)
+        changes.request("GET", "/api/0/changes", headers={"Host": "127.0.0.1"})
+        r = changes.getresponse()
+        assert r.status == 200
+        assert r.read(len(b": keep-alive\n\n")) == b": keep-alive\n\n"
+        status, _ = request("DELETE", f"/api/0/buckets/{bucket_id}")
+        assert status == 200
+        changes.close()
+        conn.close()
+        # Ends the subscription right away, instead of at the next keep-alive
+        app.api.notifier.close()
+        for _ in range(100):
+            if app.api.streams == 0:
+                break
+            time.sleep(0.01)
+        assert app.api.streams == 0
+    finally:
+        server.stop()
+        thread.join(5)
+
+
+def test_heartbeat_stream(app, flask_client, bucket):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def heartbeat_line(i, data):
+        hb = {"timestamp": (start + timedelta(seconds=i)).isoformat(), "data": data}
+        return (json.dumps(hb) + "\n").encode()
+
+    lines = [heartbeat_line(i, {"a": i // 3}) for i in range(6)]
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeat/stream?pulsetime=2",
+        data=b"".join(lines) + b"\n",
+        content_type="application/x-ndjson",
+    )
+    assert r.status_code == 200
+    assert r.json == {"heartbeats": 6}
+    events = flask_client.get(f"/api/0/buckets/{bucket}/events").json
+    assert [e["duration"] for e in events] == [2, 2]
+
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeat/stream?pulsetime=2",
+        data=heartbeat_line(6, {"a": 2}) + b"invalid\n",
+    )
+    assert r.status_code == 400
+
+    # Heartbeats are processed as they arrive, before the stream has ended,
+    # without taking the only thread other requests are handled by
+    server = AsyncWSGIServer(
+        app, "127.0.0.1", 0, threads=1, is_stream=_is_stream_request
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    assert server.started.wait(5)
+
+    def body():
+        for i in range(7, 10):
+            yield heartbeat_line(i, {"b": i})
+            for _ in range(100):
+                last = app.api.get_events(bucket, limit=1)[0]
+                if last["timestamp"] == (start + timedelta(seconds=i)).isoformat():
+                    break
+                time.sleep(0.01)
+            else:
+                raise AssertionError(f"Heartbeat {i} wasn't processed")
+            other = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+            other.request("GET", "/api/0/info", headers={"Host": "127.0.0.1"})
+            assert other.getresponse().status == 200
+            other.close()
+
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.port)
+        conn.request(
+            "POST",
+            f"/api/0/buckets/{bucket}/heartbeat/stream?pulsetime=2",
+            body(),
+            {"Host": "127.0.0.1"},
+            encode_chunked=True,
+        )
+        r = conn.getresponse()
+        assert r.status == 200
+        assert json.loads(r.read()) == {"heartbeats": 3}
+        conn.close()
+    finally:
+        server.stop()
+        thread.join(5)
+
+
+def test_heartbeat_stream_limits(bucket):
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    api.create_bucket(bucket, "test", "test", "test")
+    api.max_streams = 1
+
+    # A stream kept open until its write end is closed
+    read_fd, write_fd = os.pipe()
+    stream = threading.Thread(
+        target=api.heartbeat_stream, args=(bucket, os.fdopen(read_fd, "rb"), 2)
+    )
+    stream.start()
+    for _ in range(100):
+        if api.streams == 1:
+            break
+        time.sleep(0.01)
+    with pytest.raises(ServiceUnavailable):
+        api.heartbeat_stream(bucket, io.BytesIO(b""), 2)
+    os.close(write_fd)
+    stream.join(5)
+    assert api.streams == 0
+    assert api.heartbeat_stream(bucket, io.BytesIO(b""), 2) == 0
+
+    # Rejected by servers reading the whole body before handling a request
+    api.stream_request_bodies = False
+    with pytest.raises(NotSupported):
+        api.heartbeat_stream(bucket, io.BytesIO(b""), 2)
+
+
+def test_changes():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    all_changes = api.changes(keepalive_interval=0.01)
+    a_changes = api.changes({"test-a"}, keepalive_interval=0.01)
+    assert next(all_changes) is None
+    assert next(a_changes) is None
+
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    api.create_bucket("test-a", "test", "test", "test")
+    api.create_bucket("test-b", "test", "test", "test")
+    api.heartbeat("test-a", Event(timestamp=start, data={"a": 1}), pulsetime=2)
+    api.heartbeat(
+        "test-a", Event(timestamp=start + timedelta(seconds=1), data={"a": 1}), 2
+    )
+    api.create_events("test-b", [Event(timestamp=start, data={})])
+    event_id = api.get_events("test-a")[0]["id"]
+    api.delete_event("test-a", event_id)
+    # Deleting an event which doesn't exist changes nothing
+    assert not api.delete_event("test-a", event_id)
+
+    def received(changes):
+        notifications = []
+        for n in changes:
+            if n is None:
+                return notifications
+            notifications.append((n["type"], n["bucket"]))
+
+    assert received(a_changes) == [
+        ("bucket_created", "test-a"),
+        ("created", "test-a"),
+        ("merged", "test-a"),
+        ("deleted", "test-a"),
+    ]
+    assert len(received(all_changes)) == 6
+
+    # Subscribers not keeping up are told to refresh everything instead
+    api.notifier.max_queued = 2
+    slow_changes = api.changes(keepalive_interval=0.01)
+    next(slow_changes)
+    for i in range(5):
+        api.create_events("test-b", [Event(timestamp=start, data={})])
+    assert next(slow_changes)["type"] == "overflow"
+    assert next(slow_changes) is None
+
+    api.close()
+    # Ended once the subscriptions are closed
+    assert list(all_changes) == []
+    assert api.notifier.subscriptions == []
+
+
+def test_changes_sse(app, flask_client, bucket):
+    r = flask_client.get(f"/api/0/changes?bucket={bucket}", buffered=False)
+    assert r.status_code == 200
+    assert r.mimetype == "text/event-stream"
+    stream = iter(r.response)
+    assert next(stream) == b": keep-alive\n\n"
+
+    flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeat?pulsetime=2",
+        json={"timestamp": "2020-01-01T00:00:00+00:00", "data": {"a": 1}},
+    )
+    message = next(stream).decode()
+    assert message.startswith("event: created\ndata: ")
+    data = json.loads(message.split("data: ", 1)[1])
+    assert data["bucket"] == bucket
+    assert data["event"]["timestamp"] == "2020-01-01T00:00:00+00:00"
+
+    # Further subscribers are rejected while max_streams streams are open
+    max_streams, app.api.max_streams = app.api.max_streams, 1
+    try:
+        assert flask_client.get("/api/0/changes").status_code == 503
+    finally:
+        app.api.max_streams = max_streams
+    r.close()
+    assert not app.api.notifier.subscriptions
+    assert app.api.streams == 0
+
+
+def test_summarize():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    bucket_id = "test-summary"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # An event every 10 minutes for 3 days, none crossing the edges of the periods below
+    api.create_events(
+        bucket_id,
+        [
+            Event(
+                timestamp=start + timedelta(minutes=10 * i),
+                duration=9 * 60,
+                data={"app": f"app{i % 3}", "title": f"title{i % 5}"},
+            )
+            for i in range(3 * 24 * 6)
+        ],
+    )
+    # Days starting at 04:00 in a timezone not offset by whole hours
+    tz = timezone(timedelta(hours=5, minutes=30))
+    timeperiods = [
+        "{}/{}".format(
+            datetime(2020, 1, d, 4, 9, 30, tzinfo=tz).isoformat(),
+            datetime(2020, 1, d + 1, 4, 9, 30, tzinfo=tz).isoformat(),
+        )
+        for d in range(1, 3)
+    ]
+    query = f"""
+        events = query_bucket("{bucket_id}");
+        events = merge_events_by_keys(events, ["app", "title"]);
+        RETURN = sort_by_duration(events);
+    """
+
+    def assert_same_as_query():
+        summary = api.summarize(bucket_id, ["app", "title"], timeperiods)
+        expected = api.query2("", query, timeperiods, False)
+        for s, q in zip(summary, expected):
+            durations = [e["duration"] for e in s]
+            assert durations == sorted(durations, reverse=True)
+            assert {json.dumps(e["data"]): e["duration"] for e in s} == pytest.approx(
+                {json.dumps(e.data): e.duration.total_seconds() for e in q}
+            )
+
+    assert_same_as_query()
+    assert api.rollups.rollups[bucket_id][("app", "title")]
+
+    # Rollups are kept up to date by heartbeats, deletions and inserts
+    last = api.get_events(bucket_id, limit=1)[0]
+    end = start + timedelta(minutes=10 * (3 * 24 * 6 - 1) + 9)
+    api.heartbeat(
+        bucket_id, Event(timestamp=end + timedelta(seconds=30), data=last["data"]), 60
+    )
+    assert api.get_events(bucket_id, limit=1)[0]["duration"] == 9 * 60 + 30
+    assert_same_as_query()
+    api.delete_event(bucket_id, api.get_events(bucket_id, limit=100)[50]["id"])
+    assert_same_as_query()
+    api.create_events(
+        bucket_id,
+        [
+            Event(
+                timestamp=start + timedelta(days=1, minutes=i),
+                duration=30,
+                data={"app": "new"},
+            )
+            for i in range(3)
+        ],
+    )
+    assert_same_as_query()
+
+    categories = [[["Work"], {"type": "regex", "regex": "app1"}]]
+    summary = api.summarize(bucket_id, ["app"], timeperiods[:1], categories)[0]
+    assert {tuple(e["data"]["$category"]) for e in summary} == {
+        ("Work",),
+        ("Uncategorized",),
+    }
+
+    # The least recently used rollups are dropped once too many hours are rolled up
+    assert api.rollups.size == sum(api.rollups.sizes.values())
+    api.rollups.max_hours = api.rollups.size + 10
+    api.summarize(bucket_id, ["title"], timeperiods)
+    assert set(api.rollups.rollups[bucket_id]) == {("app",), ("title",)}
+    assert api.rollups.size <= api.rollups.max_hours
+
+    # Rollups are dropped with their bucket
+    api.delete_bucket(bucket_id)
+    assert not api.rollups.rollups
+    assert not api.rollups.sizes
+    assert api.rollups.size == 0
+
+
+def test_heartbeat_write_behind():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True, heartbeat_flush_interval=3600)
+    api.create_bucket("test-write-behind", "test", "test", "test")
+
+    start = datetime.now(tz=timezone.utc) - timedelta(minutes=1)
+    for i in range(5):
+        api.heartbeat(
+            "test-write-behind",
+            Event(timestamp=start + timedelta(seconds=i), data={"a": 1}),
+            pulsetime=2,
+        )
+
+    # Merged heartbeats are held back, so only the first one has been written
+    assert db["test-write-behind"].get(limit=1)[0].duration == timedelta(0)
+
+    # Reads flush pending heartbeats first
+    events = api.get_events("test-write-behind")
+    assert len(events) == 1
+    assert events[0]["duration"] == 4
+    api.close()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="SIGTERM can't be caught")
+def test_heartbeat_write_behind_sigterm(monkeypatch):
+    """Pending heartbeats are written when the server is stopped with SIGTERM"""
+    apps = []
+
+    def run(app, **kwargs):
+        apps.append(app)
+        app.api.create_bucket("test-sigterm", "test", "test", "test")
+        start = datetime.now(tz=timezone.utc) - timedelta(minutes=1)
+        for i in range(3):
+            app.api.heartbeat(
+                "test-sigterm",
+                Event(timestamp=start + timedelta(seconds=i), data={"a": 1}),
+                pulsetime=2,
+            )
+        os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(10)
+
+    monkeypatch.setattr(AWFlask, "run", run)
+    previous = signal.getsignal(signal.SIGTERM)
+    try:
+        _exit_on_sigterm()
+        with pytest.raises(SystemExit):
+            _start(
+                get_storage_methods()["memory"],
+                "127.0.0.1",
+                5666,
+                testing=True,
+                heartbeat_flush_interval=3600,
+            )
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    (app,) = apps
+    events = app.api.db["test-sigterm"].get()
+    assert len(events) == 1
+    assert events[0].duration == timedelta(seconds=2)
+
+
+def test_heartbeat_lock_per_bucket():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    api.create_bucket("test-a", "test", "test", "test")
+    api.create_bucket("test-b", "test", "test", "test")
+
+    e = Event(timestamp=datetime.now(tz=timezone.utc), data={"a": 1})
+    holder = threading.Thread(target=api._get_heartbeat_lock("test-a").acquire)
+    holder.start()
+    holder.join()
+    # Heartbeats to other buckets aren't blocked by the held lock
+    assert api.heartbeat("test-b", e, pulsetime=1)
+
+    api.delete_bucket("test-b")
+    assert "test-b" not in api.heartbeat_locks
+
+
+def test_query2_cache():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True, query_cache_size=10**6)
+    bucket_id = "test-query-cache"
+    api.create_bucket(bucket_id, "test", "test", "test")
+
+    day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    timeperiods = [f"{day.isoformat()}/{(day + timedelta(days=1)).isoformat()}"]
+    query = [f'events = query_bucket("{bucket_id}");', "RETURN = events;"]
+    api.create_events(bucket_id, [Event(timestamp=day, duration=60, data={})])
+
+    assert len(api.query2("test", query, timeperiods, True)[0]) == 1
+    assert len(api.query2("test", query, timeperiods, True)[0]) == 1
+    assert api.query_cache.hits == 1
+
+    # Writes after the timeperiod don't invalidate the result, however many there are
+    now = datetime.now(tz=timezone.utc)
+    for i in range(MAX_CHANGES_PER_BUCKET + 1):
+        api.heartbeat(
+            bucket_id, Event(timestamp=now + timedelta(seconds=i), data={}), 1
+        )
+    api.query2("test", query, timeperiods, True)
+    assert api.query_cache.hits == 2
+
+    # Writes within the timeperiod do
+    api.create_events(
+        bucket_id, [Event(timestamp=day + timedelta(hours=1), duration=60, data={})]
+    )
+    assert len(api.query2("test", query, timeperiods, True)[0]) == 2
+    assert api.query_cache.hits == 2
+
+
+def test_query2_parallel():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    bucket_id = "test-query-parallel"
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    ServerAPI(db, testing=True).create_bucket(bucket_id, "test", "test", "test")
+    db[bucket_id].insert(
+        [
+            Event(
+                # Not on the timeperiod boundaries, as only PeeweeStorage trims events to the timeperiod
+                timestamp=start + timedelta(minutes=10 * i + 1),
+                duration=300,
+                data={"label": str(i % 3)},
+            )
+            for i in range(6 * 24 * 3)
+        ]
+    )
+    timeperiods = [
+        f"{start + timedelta(days=i)}/{start + timedelta(days=i + 1)}".replace(" ", "T")
+        for i in range(3)
+    ]
+    query = [
+        f'events = query_bucket("{bucket_id}");',
+        'RETURN = merge_events_by_keys(events, ["label"]);',
+    ]
+
+    expected = ServerAPI(db, testing=True).query2("test", query, timeperiods, False)
+    api = ServerAPI(db, testing=True, query_workers=2)
+    try:
+        assert api.query2("test", query, timeperiods, False) == expected
+
+        # If a worker dies the query runs in the server process, and the workers are restarted
+        assert api.query_pool is not None
+        broken = api.query_pool._get_executor()
+        for process in list(broken._processes.values()):
+            process.kill()
+            process.join()
+        assert api.query2("test", query, timeperiods, False) == expected
+        assert api.query_pool._get_executor() is not broken
+        assert api.query2("test", query, timeperiods, False) == expected
+    finally:
+        api.close()
+
+
+def test_query2_profile(flask_client, bucket):
+    day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    events = [
+        Event(timestamp=day + timedelta(minutes=i), duration=30, data={"i": i % 2})
+        for i in range(10)
+    ]
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        json=[e.to_json_dict() for e in events],
+    )
+    assert r.status_code == 200
+    query = {
+        "timeperiods": [f"{day.isoformat()}/{(day + timedelta(days=1)).isoformat()}"],
+        "query": [
+            f'events = query_bucket("{bucket}");',
+            'events = merge_events_by_keys(events, ["i"]);',
+            "RETURN = events;",
+        ],
+    }
+
+    plain = flask_client.post("/api/0/query/", json=query).get_json()
+    r = flask_client.post("/api/0/query/?profile=1", json=query)
+    assert r.status_code == 200
+    profiled = r.get_json()
+    assert profiled["result"] == plain
+    assert profiled["encode_time"] >= 0
+
+    (profile,) = profiled["profile"]
+    read, merge, ret = profile["statements"]
+    assert (read["events_in"], read["events_out"]) == (0, 10)
+    assert read["datastore_events"] == 10
+    assert read["datastore_time"] > 0
+    assert (merge["events_in"], merge["events_out"]) == (10, 2)
+    assert merge["datastore_time"] == 0
+    assert (ret["events_in"], ret["events_out"]) == (2, 2)
+    assert profile["time"] >= sum(s["time"] for s in profile["statements"])
+
+
+def test_metrics(app, flask_client, bucket):
+    def sample(metrics: str, name: str) -> float:
+        return sum(
+            float(line.rsplit(" ", 1)[1])
+            for line in metrics.splitlines()
+            if line.startswith(name)
+        )
+
+    before = flask_client.get("/api/0/metrics").get_data(as_text=True)
+    now = datetime.now(tz=timezone.utc)
+    for i, data in enumerate([{"a": 1}, {"a": 1}, {"a": 2}]):
+        r = flask_client.post(
+            f"/api/0/buckets/{bucket}/heartbeat?pulsetime=10",
+            json=Event(timestamp=now + timedelta(seconds=i), data=data).to_json_dict(),
+        )
+        assert r.status_code == 200
+
+    r = flask_client.get("/api/0/metrics")
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    after = r.get_data(as_text=True)
+
+    route = 'route="/api/0/buckets/<string:bucket_id>/heartbeat"'
+    requests = f'aw_requests_total{{method="POST",{route},status="200"}}'
+    assert sample(after, requests) - sample(before, requests) == 3
+    latency = f'aw_request_duration_seconds_count{{method="POST",{route}}}'
+    assert sample(after, latency) - sample(before, latency) == 3
+    for result, count in [("merged", 1), ("inserted", 2)]:
+        name = f'aw_heartbeats_total{{result="{result}"}}'
+        assert sample(after, name) - sample(before, name) == count
+    lock_wait = "aw_heartbeat_lock_wait_seconds_count"
+    assert sample(after, lock_wait) - sample(before, lock_wait) == 3
+    assert 'aw_datastore_call_duration_seconds_count{call="insert_one"}' in after
+
+
+def test_metrics_storage_transactions(peewee_app):
+    """The storage method is timed without hiding its database (and transactions)"""
+    storage = peewee_app.api.db.storage_strategy
+    assert isinstance(storage, metrics.TimedStorage)
+    assert storage.db is storage.storage.db
+    assert isinstance(peewee_app.api._transaction(), peewee._atomic)
+
+    peewee_app.api.create_bucket("test-timed", "test", "test", "test")
+    metrics_text = peewee_app.test_client().get("/api/0/metrics").get_data(as_text=True)
+    assert (
+        'aw_datastore_call_duration_seconds_count{call="create_bucket"}' in metrics_text
+    )
+
+
+def test_profiler(app, flask_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app.profiler, "profile_dir", str(tmp_path))
+    r = flask_client.post("/api/0/profiler", json={"enabled": True, "sample_rate": 2})
+    assert r.status_code == 400
+    assert not app.profiler.enabled
+
+    r = flask_client.post(
+        "/api/0/profiler",
+        json={"enabled": True, "routes": ["/api/0/info", "/api/0/export"]},
+    )
+    assert r.status_code == 200
+    try:
+        assert flask_client.get("/api/0/profiler").get_json()["enabled"]
+        assert flask_client.get("/api/0/info").status_code == 200
+        assert flask_client.get("/api/0/buckets/").status_code == 200
+        # Streamed responses aren't collected in memory to be profiled
+        r = flask_client.get("/api/0/export", buffered=False)
+        assert not isinstance(r.response, list)
+        assert "buckets" in json.loads(r.get_data())
+    finally:
+        flask_client.post("/api/0/profiler", json={"enabled": False})
+    flask_client.get("/api/0/info")
+
+    (profile,) = tmp_path.iterdir()
+    assert profile.name.startswith("GET.api.0.info.")
+    assert pstats.Stats(str(profile)).total_calls > 0
+
+
+def test_create_events_bulk(flask_client, bucket):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    events = [
+        Event(timestamp=start + timedelta(seconds=i), duration=1, data={"i": i})
+        for i in range(1200)
+    ]
+    lines = [json.dumps(e.to_json_dict()) for e in events]
+    # Blank lines are skipped, Z suffixes are parsed
+    lines[0] = lines[0].replace("+00:00", "Z")
+    body = "\n".join(lines[:1000] + [""] + lines[1000:]) + "\n"
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        data=body,
+        content_type="application/x-ndjson",
+    )
+    assert r.status_code == 200
+    assert r.json == {"events": 1200}
+    stored = flask_client.get(f"/api/0/buckets/{bucket}/events").json
+    assert [Event(**e) for e in reversed(stored)] == events
+
+    # Events before the batch with an invalid event are created
+    lines[1100] = "{"
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    assert r.status_code == 400
+    assert "Invalid event 1101 (1000 events created)" in r.json["message"]
+    assert flask_client.get(f"/api/0/buckets/{bucket}/events/count").json == 2200
+
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/events", json=[{"timestamp": "yesterday"}]
+    )
+    assert r.status_code == 400
+
+    # Lists of events are created all or none
+    start += timedelta(hours=1)
+    data = [
+        Event(timestamp=start + timedelta(seconds=i), duration=1).to_json_dict()
+        for i in range(1500)
+    ]
+    data[1200] = {"timestamp": "yesterday"}
+    r = flask_client.post(f"/api/0/buckets/{bucket}/events", json=data)
+    assert r.status_code == 400
+    assert "Invalid event 1201" in r.json["message"]
+    assert flask_client.get(f"/api/0/buckets/{bucket}/events/count").json == 2200
+
+
+def test_create_events_bulk_transaction(peewee_app, monkeypatch):
+    """Lists of events are inserted in a single transaction"""
+    api = peewee_app.api
+    api.create_bucket("test-bulk", "test", "test", "test")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # More than peewee inserts per statement
+    data = [
+        Event(timestamp=start + timedelta(seconds=i), duration=1).to_json_dict()
+        for i in range(250)
+    ]
+    storage = api.db.storage_strategy
+
+    def insert_many(*args):
+        storage.storage.insert_many(*args)
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(storage, "insert_many", insert_many)
+    with pytest.raises(RuntimeError):
+        api.create_events_bulk("test-bulk", data)
+    assert api.get_eventcount("test-bulk") == 0
+
+    monkeypatch.undo()
+    assert api.create_events_bulk("test-bulk", data) == 250
+    assert api.get_eventcount("test-bulk") == 250
+
+
+def test_trace_requests(app, flask_client, bucket, caplog):
+    caplog.set_level(logging.INFO, logger="aw_server.trace")
+    assert flask_client.get("/api/0/trace").json == {"enabled": False}
+    flask_client.get(f"/api/0/buckets/{bucket}")
+    assert not [r for r in caplog.records if r.name == "aw_server.trace"]
+
+    r = flask_client.post("/api/0/trace", json={"enabled": True})
+    assert r.json == {"enabled": True}
+    try:
+        flask_client.get(f"/api/0/buckets/{bucket}")
+    finally:
+        flask_client.post("/api/0/trace", json={"enabled": False})
+    records = [
+        json.loads(r.getMessage())
+        for r in caplog.records
+        if r.name == "aw_server.trace"
+    ]
+    # The request turning tracing on is traced, the one turning it off isn't
+    assert [r["route"] for r in records] == [
+        "/api/0/trace",
+        "/api/0/buckets/<string:bucket_id>",
+    ]
+    assert records[1]["args"] == {"bucket_id": bucket}
+    assert records[1]["status"] == 200
+    assert records[1]["duration_ms"] > 0
+
+
+def test_heartbeat_lazy_logging():
+    """Heartbeat data is only formatted for debug messages if debug logging is enabled"""
+    formatted = 0
+
+    class Data:
+        def __repr__(self):
+            nonlocal formatted
+            formatted += 1
+            return "Data()"
+
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db, testing=True)
+    api.create_bucket("test-lazy-logging", "test", "test", "test")
+    api.heartbeat(
+        "test-lazy-logging",
+        Event(timestamp=datetime.now(tz=timezone.utc), data={"data": Data()}),
+        1,
+    )
+    assert formatted == 0
+
+
+def test_queued_logging():
+    class Stream(io.StringIO):
+        flushes = 0
+
+        def flush(self):
+            self.flushes += 1
+
+    stream = Stream()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    log_queue = queue.Queue(maxsize=4)
+    queue_handler = DroppingQueueHandler(log_queue)
+    writer = QueuedLogWriter(log_queue, [handler], queue_handler)
+    test_logger = logging.getLogger("aw_server.test_queued_logging")
+    test_logger.propagate = False
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.addHandler(queue_handler)
+    try:
+        # Nothing is written until the writer runs, debug records are
+        # dropped once the queue is half full and other records once it's full
+        for i in range(3):
+            test_logger.debug("debug %d", i)
+        for i in range(3):
+            test_logger.info("info %d", i)
+        assert stream.getvalue() == ""
+        assert queue_handler.dropped == 2
+
+        writer.start()
+        writer.stop()
+        assert stream.getvalue().splitlines() == [
+            "DEBUG debug 0",
+            "DEBUG debug 1",
+            "INFO info 0",
+            "INFO info 1",
+            "WARNING Dropped 2 log records since the log queue was full",
+        ]
+        # The stream is flushed once per batch, not once per record
+        # (stopping the writer may wake it for a second, empty batch)
+        assert stream.flushes <= 2
+        assert "flush" not in vars(handler)
+    finally:
+        test_logger.removeHandler(queue_handler)
+
+
 def test_get_events(flask_client, bucket, benchmark):
     n_events = 100
     start_time = datetime.now() - timedelta(days=100)